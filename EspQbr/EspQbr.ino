@@ -269,6 +269,12 @@ void scan() {
   rotateCube(LEFT, Z);
 }
 
+// A single rotation of the whole cube, so Qbr can scan one side at a time.
+void rotate(int axis, bool prime = false, bool twice = false) {
+  rotateCube(prime ? RIGHT : LEFT, axis);
+  if(twice) rotateCube(LEFT, axis);
+}
+
 void test() {
    openGrip(RIGHT_ARM);
    closeGrip(RIGHT_ARM);
@@ -358,6 +364,12 @@ void start() {
       case 'T':
         test();
         break;
+      case 'X':
+        rotate(X, prime, twice);
+        break;
+      case 'Z':
+        rotate(Z, prime, twice);
+        break;
     }
     
     i++;
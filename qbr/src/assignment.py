@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import numpy as np
+
+def assign_with_counts(distances, counts, fixed=None):
+    """
+    Assign every item to a class such that every class gets exactly its count
+    of items and the sum of the distances is minimal, e.g. the 54 facelets to
+    the 6 colors with 9 facelets each.
+
+    This is a transportation problem with only a few classes, so it's solved
+    on the graph of the classes instead of as a (items x items) assignment:
+    every item starts at its closest class, then one item at a time is moved
+    along the cheapest chain of moves from a class with too many items to a
+    class with too few. Every step keeps the assignment the cheapest one for
+    the current counts, so the final assignment is optimal.
+
+    The margin of an item is how much the total distance grows at least when
+    it gets any other class, with the other items moved to keep the counts.
+
+    :param distances: array of shape (items, classes)
+    :param counts: The amount of items of every class, summing up to items.
+    :param fixed: The class of every item which may not be moved, -1 for the
+                  others.
+    :returns: (labels, margins) numpy arrays, the margins of fixed items are
+              inf
+    :raises ValueError: when the fixed items already exceed the counts
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    counts = np.asarray(counts)
+    items, classes = distances.shape
+    labels = np.argmin(distances, axis=1)
+    free = np.ones(items, dtype=bool)
+    if fixed is not None:
+        fixed = np.asarray(fixed)
+        free = fixed < 0
+        labels[~free] = fixed[~free]
+    if counts.sum() != items or (np.bincount(labels[~free], minlength=classes) > counts).any():
+        raise ValueError('the counts cannot be reached')
+
+    while True:
+        excess = np.bincount(labels, minlength=classes) - counts
+        if not excess.any():
+            break
+        paths, hops, movers = class_moves(distances, labels, free)
+        paths = np.where((excess > 0)[:, None] & (excess < 0)[None, :], paths, np.inf)
+        source, target = np.unravel_index(np.argmin(paths), paths.shape)
+        if not np.isfinite(paths[source, target]):
+            raise ValueError('the counts cannot be reached')
+        # Every class on the path hands one item on to the next class.
+        moves = []
+        while source != target:
+            step = hops[source, target]
+            moves.append((movers[source, step], step))
+            source = step
+        for item, label in moves:
+            labels[item] = label
+
+    paths, _, _ = class_moves(distances, labels, free)
+    rows = np.arange(items)
+    others = distances - distances[rows, labels][:, None] + paths[:, labels].T
+    others[rows, labels] = np.inf
+    margins = np.where(free, others.min(axis=1), np.inf)
+    return labels, margins
+
+def class_moves(distances, labels, free):
+    """
+    Find the cheapest chains of moves in-between the classes: moving an item
+    from class p to q costs the difference of its distances, and the edge from
+    p to q is the cheapest such move.
+
+    :returns: (paths, hops, movers), the cost of the cheapest chain from every
+              class to every class, the class after p on the chain from p to
+              q, and the item moved on the edge from p to q
+    """
+    items, classes = distances.shape
+    moves = distances - distances[np.arange(items), labels][:, None]
+    members = (labels[:, None] == np.arange(classes)) & free[:, None]
+    # (items x from x to), the cost of every item's moves out of its class.
+    by_class = np.where(members[:, :, None], moves[:, None, :], np.inf)
+    movers = by_class.argmin(axis=0)
+    paths = by_class.min(axis=0)
+    np.fill_diagonal(paths, 0)
+
+    # Floyd-Warshall, there are no negative cycles since the assignment is
+    # always the cheapest one for its counts.
+    hops = np.tile(np.arange(classes), (classes, 1))
+    for via in range(classes):
+        through = paths[:, via, None] + paths[None, via, :]
+        shorter = through < paths
+        paths = np.where(shorter, through, paths)
+        hops = np.where(shorter, hops[:, via, None], hops)
+    return paths, hops, movers
@@ -0,0 +1,768 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Micro-benchmarks for the Qbr detection pipeline.
+
+Run one of the benchmarks like so:
+
+    $ ./src/benchmark.py colors
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import cv2
+import numpy as np
+from colordetection import color_detector, DOMINANT_COLOR_ESTIMATORS
+from detection import (
+    preprocess_frame,
+    find_contours,
+    find_grid,
+    sort_grid,
+    sample_stickers,
+    detect_grid,
+    detect_grid_pyramid,
+    GridTracker
+)
+from helpers import bgr2lab, bgr2lab_batch, ciede2000
+from solution_cache import SolutionCache
+from cube import SOLVED_STATE, MOVES, apply_moves
+from constants import DEFAULT_PREVIEW_VOTE_WINDOW, DEFAULT_PREVIEW_VOTE_CONFIDENCE
+from workers import DetectionPool
+from synthetic import (
+    STICKER_SIZE,
+    STICKER_GAP,
+    draw_background,
+    draw_face,
+    generate_frame,
+    random_frame_params,
+    SyntheticCapture
+)
+
+def scalar_closest_color(bgr):
+    """The original per-color get_closest_color() implementation."""
+    lab = bgr2lab(bgr)
+    distances = []
+    for color_name, color_bgr in color_detector.cube_color_palette.items():
+        distances.append({
+            'color_name': color_name,
+            'distance': ciede2000(lab, bgr2lab(color_bgr))
+        })
+    return min(distances, key=lambda item: item['distance'])
+
+def time_call(func, repeat):
+    """Return the best time of a single call of func in microseconds."""
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1e6
+
+def bench_colors(args):
+    """
+    Compare the scalar and batch color math on random BGR colors.
+
+    Reports the time needed to classify one frame (9 stickers) and the
+    largest deviation between both paths.
+    """
+    rng = np.random.default_rng(args.seed)
+    samples = rng.integers(0, 256, size=(args.samples, 3))
+
+    lab_scalar = np.array([bgr2lab(bgr) for bgr in samples])
+    lab_batch = bgr2lab_batch(samples)
+    scalar = [scalar_closest_color(bgr) for bgr in samples]
+    batch = color_detector.get_closest_color(samples)
+    distance_error = max(abs(s['distance'] - b['distance']) for s, b in zip(scalar, batch))
+    mismatches = sum(s['color_name'] != b['color_name'] for s, b in zip(scalar, batch))
+
+    frame = samples[:9]
+    print('samples:                  {}'.format(args.samples))
+    print('max lab deviation:        {:.2e}'.format(np.abs(lab_scalar - lab_batch).max()))
+    print('max distance deviation:   {:.2e}'.format(distance_error))
+    print('classification mismatches: {}'.format(mismatches))
+    print('scalar, 9 stickers:       {:.1f} us'.format(
+        time_call(lambda: [scalar_closest_color(bgr) for bgr in frame], args.repeat)))
+    print('batch, 9 stickers:        {:.1f} us'.format(
+        time_call(lambda: color_detector.get_closest_color_indices(frame), args.repeat)))
+
+def bench_lut(args):
+    """
+    Measure the accuracy and speed of the palette lookup table against the
+    exact CIEDE2000 path for several table resolutions.
+
+    Accuracy is measured on uniformly random colors and on colors close to the
+    palette, which is what the webcam actually sees.
+    """
+    rng = np.random.default_rng(args.seed)
+    uniform = rng.integers(0, 256, size=(args.samples, 3)).astype(np.float64)
+    palette = color_detector.palette_bgr[rng.integers(0, len(color_detector.palette_bgr), args.samples)]
+    realistic = np.clip(palette + rng.normal(0, args.noise, size=palette.shape), 0, 255)
+    exact_uniform = color_detector.get_closest_color_indices(uniform, exact=True)
+    exact_realistic = color_detector.get_closest_color_indices(realistic, exact=True)
+    frame = realistic[:9]
+
+    print('exact, 9 stickers:        {:.1f} us'.format(
+        time_call(lambda: color_detector.get_closest_color_indices(frame, exact=True), args.repeat)))
+    print('resolution  build (s)  agreement uniform  agreement near palette  9 stickers (us)')
+    for resolution in args.resolutions:
+        start = timeit.default_timer()
+        color_detector.palette_lut = color_detector.build_palette_lut(resolution)
+        build_time = timeit.default_timer() - start
+        agreement_uniform = np.mean(color_detector.get_closest_color_indices(uniform) == exact_uniform)
+        agreement_realistic = np.mean(color_detector.get_closest_color_indices(realistic) == exact_realistic)
+        lookup_time = time_call(lambda: color_detector.get_closest_color_indices(frame), args.repeat)
+        print('{:>10}  {:>9.2f}  {:>17.3%}  {:>22.3%}  {:>15.1f}'.format(
+            resolution, build_time, agreement_uniform, agreement_realistic, lookup_time))
+
+def random_sticker_rois(rng, amount, size, noise, glare):
+    """
+    Generate sticker regions of interest: a palette color with gaussian noise,
+    a fraction of glare (near white) pixels and a dark border like the gaps
+    between the stickers.
+
+    :returns: (rois, ground truth palette indices)
+    """
+    height, width = size
+    truth = rng.integers(0, len(color_detector.palette_bgr), amount)
+    rois = color_detector.palette_bgr[truth][:, None, None, :] + rng.normal(0, noise, (amount, height, width, 3))
+    glare_mask = rng.random((amount, height, width)) < glare
+    rois[glare_mask] = rng.uniform(230, 255, (glare_mask.sum(), 3))
+    rois[:, :, :2] = rng.uniform(0, 40, (amount, height, 2, 3))
+    return np.uint8(np.clip(rois, 0, 255)), truth
+
+def bench_dominant(args):
+    """
+    Compare the dominant color estimators on generated sticker ROIs: time per
+    ROI, agreement of the classified color with the kmeans estimator and
+    accuracy against the ground truth.
+    """
+    rng = np.random.default_rng(args.seed)
+    rois, truth = random_sticker_rois(rng, args.samples, (args.height, args.width), args.noise, args.glare)
+    pixels = rois.reshape(args.samples, -1, 3)
+
+    def classify(estimator):
+        return color_detector.get_closest_color_indices(estimator(pixels), exact=True)
+
+    reference = classify(DOMINANT_COLOR_ESTIMATORS['kmeans'])
+    print('estimator         per ROI (us)  per 9 ROIs batched (us)  agreement with kmeans  accuracy')
+    for name, estimator in DOMINANT_COLOR_ESTIMATORS.items():
+        per_roi = time_call(lambda: estimator(pixels[0]), args.repeat)
+        batched = time_call(lambda: estimator(pixels[:9]), args.repeat)
+        indices = classify(estimator)
+        print('{:<16}  {:>12.1f}  {:>23.1f}  {:>21.2%}  {:>8.2%}'.format(
+            name, per_roi, batched, np.mean(indices == reference), np.mean(indices == truth)))
+
+def detect_in_process(frame):
+    """The work one detection worker does for a frame."""
+    contours = find_contours(preprocess_frame(frame))
+    if len(contours) == 9:
+        color_detector.get_dominant_colors(sample_stickers(frame, contours))
+    return contours
+
+def bench_workers(args):
+    """
+    Measure the detection throughput in frames per second of a single process
+    and of a DetectionPool with an increasing amount of workers.
+    """
+    rng = np.random.default_rng(args.seed)
+    frames = [generate_frame(rng, clutter=args.clutter)[0] for _ in range(32)]
+
+    start = timeit.default_timer()
+    for index in range(args.frames):
+        detect_in_process(frames[index % len(frames)])
+    baseline = args.frames / (timeit.default_timer() - start)
+    print('workers  frames/s  speedup')
+    print('{:>7}  {:>8.1f}  {:>7.2f}'.format('inline', baseline, 1))
+
+    for workers in args.workers:
+        pool = DetectionPool(workers, frames[0].shape)
+
+        # Warm up, the first result waits for the workers to start.
+        slot = pool.acquire()
+        pool.submit(slot)
+        pool.release(pool.get()[1])
+
+        start = timeit.default_timer()
+        submitted = received = 0
+        while received < args.frames:
+            slot = pool.acquire() if submitted < args.frames else None
+            if slot is not None:
+                pool.ring.frames[slot] = frames[submitted % len(frames)]
+                pool.submit(slot)
+                submitted += 1
+                continue
+            pool.release(pool.get()[1])
+            received += 1
+        fps = args.frames / (timeit.default_timer() - start)
+        pool.close()
+        print('{:>7}  {:>8.1f}  {:>7.2f}'.format(workers, fps, fps / baseline))
+
+def find_grid_bruteforce(final_contours):
+    """
+    The original O(n^2) neighbor search of find_contours, which compares every
+    contour against every other contour at each of the 9 neighbor positions.
+    """
+    if len(final_contours) < 9:
+        return []
+
+    contour_neighbors = {}
+    for index, (x, y, w, h) in enumerate(final_contours):
+        contour_neighbors[index] = []
+        center_x = x + w / 2
+        center_y = y + h / 2
+        radius = 1.5
+        neighbor_positions = [
+            [(center_x - w * radius), (center_y - h * radius)],
+            [center_x, (center_y - h * radius)],
+            [(center_x + w * radius), (center_y - h * radius)],
+            [(center_x - w * radius), center_y],
+            [center_x, center_y],
+            [(center_x + w * radius), center_y],
+            [(center_x - w * radius), (center_y + h * radius)],
+            [center_x, (center_y + h * radius)],
+            [(center_x + w * radius), (center_y + h * radius)],
+        ]
+        for neighbor in final_contours:
+            (x2, y2, w2, h2) = neighbor
+            for (x3, y3) in neighbor_positions:
+                if (x2 < x3 and y2 < y3) and (x2 + w2 > x3 and y2 + h2 > y3):
+                    contour_neighbors[index].append(neighbor)
+
+    for (contour, neighbors) in contour_neighbors.items():
+        if len(neighbors) == 9:
+            return sort_grid(neighbors)
+    return []
+
+def random_candidates(rng, amount, shape=(480, 640)):
+    """
+    Generate a list of square-ish contours like the square filter of
+    find_contours produces: one 3x3 grid plus random clutter, shuffled.
+    """
+    height, width = shape
+    candidates = []
+    size, pitch = 40, 50
+    x0, y0 = int(rng.integers(0, width - 3 * pitch)), int(rng.integers(0, height - 3 * pitch))
+    for row in range(3):
+        for col in range(3):
+            candidates.append((x0 + col * pitch, y0 + row * pitch, size, size))
+    while len(candidates) < amount:
+        w = int(rng.integers(30, 61))
+        h = int(np.clip(w * rng.uniform(0.85, 1.2), 30, 75))
+        candidates.append((int(rng.integers(0, width - w)), int(rng.integers(0, height - h)), w, h))
+    rng.shuffle(candidates)
+    return candidates
+
+def bench_neighbors(args):
+    """
+    Compare the brute force and the spatial hash neighbor search of
+    find_contours for a growing amount of candidate contours, and check that
+    both return exactly the same contours.
+    """
+    rng = np.random.default_rng(args.seed)
+    print('candidates  brute force (us)  spatial hash (us)  speedup  identical')
+    for amount in args.candidates:
+        lists = [random_candidates(rng, amount) for _ in range(args.lists)]
+        identical = all(find_grid(c) == find_grid_bruteforce(c) for c in lists)
+        brute = time_call(lambda: [find_grid_bruteforce(c) for c in lists], max(1, args.repeat // 20)) / len(lists)
+        hashed = time_call(lambda: [find_grid(c) for c in lists], max(1, args.repeat // 20)) / len(lists)
+        print('{:>10}  {:>16.1f}  {:>17.1f}  {:>7.1f}  {:>9}'.format(
+            amount, brute, hashed, brute / hashed, str(identical)))
+
+def bench_tracking(args):
+    """
+    Run the full frame search and the grid tracker on a sequence of frames in
+    which the cube slowly drifts and now and then leaves the frame.
+    """
+    rng = np.random.default_rng(args.seed)
+    background = draw_background(rng, clutter=args.clutter)
+    colors = color_detector.palette_bgr[rng.integers(0, len(color_detector.palette_bgr), 9)]
+    half = 1.5 * (STICKER_SIZE + STICKER_GAP)
+    frames = []
+    x, y = 200.0, 150.0
+    for index in range(args.frames):
+        frame = background.copy()
+        x = float(np.clip(x + rng.normal(0, 3), half + 10, 640 - half - 10))
+        y = float(np.clip(y + rng.normal(0, 3), half + 10, 480 - half - 10))
+        if (index // 50) % 4 != 3:
+            draw_face(frame, colors, (x, y))
+        frames.append(frame)
+
+    start = timeit.default_timer()
+    full = [find_contours(preprocess_frame(frame)) for frame in frames]
+    full_ms = (timeit.default_timer() - start) * 1000 / len(frames)
+
+    tracker = GridTracker()
+    tracked = [tracker.detect(frame) for frame in frames]
+    agreement = np.mean([len(a) == len(b) for a, b in zip(full, tracked)])
+
+    print('{:<30} {:.2f}'.format('full search ms_per_frame:', full_ms))
+    for name, value in tracker.summary().items():
+        print('{:<30} {}'.format('tracker {}:'.format(name), value))
+    print('{:<30} {:.2%}'.format('grid found agreement:', agreement))
+
+def bench_pyramid(args):
+    """
+    Compare the full resolution and the coarse-to-fine pyramid detection on
+    upscaled frames.
+    """
+    rng = np.random.default_rng(args.seed)
+    width, height = int(640 * args.scale), int(480 * args.scale)
+    frames = [cv2.resize(generate_frame(rng)[0], (width, height)) for _ in range(args.frames)]
+
+    start = timeit.default_timer()
+    full = [detect_grid(frame, args.scale) for frame in frames]
+    full_ms = (timeit.default_timer() - start) * 1000 / len(frames)
+
+    start = timeit.default_timer()
+    pyramid = [detect_grid_pyramid(frame, args.scale) for frame in frames]
+    pyramid_ms = (timeit.default_timer() - start) * 1000 / len(frames)
+
+    deviation = max([
+        np.abs(np.array(a) - np.array(b)).max()
+        for a, b in zip(full, pyramid) if len(a) == 9 and len(b) == 9
+    ] or [0])
+    print('resolution:               {}x{}'.format(width, height))
+    print('full resolution:          {:.2f} ms/frame, found {}/{}'.format(full_ms, sum(len(c) == 9 for c in full), len(frames)))
+    print('pyramid:                  {:.2f} ms/frame, found {}/{}'.format(pyramid_ms, sum(len(c) == 9 for c in pyramid), len(frames)))
+    print('max contour deviation:    {} px'.format(deviation))
+
+def bench_cache(args):
+    """
+    Compare solving a facelet string with kociemba to looking it up in the
+    memory and the disk layer of the solution cache.
+    """
+    import kociemba
+    import os
+    import tempfile
+
+    facelets = 'DRLUUBFBRBLURRLRUBLRDDFDLFUFUFFDBRDUBRUFLLFDDBFLUBLRBD'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'solutions.sqlite3')
+        solve_us = time_call(lambda: kociemba.solve(facelets), args.repeat)
+
+        cache = SolutionCache(path)
+        cache.solve(facelets)
+        memory_us = time_call(lambda: cache.solve(facelets), args.repeat)
+
+        def disk_lookup():
+            cache.memory.clear()
+            cache.solve(facelets)
+        disk_us = time_call(disk_lookup, args.repeat)
+        cache.close()
+
+    print('kociemba.solve:           {:.1f} µs'.format(solve_us))
+    print('memory hit:               {:.1f} µs'.format(memory_us))
+    print('disk hit:                 {:.1f} µs'.format(disk_us))
+
+def bench_state(args):
+    """
+    Time the validation of a scanned state against kociemba rejecting it, for
+    a valid state and one invalid state per check.
+    """
+    import kociemba
+    from cube import FaceletState, InvalidCubeState, CORNER_FACELETS, EDGE_FACELETS
+
+    valid = random_scramble(np.random.default_rng(args.seed))
+    def swap(facelets, pairs):
+        facelets = list(facelets)
+        for i, j in pairs:
+            facelets[i], facelets[j] = facelets[j], facelets[i]
+        return ''.join(facelets)
+    corner, edge, other = CORNER_FACELETS[0], EDGE_FACELETS[0], EDGE_FACELETS[1]
+    states = {
+        'valid': valid,
+        'colors': 'U' + valid[1:] if valid[0] != 'U' else 'R' + valid[1:],
+        'twist': swap(valid, [(corner[0], corner[1]), (corner[1], corner[2])]),
+        'flip': swap(valid, [(edge[0], edge[1])]),
+        'parity': swap(valid, zip(edge, other)),
+    }
+
+    def validate(facelets):
+        try:
+            FaceletState.from_facelets(facelets).validate()
+        except InvalidCubeState:
+            pass
+    def solve(facelets):
+        try:
+            kociemba.solve(facelets)
+        except ValueError:
+            pass
+
+    print('state      validate (µs)   kociemba (µs)')
+    for name, facelets in states.items():
+        print('{:<8}   {:>13.1f}   {:>13.1f}'.format(
+            name, time_call(lambda: validate(facelets), args.repeat), time_call(lambda: solve(facelets), 20)))
+
+def bench_assign(args):
+    """
+    Classify noisy scans of random scrambles sticker by sticker and with the
+    global color assignment, and count how many cubes come out right.
+    """
+    from cube import FaceletState, InvalidCubeState
+    from colordetection import COLOR_FACES
+
+    rng = np.random.default_rng(args.seed)
+    colors = {face: np.array(color_detector.cube_color_palette[name]) for name, face in COLOR_FACES.items()}
+    names = sorted(COLOR_FACES, key=lambda name: 'URFDLB'.index(COLOR_FACES[name]))
+
+    print('noise   lighting   per sticker right   global right   per sticker (µs)   global (µs)')
+    for noise in args.noise:
+        right = {'sticker': 0, 'global': 0}
+        seconds = {'sticker': [], 'global': []}
+        for _ in range(args.scrambles):
+            facelets = random_scramble(rng)
+            truth = FaceletState.from_facelets(facelets).colors
+            # Every side gets its own brightness, every sticker its own noise.
+            bgr = np.array([colors[face] for face in facelets], dtype=np.float64)
+            bgr *= np.repeat(1 + rng.uniform(-args.lighting, args.lighting, 6), 9)[:, None]
+            bgr = np.clip(bgr + rng.normal(0, noise, bgr.shape), 0, 255)
+            sides = {name: bgr[index * 9:index * 9 + 9] for index, name in enumerate(names)}
+
+            for method, classify in (
+                    ('sticker', lambda: color_detector.convert_sides_to_faces(sides)),
+                    ('global', lambda: color_detector.assign_sides_to_faces(sides)[0])):
+                start = time.perf_counter()
+                faces = classify()
+                seconds[method].append(time.perf_counter() - start)
+                try:
+                    FaceletState(faces).validate()
+                    right[method] += bool((faces == truth).all())
+                except InvalidCubeState:
+                    pass
+        print('{:>5.0f}   {:>8.2f}   {:>13}/{}   {:>8}/{}   {:>16.1f}   {:>11.1f}'.format(
+            noise, args.lighting, right['sticker'], args.scrambles, right['global'], args.scrambles,
+            np.median(seconds['sticker']) * 1e6, np.median(seconds['global']) * 1e6))
+
+def random_scramble(rng, length=25):
+    """Get the facelet string of a random scramble."""
+    moves = list(MOVES)
+    return apply_moves(SOLVED_STATE, [moves[i] for i in rng.integers(0, len(moves), length)])
+
+def bench_planner(args):
+    """
+    Compare the robot actuation cost of kociemba's solution with the planned
+    solution for an increasing amount of candidates.
+    """
+    from planner import Planner
+
+    rng = np.random.default_rng(args.seed)
+    scrambles = [random_scramble(rng) for _ in range(args.scrambles)]
+    print('candidates   plan (s)   moves   kociemba moves   robot cost (s)   kociemba cost (s)')
+    for candidates in args.candidates:
+        planner = Planner(candidates=candidates)
+        planner.start()
+        summaries = []
+        for facelets in scrambles:
+            planner.plan(facelets)
+            summaries.append(planner.last_summary)
+        planner.close()
+        print('{:>10}   {:>8.3f}   {:>5.1f}   {:>14.1f}   {:>14.1f}   {:>17.1f}'.format(
+            candidates,
+            np.mean([summary['seconds'] for summary in summaries]),
+            np.mean([summary['moves'] for summary in summaries]),
+            np.mean([summary['kociemba_moves'] for summary in summaries]),
+            np.mean([summary['cost'] for summary in summaries]),
+            np.mean([summary['kociemba_cost'] for summary in summaries])
+        ))
+
+def bench_robot(args):
+    """
+    Stream the solutions of random scrambles to the simulated robot and
+    compare the measured actuation time with the predicted one, for both
+    protocols and endpoints.
+    """
+    import kociemba
+    from simulator import SimulatedRobot, SimulatorServer, PtySimulator, predict_time
+    from transport import open_transport, RobotLink
+
+    rng = np.random.default_rng(args.seed)
+    scrambles = [random_scramble(rng) for _ in range(args.scrambles)]
+    solutions = [kociemba.solve(facelets).split() for facelets in scrambles]
+    predicted = sum(predict_time(solution) for solution in solutions) / args.speed
+    moves = sum(len(solution) for solution in solutions)
+
+    print('endpoint   protocol   predicted (s)   measured (s)   overhead per move (ms)   solved')
+    for endpoint in ('tcp', 'pty'):
+        for protocol in ('ascii', 'binary'):
+            robot = SimulatedRobot(protocol, speed=args.speed)
+            simulator = (SimulatorServer(robot) if endpoint == 'tcp' else PtySimulator(robot)).start()
+            link = RobotLink(open_transport(simulator.url), args.window, protocol=protocol)
+            solved = 0
+            start = time.perf_counter()
+            for facelets, solution in zip(scrambles, solutions):
+                robot.facelets = facelets
+                link.send_moves(solution)
+                solved += robot.solved
+            measured = time.perf_counter() - start
+            link.close()
+            simulator.close()
+            print('{:>8}   {:>8}   {:>13.3f}   {:>12.3f}   {:>22.3f}   {:>3}/{}'.format(
+                endpoint, protocol, predicted, measured, (measured - predicted) / moves * 1000,
+                solved, len(scrambles)))
+
+def bench_scan(args):
+    """
+    Scan scrambled cubes in the simulated robot with a simulated camera, one
+    rotation per side, and compare the time with the firmware's S command.
+    """
+    from simulator import SimulatedRobot, SimulatedCamera, SimulatorServer, PtySimulator
+    from transport import open_transport, RobotLink
+    from multicam import CameraWorker, CameraSpec
+    from scanning import ScanOrchestrator
+    from cube import CENTERS
+
+    rng = np.random.default_rng(args.seed)
+    print('endpoint   protocol   rotations   robot (s)   camera (s)   real robot (s)   firmware S (s)   correct')
+    for endpoint in ('tcp', 'pty'):
+        for protocol in ('ascii', 'binary'):
+            robot = SimulatedRobot(protocol, speed=args.speed)
+            simulator = (SimulatorServer(robot) if endpoint == 'tcp' else PtySimulator(robot)).start()
+            link = RobotLink(open_transport(simulator.url), args.window, protocol=protocol)
+            correct, results = 0, []
+            for _ in range(args.scrambles):
+                robot.facelets = random_scramble(rng)
+                camera = CameraSpec(None, SimulatedCamera(robot, args.fps, int(rng.integers(1 << 31)), args.difficulty), 0)
+                worker = CameraWorker(camera, args.vote_window, args.vote_confidence)
+                worker.start()
+                try:
+                    result = ScanOrchestrator(link, worker).scan()
+                finally:
+                    worker.stop()
+                    worker.join()
+                # Name the robot's facelets after its centers, like the scan.
+                faces = {robot.facelets[center]: face for center, face in zip(CENTERS, 'URFDLB')}
+                correct += result['facelets'] == ''.join(faces[color] for color in robot.facelets)
+                results.append(result)
+            link.close()
+            simulator.close()
+            robot_seconds = np.mean([sum(side['robot_seconds'] for side in result['sides']) for result in results])
+            camera_seconds = np.mean([sum(side['camera_seconds'] for side in result['sides']) for result in results])
+            print('{:>8}   {:>8}   {:>9}   {:>9.3f}   {:>10.3f}   {:>14.2f}   {:>14.2f}   {:>3}/{}'.format(
+                endpoint, protocol, results[0]['rotations'], robot_seconds, camera_seconds,
+                results[0]['predicted'] + camera_seconds, results[0]['firmware_predicted'],
+                correct, args.scrambles))
+
+def stage_summary(seconds):
+    """Summarize a list of stage durations in milliseconds."""
+    ms = np.array(seconds) * 1000
+    if not len(ms):
+        return {'calls': 0}
+    return {
+        'calls': len(ms),
+        'mean_ms': round(float(ms.mean()), 4),
+        'p50_ms': round(float(np.percentile(ms, 50)), 4),
+        'p95_ms': round(float(np.percentile(ms, 95)), 4),
+    }
+
+def git_revision():
+    """Get the current git revision, or None outside of a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare the results with a baseline result file.
+
+    :returns: list of str describing every regression
+    """
+    regressions = []
+    fps, baseline_fps = results['end_to_end']['fps'], baseline['end_to_end']['fps']
+    if fps < baseline_fps * (1 - tolerance):
+        regressions.append('end-to-end fps {:.1f} < baseline {:.1f}'.format(fps, baseline_fps))
+    for name, summary in results['stages'].items():
+        base = baseline['stages'].get(name, {})
+        if 'mean_ms' in summary and 'mean_ms' in base and summary['mean_ms'] > base['mean_ms'] * (1 + tolerance):
+            regressions.append('{} {:.3f} ms > baseline {:.3f} ms'.format(name, summary['mean_ms'], base['mean_ms']))
+    for name, value in results['accuracy'].items():
+        if value < baseline['accuracy'].get(name, 0) - 0.01:
+            regressions.append('{} {:.2%} < baseline {:.2%}'.format(name, value, baseline['accuracy'][name]))
+    return regressions
+
+def bench_suite(args):
+    """
+    Time every stage of the Webcam pipeline and the end-to-end scanning on
+    synthetic frames, measure the accuracy against the ground truth and write
+    the results to a JSON file.
+    """
+    from qbr import Qbr
+    from video import Webcam
+
+    rng = np.random.default_rng(args.seed)
+    samples = [generate_frame(rng, **random_frame_params(rng, args.difficulty)) for _ in range(args.frames)]
+    qbr = Qbr(False, True, False, headless=['synthetic'])
+    webcam = Webcam(qbr, SyntheticCapture(0))
+
+    stages = {name: [] for name in ['preprocess', 'find_contours', 'get_dominant_color', 'get_closest_color', 'draw']}
+    grids = correct = 0
+    for frame, truth in samples:
+        frame = frame.copy()
+        start = time.perf_counter()
+        dilated = preprocess_frame(frame, webcam.scale)
+        stages['preprocess'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        contours = find_contours(dilated, webcam.scale)
+        stages['find_contours'].append(time.perf_counter() - start)
+
+        if len(contours) == 9:
+            grids += 1
+            start = time.perf_counter()
+            dominant_colors = color_detector.get_dominant_colors(sample_stickers(frame, contours, webcam.scale))
+            stages['get_dominant_color'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            indices = color_detector.get_closest_color_indices(dominant_colors)
+            stages['get_closest_color'].append(time.perf_counter() - start)
+            correct += sum(color_detector.palette_names[i] == name for i, name in zip(indices, truth['stickers']))
+
+        start = time.perf_counter()
+        webcam.draw_interface(frame, contours)
+        stages['draw'].append(time.perf_counter() - start)
+
+    # End-to-end: everything the webcam does with a frame, except for
+    # capturing and displaying it.
+    frames = [frame.copy() for frame, _ in samples]
+    start = time.perf_counter()
+    for frame in frames:
+        contours = webcam.detect(frame)
+        webcam.process_frame(frame, contours)
+        webcam.draw_interface(frame, contours)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'params': {
+            'frames': args.frames,
+            'seed': args.seed,
+            'difficulty': args.difficulty,
+            'dominant_color_method': color_detector.dominant_color_method,
+            'palette_lut': color_detector.palette_lut is not None,
+        },
+        'stages': {name: stage_summary(seconds) for name, seconds in stages.items()},
+        'end_to_end': {
+            'fps': round(len(frames) / elapsed, 2),
+            'mean_ms': round(elapsed * 1000 / len(frames), 4),
+        },
+        'accuracy': {
+            'grid_detection_rate': grids / len(samples),
+            'sticker_accuracy': correct / (grids * 9) if grids else 0.0,
+        },
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print('stage               calls   mean (ms)   p50 (ms)   p95 (ms)')
+    for name, summary in results['stages'].items():
+        print('{:<18}  {:>5}  {:>10}  {:>9}  {:>9}'.format(
+            name, summary['calls'], summary.get('mean_ms', '-'), summary.get('p50_ms', '-'), summary.get('p95_ms', '-')))
+    print('end-to-end:          {} fps, {} ms/frame'.format(results['end_to_end']['fps'], results['end_to_end']['mean_ms']))
+    print('grid detection rate: {:.2%}'.format(results['accuracy']['grid_detection_rate']))
+    print('sticker accuracy:    {:.2%}'.format(results['accuracy']['sticker_accuracy']))
+    print('results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Qbr micro-benchmarks.')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--repeat', type=int, default=200, help='timing repetitions')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    colors = subparsers.add_parser('colors', help='scalar vs batch BGR->LAB and CIEDE2000')
+    colors.add_argument('--samples', type=int, default=10000, help='amount of random colors')
+    colors.set_defaults(func=bench_colors)
+
+    lut = subparsers.add_parser('lut', help='palette lookup table vs exact CIEDE2000')
+    lut.add_argument('--samples', type=int, default=100000, help='amount of random colors')
+    lut.add_argument('--noise', type=float, default=40, help='stddev of the colors around the palette')
+    lut.add_argument('--resolutions', type=int, nargs='+', default=[16, 32, 64, 128])
+    lut.set_defaults(func=bench_lut)
+
+    dominant = subparsers.add_parser('dominant', help='dominant color estimators vs kmeans')
+    dominant.add_argument('--samples', type=int, default=2000, help='amount of generated ROIs')
+    dominant.add_argument('--width', type=int, default=17, help='ROI width in pixels')
+    dominant.add_argument('--height', type=int, default=31, help='ROI height in pixels')
+    dominant.add_argument('--noise', type=float, default=25, help='stddev of the pixel noise')
+    dominant.add_argument('--glare', type=float, default=0.1, help='fraction of glare pixels')
+    dominant.set_defaults(func=bench_dominant)
+
+    workers = subparsers.add_parser('workers', help='detection throughput vs amount of worker processes')
+    workers.add_argument('--frames', type=int, default=500, help='amount of frames per run')
+    workers.add_argument('--clutter', type=int, default=20, help='random rectangles per frame')
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    workers.set_defaults(func=bench_workers)
+
+    neighbors = subparsers.add_parser('neighbors', help='find_contours neighbor search vs amount of contours')
+    neighbors.add_argument('--lists', type=int, default=20, help='candidate lists per amount')
+    neighbors.add_argument('--candidates', type=int, nargs='+', default=[9, 25, 50, 100, 200, 400])
+    neighbors.set_defaults(func=bench_neighbors)
+
+    tracking = subparsers.add_parser('tracking', help='grid tracking vs full frame search')
+    tracking.add_argument('--frames', type=int, default=400, help='amount of frames')
+    tracking.add_argument('--clutter', type=int, default=20, help='random rectangles in the background')
+    tracking.set_defaults(func=bench_tracking)
+
+    pyramid = subparsers.add_parser('pyramid', help='full resolution vs pyramid detection')
+    pyramid.add_argument('--frames', type=int, default=50, help='amount of frames')
+    pyramid.add_argument('--scale', type=float, default=2, help='frame size relative to 640x480')
+    pyramid.set_defaults(func=bench_pyramid)
+
+    cache = subparsers.add_parser('cache', help='kociemba vs the solution cache')
+    cache.set_defaults(func=bench_cache)
+
+    state = subparsers.add_parser('state', help='validation of scanned states vs kociemba')
+    state.set_defaults(func=bench_state)
+
+    assign = subparsers.add_parser('assign', help='sticker by sticker vs global color assignment of noisy scans')
+    assign.add_argument('--scrambles', type=int, default=200, help='amount of random scrambles')
+    assign.add_argument('--noise', type=float, nargs='+', default=[10, 20, 30, 40], help='BGR noise levels')
+    assign.add_argument('--lighting', type=float, default=0.2, help='brightness variation in-between the sides')
+    assign.set_defaults(func=bench_assign)
+
+    planner = subparsers.add_parser('planner', help='robot cost of kociemba vs planned solutions')
+    planner.add_argument('--scrambles', type=int, default=20, help='amount of random scrambles')
+    planner.add_argument('--candidates', type=int, nargs='+', default=[1, 4, 12, 24], help='amounts of candidates')
+    planner.set_defaults(func=bench_planner)
+
+    robot = subparsers.add_parser('robot', help='solutions streamed to the simulated robot')
+    robot.add_argument('--scrambles', type=int, default=5, help='amount of random scrambles')
+    robot.add_argument('--speed', type=float, default=1000.0, help='how many times faster than the real robot')
+    robot.add_argument('--window', type=int, default=4, help='moves sent ahead of their acknowledgement')
+    robot.set_defaults(func=bench_robot)
+
+    scan = subparsers.add_parser('scan', help='scanning in the simulated robot vs the firmware\'s S command')
+    scan.add_argument('--scrambles', type=int, default=3, help='amount of random scrambles')
+    scan.add_argument('--speed', type=float, default=1000.0, help='how many times faster than the real robot')
+    scan.add_argument('--window', type=int, default=4, help='moves sent ahead of their acknowledgement')
+    scan.add_argument('--fps', type=float, default=30.0, help='frame rate of the simulated camera')
+    scan.add_argument('--difficulty', type=float, default=0.5, help='pose, lighting and noise variation')
+    scan.add_argument('--vote-window', type=int, default=DEFAULT_PREVIEW_VOTE_WINDOW, help='frames every side is voted over')
+    scan.add_argument('--vote-confidence', type=float, default=DEFAULT_PREVIEW_VOTE_CONFIDENCE, help='confidence every sticker needs')
+    scan.set_defaults(func=bench_scan)
+
+    suite = subparsers.add_parser('suite', help='per-stage and end-to-end timings on synthetic frames')
+    suite.add_argument('--frames', type=int, default=300, help='amount of synthetic frames')
+    suite.add_argument('--difficulty', type=float, default=1.0, help='pose, lighting and noise variation')
+    suite.add_argument('--output', default='bench_results.json', help='JSON file to write the results to')
+    suite.add_argument('--baseline', default=None, help='JSON results to compare with, exits with 1 on regressions')
+    suite.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
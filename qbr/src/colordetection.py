@@ -2,11 +2,108 @@
 # -*- coding: utf-8 -*-
 # vim: fenc=utf-8 ts=4 sw=4 et
 
+import os
+import glob
+import hashlib
 import numpy as np
 import cv2
-from helpers import ciede2000, bgr2lab
+from helpers import ciede2000_matrix, bgr2lab_batch
+from assignment import assign_with_counts
 from config import config
-from constants import CUBE_PALETTE, COLOR_PLACEHOLDER
+from cube import FACES
+from constants import (
+    CUBE_PALETTE,
+    COLOR_PLACEHOLDER,
+    PALETTE_LUT_RESOLUTION,
+    DEFAULT_PALETTE_LUT_RESOLUTION,
+    PALETTE_LUT_BUILD_CHUNK,
+    DOMINANT_COLOR_METHOD,
+    DEFAULT_DOMINANT_COLOR_METHOD,
+    TRIMMED_MEAN_PROPORTION,
+    SUBSAMPLED_MEAN_STEP,
+    HISTOGRAM_MODE_BINS
+)
+
+# The face every color is scanned as: white on top and green in front.
+COLOR_FACES = {
+    'white' : 'U',
+    'red'   : 'R',
+    'green' : 'F',
+    'yellow': 'D',
+    'orange': 'L',
+    'blue'  : 'B',
+}
+
+# The dominant color estimators below all take an array of pixels of shape
+# (..., N, 3) and reduce the N pixels to a single BGR color, so they can be
+# used for one region of interest as well as for a batch of them.
+
+def dominant_color_kmeans(pixels):
+    """Dominant color as the largest k-means cluster (the original method)."""
+    pixels = np.float32(pixels)
+    flat = pixels.reshape(-1, pixels.shape[-2], 3)
+    dominant = np.empty((len(flat), 3), dtype=np.float32)
+    n_colors = 1
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, .1)
+    flags = cv2.KMEANS_RANDOM_CENTERS
+    for index, roi_pixels in enumerate(flat):
+        _, labels, palette = cv2.kmeans(roi_pixels, n_colors, None, criteria, 10, flags)
+        _, counts = np.unique(labels, return_counts=True)
+        dominant[index] = palette[np.argmax(counts)]
+    return dominant.reshape(pixels.shape[:-2] + (3,))
+
+def dominant_color_mean(pixels):
+    """Dominant color as the mean of all pixels."""
+    return np.mean(pixels, axis=-2, dtype=np.float32)
+
+def dominant_color_subsampled_mean(pixels):
+    """Dominant color as the mean of every SUBSAMPLED_MEAN_STEP-th pixel."""
+    return np.mean(pixels[..., ::SUBSAMPLED_MEAN_STEP, :], axis=-2, dtype=np.float32)
+
+def dominant_color_median(pixels):
+    """Dominant color as the per-channel median, which ignores glare."""
+    return np.median(pixels, axis=-2).astype(np.float32)
+
+def dominant_color_trimmed_mean(pixels):
+    """
+    Dominant color as the per-channel mean after dropping the lowest and
+    highest TRIMMED_MEAN_PROPORTION of the values.
+    """
+    n = pixels.shape[-2]
+    cut = int(n * TRIMMED_MEAN_PROPORTION)
+    ordered = np.sort(pixels, axis=-2)
+    return np.mean(ordered[..., cut:max(n - cut, cut + 1), :], axis=-2, dtype=np.float32)
+
+def dominant_color_histogram_mode(pixels):
+    """
+    Dominant color as the mean of the pixels in the most populated cell of a
+    coarse HSV histogram.
+    """
+    pixels = np.asarray(pixels)
+    flat = pixels.reshape(-1, pixels.shape[-2], 3)
+    rows, n, _ = flat.shape
+    hsv = cv2.cvtColor(np.uint8(flat), cv2.COLOR_BGR2HSV).astype(np.intp)
+
+    h_bins, s_bins, v_bins = HISTOGRAM_MODE_BINS
+    cells = ((hsv[..., 0] * h_bins // 180) * s_bins + (hsv[..., 1] * s_bins // 256)) * v_bins + (hsv[..., 2] * v_bins // 256)
+    n_cells = h_bins * s_bins * v_bins
+
+    # One bincount for all rows by giving every row its own range of cells.
+    offsets = np.arange(rows)[:, None] * n_cells
+    histogram = np.bincount((cells + offsets).ravel(), minlength=rows * n_cells).reshape(rows, n_cells)
+    mask = cells == np.argmax(histogram, axis=1)[:, None]
+
+    dominant = (flat * mask[..., None]).sum(axis=1) / mask.sum(axis=1)[:, None]
+    return dominant.astype(np.float32).reshape(pixels.shape[:-2] + (3,))
+
+DOMINANT_COLOR_ESTIMATORS = {
+    'kmeans'          : dominant_color_kmeans,
+    'mean'            : dominant_color_mean,
+    'subsampled_mean' : dominant_color_subsampled_mean,
+    'median'          : dominant_color_median,
+    'trimmed_mean'    : dominant_color_trimmed_mean,
+    'histogram_mode'  : dominant_color_histogram_mode,
+}
 
 class ColorDetection:
 
@@ -28,6 +125,93 @@ class ColorDetection:
         for side, bgr in self.cube_color_palette.items():
             self.cube_color_palette[side] = tuple(bgr)
 
+        # The amount of cells per BGR channel of the palette lookup table, 0
+        # disables the lookup table.
+        self.lut_resolution = config.get_setting(
+            PALETTE_LUT_RESOLUTION,
+            DEFAULT_PALETTE_LUT_RESOLUTION
+        )
+        self.palette_lut = None
+        self.update_palette_arrays()
+
+        self.set_dominant_color_method(config.get_setting(
+            DOMINANT_COLOR_METHOD,
+            DEFAULT_DOMINANT_COLOR_METHOD
+        ))
+
+    def set_dominant_color_method(self, method):
+        """
+        Set the estimator used by get_dominant_color, one of the keys of
+        DOMINANT_COLOR_ESTIMATORS.
+        """
+        if method not in DOMINANT_COLOR_ESTIMATORS:
+            raise ValueError('Unknown dominant color method: {}'.format(method))
+        self.dominant_color_method = method
+        self.dominant_color_estimator = DOMINANT_COLOR_ESTIMATORS[method]
+
+    def update_palette_arrays(self):
+        """
+        Cache the palette as arrays so that batches of colors can be matched
+        against all palette colors at once.
+        """
+        self.palette_names = list(self.cube_color_palette.keys())
+        self.palette_faces = np.array([FACES.index(COLOR_FACES[name]) for name in self.palette_names], dtype=np.uint8)
+        self.palette_bgr = np.array(list(self.cube_color_palette.values()), dtype=np.float64)
+        self.palette_lab = bgr2lab_batch(self.palette_bgr)
+        if self.lut_resolution:
+            self.load_palette_lut()
+
+    def get_palette_lut_path(self, resolution):
+        """
+        Get the path of the lookup table file for the current palette. The file
+        name contains a hash of the palette, so a stale table is never used.
+        """
+        digest = hashlib.sha1(repr(list(self.cube_color_palette.items())).encode('utf-8')).hexdigest()
+        filename = 'palette-lut-{}-{}.npy'.format(resolution, digest[:12])
+        return os.path.join(config.config_dir, filename)
+
+    def build_palette_lut(self, resolution):
+        """
+        Build a lookup table which maps every quantized BGR cell to the index of
+        its closest palette color. The center of every cell is classified with
+        the exact CIEDE2000 path.
+
+        :param resolution int: The amount of cells per BGR channel.
+        :returns: numpy.ndarray of shape (resolution, resolution, resolution)
+        """
+        centers = (np.arange(resolution) + 0.5) * (256 / resolution)
+        b, g, r = np.meshgrid(centers, centers, centers, indexing='ij')
+        cells = np.stack((b.ravel(), g.ravel(), r.ravel()), axis=1)
+
+        lut = np.empty(len(cells), dtype=np.uint8)
+        for start in range(0, len(cells), PALETTE_LUT_BUILD_CHUNK):
+            chunk = cells[start:start + PALETTE_LUT_BUILD_CHUNK]
+            lut[start:start + len(chunk)] = self.get_closest_color_indices(chunk, exact=True)
+        return lut.reshape((resolution,) * 3)
+
+    def load_palette_lut(self):
+        """
+        Memory-map the lookup table of the current palette from the config
+        directory, building and saving it first if it doesn't exist yet.
+        """
+        path = self.get_palette_lut_path(self.lut_resolution)
+        if not os.path.exists(path):
+            lut = self.build_palette_lut(self.lut_resolution)
+
+            # Write to a temporary file first, so a crash never leaves a
+            # truncated table behind.
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, lut)
+            os.replace(tmp_path, path)
+
+            # Remove the tables of previous palettes.
+            for stale_path in glob.glob(os.path.join(config.config_dir, 'palette-lut-*.npy')):
+                if stale_path != path:
+                    os.remove(stale_path)
+
+        self.palette_lut = np.load(path, mmap_mode='r')
+
     def get_prominent_color(self, bgr):
         """Get the prominent color equivalent of the given bgr color."""
         for color_name, color_bgr in self.cube_color_palette.items():
@@ -42,33 +226,59 @@ class ColorDetection:
         :param roi: The image list.
         :returns: tuple
         """
-        average = roi.mean(axis=0).mean(axis=0)
-        pixels = np.float32(roi.reshape(-1, 3))
+        return tuple(self.dominant_color_estimator(roi.reshape(-1, 3)))
 
-        n_colors = 1
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, .1)
-        flags = cv2.KMEANS_RANDOM_CENTERS
-        _, labels, palette = cv2.kmeans(pixels, n_colors, None, criteria, 10, flags)
-        _, counts = np.unique(labels, return_counts=True)
-        dominant = palette[np.argmax(counts)]
-        return tuple(dominant)
+    def get_dominant_colors(self, pixels):
+        """
+        Get the dominant color of a batch of regions of interest at once.
+
+        :param pixels: An array of shape (N, P, 3) with P pixels per region.
+        :returns: numpy.ndarray of shape (N, 3)
+        """
+        return self.dominant_color_estimator(pixels)
+
+    def get_closest_color_indices(self, bgr, exact=False):
+        """
+        Get the index into self.palette_names of the closest palette color for
+        every BGR color in a batch, using CIEDE2000 distance.
+
+        When the palette lookup table is enabled the colors are classified by
+        indexing the table, unless exact is True.
+
+        :param bgr: An array-like of shape (N, 3) with BGR values.
+        :param exact bool: Always compute the CIEDE2000 distances.
+        :returns: numpy.ndarray of shape (N,)
+        """
+        if self.palette_lut is not None and not exact:
+            resolution = self.palette_lut.shape[0]
+            cells = np.asarray(bgr, dtype=np.float64).reshape(-1, 3) * (resolution / 256)
+            cells = np.clip(cells.astype(np.intp), 0, resolution - 1)
+            return self.palette_lut[cells[:, 0], cells[:, 1], cells[:, 2]].astype(np.intp)
+
+        lab = bgr2lab_batch(np.reshape(bgr, (-1, 3)))
+        return np.argmin(ciede2000_matrix(lab, self.palette_lab), axis=1)
 
     def get_closest_color(self, bgr):
         """
         Get the closest color of a BGR color using CIEDE2000 distance.
 
-        :param bgr tuple: The BGR color to use.
-        :returns: dict
+        :param bgr: The BGR color to use, or an array-like of shape (N, 3) to
+                    classify a whole batch at once.
+        :returns: dict, or a list of dicts for a batch
         """
-        lab = bgr2lab(bgr)
-        distances = []
-        for color_name, color_bgr in self.cube_color_palette.items():
-            distances.append({
+        lab = bgr2lab_batch(np.reshape(bgr, (-1, 3)))
+        distances = ciede2000_matrix(lab, self.palette_lab)
+        indices = np.argmin(distances, axis=1)
+        closest = []
+        for row, index in enumerate(indices):
+            color_name = self.palette_names[index]
+            closest.append({
                 'color_name': color_name,
-                'color_bgr': color_bgr,
-                'distance': ciede2000(lab, bgr2lab(color_bgr))
+                'color_bgr': self.cube_color_palette[color_name],
+                'distance': float(distances[row, index])
             })
-        closest = min(distances, key=lambda item: item['distance'])
+        if np.ndim(bgr) == 1:
+            return closest[0]
         return closest
 
     def convert_bgr_to_notation(self, bgr):
@@ -76,19 +286,72 @@ class ColorDetection:
         Convert BGR tuple to rubik's cube notation.
         The BGR color must be normalized first by the get_closest_color method.
 
-        :param bgr tuple: The BGR values to convert.
-        :returns: str
+        :param bgr: The BGR values to convert, or an array-like of shape (N, 3).
+        :returns: str, or a list of str for a batch
         """
-        notations = {
-            'green' : 'F',
-            'white' : 'U',
-            'blue'  : 'B',
-            'red'   : 'R',
-            'orange': 'L',
-            'yellow': 'D'
-        }
-        color_name = self.get_closest_color(bgr)['color_name']
-        return notations[color_name]
+        notation = [FACES[face] for face in self.convert_bgr_to_faces(np.reshape(bgr, (-1, 3)))]
+        if np.ndim(bgr) == 1:
+            return notation[0]
+        return notation
+
+    def convert_bgr_to_faces(self, bgr):
+        """
+        Convert a batch of BGR colors to the index of their face in FACES
+        (URFDLB), e.g. for a cube.FaceletState.
+
+        :param bgr: array-like of shape (N, 3)
+        :returns: uint8 array of shape (N,)
+        """
+        return self.palette_faces[self.get_closest_color_indices(bgr, exact=True)]
+
+    def convert_sides_to_faces(self, sides):
+        """
+        Convert the BGR colors of all 6 sides, keyed by the color of their
+        center like Webcam.result_state, to the faces of the 54 facelets.
+
+        :param sides: dict color name -> 9 BGR colors
+        :returns: uint8 array of shape (54,) in URFDLB order
+        """
+        names = sorted(COLOR_FACES, key=lambda name: FACES.index(COLOR_FACES[name]))
+        return self.convert_bgr_to_faces(np.reshape([sides[name] for name in names], (54, 3)))
+
+    def assign_colors(self, bgr, fixed):
+        """
+        Match a batch of BGR colors against the palette at once, every
+        palette color to the same amount of them, with the lowest sum of
+        CIEDE2000 distances, see assignment.assign_with_counts.
+
+        :param bgr: An array-like of shape (N, 3) with BGR values.
+        :param fixed: The palette index of every color which must keep it, -1
+                      for the others.
+        :returns: (indices into self.palette_names, margins) numpy arrays
+        :raises ValueError: when two fixed colors exceed the counts
+        """
+        lab = bgr2lab_batch(np.reshape(bgr, (-1, 3)))
+        counts = np.full(len(self.palette_names), len(lab) // len(self.palette_names))
+        return assign_with_counts(ciede2000_matrix(lab, self.palette_lab), counts, fixed)
+
+    def assign_sides_to_faces(self, sides):
+        """
+        Classify the measured BGR colors of all 6 sides at once instead of
+        every sticker on its own: every palette color is given to exactly 9
+        facelets, the center of every side keeps the color of its side, and
+        the sum of the CIEDE2000 distances is minimal. A single misread
+        sticker swaps with the one it was confused with instead of leaving
+        the color counts off.
+
+        :param sides: dict color name -> 9 BGR colors, like
+                      Webcam.result_state
+        :returns: (faces, margins), the faces of the 54 facelets in URFDLB
+                  order like convert_sides_to_faces, and how much the sum of
+                  the distances grows when a facelet gets any other color
+                  (inf for the centers)
+        """
+        names = sorted(COLOR_FACES, key=lambda name: FACES.index(COLOR_FACES[name]))
+        fixed = np.full(54, -1)
+        fixed[np.arange(len(names)) * 9 + 4] = [self.palette_names.index(name) for name in names]
+        labels, margins = self.assign_colors([sides[name] for name in names], fixed)
+        return self.palette_faces[labels], margins
 
     def set_cube_color_pallete(self, palette):
         """
@@ -98,5 +361,6 @@ class ColorDetection:
         """
         for side, bgr in palette.items():
             self.cube_color_palette[side] = tuple([int(c) for c in bgr])
+        self.update_palette_arrays()
 
 color_detector = ColorDetection()
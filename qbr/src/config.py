@@ -3,22 +3,72 @@
 # vim: fenc=utf-8 ts=4 sw=4 et
 
 import os
+import copy
 import json
+import atexit
+import tempfile
+import threading
+import numpy as np
+from constants import CONFIG_WRITE_DELAY, CONFIG_SIDECAR_SETTINGS
 
 class Config:
+    """
+    The settings in ~/.config/qbr.
+
+    Settings are changed in memory and written by a background thread once no
+    setting changed for CONFIG_WRITE_DELAY seconds, and when Qbr exits, so
+    set_setting never waits for the disk. Files are replaced atomically by
+    renaming a temporary file, a crash leaves either the old or the new file.
+
+    Color tables (the palette and the saved cube state) are kept in the NumPy
+    sidecar settings.npz as a names array and a uint8 array each, instead of
+    nested JSON lists.
+    """
 
     def __init__(self):
         self.config_dir = os.path.expanduser('~/.config/qbr')
         self.settings_file = os.path.join(self.config_dir, 'settings.json')
+        self.sidecar_file = os.path.join(self.config_dir, 'settings.npz')
 
         try:
             self.settings = json.loads(open(self.settings_file, 'r').read())
         except Exception:
             self.settings = {}
+        # Encoded sidecar settings, key -> (names, values).
+        self.tables = {}
+        self.load_sidecar()
 
         if not os.path.exists(self.config_dir):
             os.mkdir(self.config_dir)
 
+        self.lock = threading.Lock()
+        # Serializes writing the files, held while the disk is busy.
+        self.write_lock = threading.Lock()
+        self.changed = threading.Event()
+        self.dirty = False
+        # Incremented by every change, so a write only marks its own changes saved.
+        self.version = 0
+        self.writer = None
+        self.writes = 0
+
+    def load_sidecar(self):
+        """Load the settings of the sidecar, they take precedence over JSON."""
+        try:
+            with np.load(self.sidecar_file, allow_pickle=False) as data:
+                for key in CONFIG_SIDECAR_SETTINGS:
+                    if key + '.names' in data and key + '.values' in data:
+                        names, values = data[key + '.names'], data[key + '.values']
+                        self.tables[key] = (names, values)
+                        self.settings[key] = decode_table(names, values)
+        except Exception:
+            pass
+        # Settings of older versions are moved to the sidecar on the next write.
+        for key in CONFIG_SIDECAR_SETTINGS:
+            if key in self.settings and key not in self.tables:
+                table = encode_table(self.settings[key])
+                if table is not None:
+                    self.tables[key] = table
+
     def get_setting(self, key, default_value=None):
         """Get a specific key from the settings."""
         if key in self.settings:
@@ -28,10 +78,119 @@ class Config:
         return None
 
     def set_setting(self, key, value):
-        """Set a specific setting and save it."""
-        self.settings[key] = value
-        with open(self.settings_file, 'w') as f:
-            json.dump(self.settings, f)
-            f.close()
+        """
+        Set a specific setting and save it in the background.
+
+        :raises TypeError: when the value can't be saved as JSON
+        """
+        table = encode_table(value) if key in CONFIG_SIDECAR_SETTINGS else None
+        if table is None:
+            # Fail here, not later in the writer.
+            json.dumps(value)
+        with self.lock:
+            if table is not None:
+                self.tables[key] = table
+                self.settings[key] = decode_table(*table)
+            else:
+                self.tables.pop(key, None)
+                self.settings[key] = copy.deepcopy(value)
+            self.dirty = True
+            self.version += 1
+        self.start_writer()
+        self.changed.set()
+
+    def start_writer(self):
+        with self.lock:
+            if self.writer is not None:
+                return
+            self.writer = threading.Thread(target=self.write_loop, daemon=True)
+            self.writer.start()
+            atexit.register(self.flush)
+
+    def write_loop(self):
+        """Write the settings once they didn't change for a while."""
+        while True:
+            self.changed.wait()
+            # Debounce: wait until a whole delay passes without a change.
+            while True:
+                self.changed.clear()
+                if not self.changed.wait(CONFIG_WRITE_DELAY):
+                    break
+            # A failing write must never end the writer.
+            try:
+                self.flush()
+            except Exception as e:
+                print('Cannot save the settings: {}'.format(e))
+
+    def flush(self):
+        """Write the settings now if they changed."""
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                settings = {key: value for key, value in self.settings.items() if key not in self.tables}
+                tables = dict(self.tables)
+                version = self.version
+            try:
+                # Serialize first, so a setting JSON can't encode is reported
+                # before any file is touched.
+                data = json.dumps(settings).encode('utf-8')
+                if tables or os.path.exists(self.sidecar_file):
+                    arrays = {}
+                    for key, (names, values) in tables.items():
+                        arrays[key + '.names'] = names
+                        arrays[key + '.values'] = values
+                    self.replace(self.sidecar_file, lambda f: np.savez(f, **arrays))
+                self.replace(self.settings_file, lambda f: f.write(data))
+            except (OSError, TypeError, ValueError) as e:
+                print('Cannot save the settings: {}'.format(e))
+                return
+            with self.lock:
+                # Settings changed during the write are written next time.
+                if self.version == version:
+                    self.dirty = False
+            self.writes += 1
+
+    def replace(self, path, write):
+        """Atomically replace a file with what write(f) writes to it."""
+        fd, temp_path = tempfile.mkstemp(dir=self.config_dir, prefix='.' + os.path.basename(path))
+        try:
+            # mkstemp creates the file for the owner only, keep the old mode.
+            try:
+                os.chmod(temp_path, os.stat(path).st_mode & 0o777)
+            except OSError:
+                os.chmod(temp_path, 0o644)
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+def encode_table(value):
+    """
+    Encode a dict of colors, e.g. {'red': (0, 0, 255), ...} or a cube state
+    {'red': [(0, 0, 255), ...], ...}, as a names array and a values array.
+
+    :returns: (names, values) numpy arrays, or None if value isn't a dict of
+              equally shaped numbers.
+    """
+    if not isinstance(value, dict) or not value:
+        return None
+    try:
+        values = np.array(list(value.values()))
+    except ValueError:
+        return None
+    if values.dtype.kind not in 'iuf':
+        return None
+    if values.dtype.kind != 'f' and values.min() >= 0 and values.max() <= 255:
+        values = values.astype(np.uint8)
+    return np.array([str(name) for name in value.keys()]), values
+
+def decode_table(names, values):
+    """Decode the arrays of encode_table like JSON would, with lists."""
+    return dict(zip(names.tolist(), values.tolist()))
 
 config = Config()
@@ -30,15 +30,107 @@ STICKER_AREA_TILE_GAP = 4
 STICKER_AREA_OFFSET = 20
 
 STICKER_CONTOUR_COLOR = (36, 255, 12)
+STICKER_SAMPLE_SIZE = 16
+
+# Detection scale, all sticker sizes and margins are in pixels of a frame with
+# this width.
+DETECTION_REFERENCE_WIDTH = 640
+DEFAULT_CAPTURE_RESOLUTION = (640, 480)
+
+# Grid tracking
+TRACKING_PADDING = 0.5 # relative to the grid size
+TRACKING_MAX_MISSES = 3
+TRACKING_REFRESH_INTERVAL = 30 # frames
+
 CALIBRATE_MODE_KEY = 'c'
 SWITCH_LANGUAGE_KEY = 'l'
 SOLVE_CUBE_KEY = 's'
 RESET_CUBE_KEY = 'r'
+PROFILER_OVERLAY_KEY = 'p'
 TEXT_SIZE = 18
 
+# Stage profiler
+PROFILER_WINDOW = 300 # latencies kept per stage
+PROFILER_DUMP_INTERVAL = 5.0 # seconds
+PROFILER_OVERLAY_REFRESH = 0.25 # seconds
+PROFILER_HISTOGRAM_BINS = 20
+
 # Config
 CUBE_PALETTE = 'cube_palette'
 CUBE_SAVED_STATE = 'cube_saved_state'
+PALETTE_LUT_RESOLUTION = 'palette_lut_resolution'
+DOMINANT_COLOR_METHOD = 'dominant_color_method'
+CAPTURE_RESOLUTION = 'capture_resolution'
+SOLUTION_CACHE_SIZE = 'solution_cache_size'
+SOLUTION_CACHE_DISK_SIZE = 'solution_cache_disk_size'
+SOLVE_TIMEOUT = 'solve_timeout'
+REMOTE_URL = 'remote_url'
+ROBOT_WINDOW = 'robot_window'
+ROBOT_PROTOCOL = 'robot_protocol'
+ROBOT_MOVE_COSTS = 'robot_move_costs'
+PLANNER_CANDIDATES = 'planner_candidates'
+PREVIEW_VOTE_WINDOW = 'preview_vote_window'
+PREVIEW_VOTE_CONFIDENCE = 'preview_vote_confidence'
+
+# Preview voting
+DEFAULT_PREVIEW_VOTE_WINDOW = 8 # frames
+DEFAULT_PREVIEW_VOTE_CONFIDENCE = 0.75 # share of the window, 6 of 8 frames
+
+# Settings
+CONFIG_WRITE_DELAY = 0.5 # seconds without a change before the settings are written
+CONFIG_SIDECAR_SETTINGS = (CUBE_PALETTE, CUBE_SAVED_STATE) # kept in settings.npz
+
+# Palette lookup table
+DEFAULT_PALETTE_LUT_RESOLUTION = 64
+PALETTE_LUT_BUILD_CHUNK = 32768
+
+# Dominant color estimation
+DEFAULT_DOMINANT_COLOR_METHOD = 'kmeans'
+TRIMMED_MEAN_PROPORTION = 0.2
+SUBSAMPLED_MEAN_STEP = 4
+HISTOGRAM_MODE_BINS = (12, 4, 4) # H, S, V
+
+# Solution cache
+SOLUTION_CACHE_FILENAME = 'solutions.sqlite3'
+DEFAULT_SOLUTION_CACHE_SIZE = 1024 # solutions kept in memory
+DEFAULT_SOLUTION_CACHE_DISK_SIZE = 100000 # solutions kept on disk
+
+# Solving
+DEFAULT_SOLVE_TIMEOUT = 10.0 # seconds
+
+# Robot transport, e.g. tcp://192.168.4.1:50001 or bluetooth://00:1f:e1:dd:08:3d:3
+DEFAULT_REMOTE_URL = 'serial:///dev/ttyUSB0?baudrate=115200'
+DEFAULT_ROBOT_WINDOW = 4 # moves sent but not acknowledged yet
+ROBOT_ACK_TIMEOUT = 120.0 # seconds, a U move alone takes about half a minute
+ROBOT_CONNECT_TIMEOUT = 5.0 # seconds
+ROBOT_SERIAL_POLL = 0.05 # seconds a serial read blocks at most, set once when the port is opened
+ROBOT_RECONNECT_ATTEMPTS = 3
+ROBOT_RECONNECT_DELAY = 0.5 # seconds, doubled after every attempt
+DEFAULT_ROBOT_PROTOCOL = 'ascii' # or 'binary', see EspQbr/PROTOCOL.md
+ROBOT_SYNC_TIMEOUT = 2.0 # seconds to wait for the acknowledgement of a SYNC frame
+
+# EspQbr firmware timing
+ESPQBR_SWEEP_DELAY = 0.005 # seconds per degree, SWEEP_DELAY
+ESPQBR_SETTLE_DELAY = 1.0 # seconds after every turn() and grip, delay(1000)
+ESPQBR_TURN_STEPS = 91 # degrees from MID to LEFT or RIGHT, inclusive
+ESPQBR_GRIP_STEPS = 61 # degrees from GRIP_MIN to GRIP_MAX, inclusive
+ESPQBR_SCAN_DELAY = 5.0 # seconds, SCAN_DELAY
+# Amount of rotateCube() calls around a turn of every face.
+ESPQBR_REGRIPS = {'U': 4, 'R': 2, 'F': 4, 'D': 0, 'L': 2, 'B': 0}
+ESPQBR_SCAN_ROTATIONS = 16 # rotateCube() calls of scan()
+ESPQBR_SCAN_PAUSES = 6 # delay(SCAN_DELAY) calls of scan()
+ESPQBR_MAX_COMMANDS = 30 # String cmds[30], longer lines overflow it
+# Single rotateCube() calls: X about the vertical axis, Z about the camera's.
+ESPQBR_CUBE_ROTATIONS = 'XZ'
+
+# Scan orchestration
+SCAN_SIDE_TIMEOUT = 10.0 # seconds to wait for a stable side after a rotation
+SCAN_SETTLE_FRAMES = 2 # frames ignored after a rotation, the camera may have buffered them
+DEFAULT_CAMERA_SCAN_TIMEOUT = 60.0 # seconds --camera waits for all sides to be stable
+
+# Solution planner
+DEFAULT_PLANNER_CANDIDATES = 24 # whole-cube rotations, 0 disables the planner
+DEFAULT_PLANNER_MAX_DEPTHS = (24,)
 
 # Application errors
 E_INCORRECTLY_SCANNED = 1
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+A geometric model of the cube's 54 facelets, to turn faces and rotate the
+whole cube on facelet strings in kociemba's URFDLB order.
+
+Coordinates: x points to the right (R), y up (U) and z to the front (F).
+Every facelet is identified by the position of its cubie, a vector in
+{-1, 0, 1}^3, and the normal of the face it's on.
+"""
+
+import itertools
+import numpy as np
+
+FACES = 'URFDLB'
+SOLVED_STATE = ''.join(face * 9 for face in FACES)
+
+FACE_NORMALS = {
+    'U': (0, 1, 0),
+    'R': (1, 0, 0),
+    'F': (0, 0, 1),
+    'D': (0, -1, 0),
+    'L': (-1, 0, 0),
+    'B': (0, 0, -1),
+}
+
+# For every face the direction of its rows (top to bottom) and columns (left
+# to right) as seen in the facelet string, i.e. looking at the face from the
+# outside with U up (for U itself B up and for D F up).
+FACE_AXES = {
+    'U': ((0, 0, 1), (1, 0, 0)),
+    'R': ((0, -1, 0), (0, 0, -1)),
+    'F': ((0, -1, 0), (1, 0, 0)),
+    'D': ((0, 0, -1), (1, 0, 0)),
+    'L': ((0, -1, 0), (0, 0, 1)),
+    'B': ((0, -1, 0), (-1, 0, 0)),
+}
+
+def facelet_geometry():
+    """
+    Get the cubie position and the normal of every facelet.
+
+    :returns: (positions, normals), both int arrays of shape (54, 3)
+    """
+    positions = []
+    normals = []
+    for face in FACES:
+        normal = np.array(FACE_NORMALS[face])
+        down, right = (np.array(axis) for axis in FACE_AXES[face])
+        for row in range(3):
+            for col in range(3):
+                positions.append(normal + (row - 1) * down + (col - 1) * right)
+                normals.append(normal)
+    return np.array(positions), np.array(normals)
+
+POSITIONS, NORMALS = facelet_geometry()
+
+def facelet_index(position, normal):
+    """Get the index of the facelet at the given cubie position and normal."""
+    matches = np.flatnonzero((POSITIONS == position).all(axis=1) & (NORMALS == normal).all(axis=1))
+    return int(matches[0])
+
+def face_of(normal):
+    """Get the face letter of a normal vector."""
+    for face, face_normal in FACE_NORMALS.items():
+        if tuple(int(v) for v in normal) == face_normal:
+            return face
+    raise ValueError('not a face normal: {}'.format(normal))
+
+def rotation_permutation(matrix, mask=None):
+    """
+    Get the facelet permutation of a rotation: the facelet at index i ends up
+    at index permutation[i]. Only the facelets in mask are rotated.
+    """
+    permutation = np.arange(54)
+    for index in range(54) if mask is None else np.flatnonzero(mask):
+        permutation[index] = facelet_index(matrix @ POSITIONS[index], matrix @ NORMALS[index])
+    return permutation
+
+def quarter_turn_matrix(axis):
+    """The rotation matrix of a clockwise quarter turn seen from the end of axis."""
+    axis = np.array(axis)
+    # Rodrigues' formula with an angle of -90 degrees.
+    cross = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    return np.outer(axis, axis) - cross
+
+def move_permutations():
+    """
+    Get the facelet permutation of every face turn, e.g. 'U', "U'" and 'U2'.
+
+    :returns: dict move -> int array (54,)
+    """
+    moves = {}
+    for face in FACES:
+        normal = np.array(FACE_NORMALS[face])
+        matrix = quarter_turn_matrix(normal)
+        quarter = rotation_permutation(matrix, POSITIONS @ normal == 1)
+        moves[face] = quarter
+        moves[face + '2'] = quarter[quarter]
+        moves[face + "'"] = quarter[quarter][quarter]
+    return moves
+
+MOVES = move_permutations()
+
+def cube_rotations():
+    """
+    Get the matrices of all 24 rotations of the whole cube, starting with the
+    identity.
+
+    :returns: list of int arrays (3, 3)
+    """
+    rotations = []
+    for order in itertools.permutations(range(3)):
+        for signs in itertools.product((1, -1), repeat=3):
+            matrix = np.zeros((3, 3), dtype=int)
+            for row, (column, sign) in enumerate(zip(order, signs)):
+                matrix[row, column] = sign
+            if round(np.linalg.det(matrix)) == 1:
+                rotations.append(matrix)
+    return rotations
+
+ROTATIONS = cube_rotations()
+
+def robot_rotations():
+    """
+    Get the facelet permutation of EspQbr's whole-cube rotations, rotateCube()
+    with LEFT for X and Z and with RIGHT for X' and Z'. X turns the cube
+    about the vertical axis, clockwise seen from the top, and Z about the axis
+    of the camera, which looks at F, clockwise seen from the camera.
+
+    :returns: dict command -> int array (54,), e.g. 'X', "X'" and 'X2'
+    """
+    rotations = {}
+    for command, face in (('X', 'U'), ('Z', 'F')):
+        quarter = rotation_permutation(quarter_turn_matrix(FACE_NORMALS[face]))
+        rotations[command] = quarter
+        rotations[command + '2'] = quarter[quarter]
+        rotations[command + "'"] = quarter[quarter][quarter]
+    return rotations
+
+ROBOT_ROTATIONS = robot_rotations()
+
+def apply_permutation(facelets, permutation):
+    """Move the facelet at index i to index permutation[i]."""
+    result = [''] * 54
+    for index, target in enumerate(permutation):
+        result[target] = facelets[index]
+    return ''.join(result)
+
+def apply_moves(facelets, moves):
+    """
+    Turn the faces of a facelet string.
+
+    :param moves: A list of moves or a string like "R U2 F'".
+    :returns: str The facelet string after the moves.
+    """
+    if isinstance(moves, str):
+        moves = moves.split()
+    for move in moves:
+        facelets = apply_permutation(facelets, MOVES[move])
+    return facelets
+
+def rotate_cube(facelets, matrix):
+    """
+    Rotate the whole cube and relabel the facelets, so that every face is
+    named after its new center again like kociemba expects.
+
+    :returns: (facelets, face_map) where face_map maps every old face letter
+              to the new face letter of the same side
+    """
+    rotated = apply_permutation(facelets, rotation_permutation(matrix))
+    face_map = {face: face_of(matrix @ np.array(normal)) for face, normal in FACE_NORMALS.items()}
+    return ''.join(face_map[letter] for letter in rotated), face_map
+
+def unrotate_moves(moves, face_map):
+    """
+    Map moves on the rotated cube of rotate_cube back to the sides of the
+    original cube.
+    """
+    inverse = {new: old for old, new in face_map.items()}
+    return [inverse[move[0]] + move[1:] for move in moves]
+
+CENTERS = np.array([facelet_index(FACE_NORMALS[face], FACE_NORMALS[face]) for face in FACES])
+
+def cubie_facelets():
+    """
+    Get the facelets of every corner and edge slot in kociemba's reference
+    order: corners start with their U or D facelet followed by the others
+    clockwise, edges start with their U or D facelet, or their F or B facelet
+    in the middle layer.
+
+    :returns: (corners, edges), int arrays of shape (8, 3) and (12, 2)
+    """
+    corners = []
+    edges = []
+    for position in {tuple(position) for position in POSITIONS}:
+        indices = [int(index) for index in np.flatnonzero((POSITIONS == position).all(axis=1))]
+        # Reference facelet first: U/D (y axis), else F/B (z axis).
+        indices.sort(key=lambda index: -abs(NORMALS[index][1]) * 2 - abs(NORMALS[index][2]))
+        if len(indices) == 3:
+            # Clockwise seen from outside: the triple product of the normals is -1.
+            if np.linalg.det(NORMALS[indices]) > 0:
+                indices[1], indices[2] = indices[2], indices[1]
+            corners.append(indices)
+        elif len(indices) == 2:
+            edges.append(indices)
+    return np.array(sorted(corners)), np.array(sorted(edges))
+
+CORNER_FACELETS, EDGE_FACELETS = cubie_facelets()
+
+def cubie_masks(faces, cubies):
+    """
+    Identify the cubies by the bit mask of their faces, e.g. 1 << U | 1 << R
+    | 1 << F. The bits are summed: with a repeated face the sum has fewer bits
+    than the cubie has faces, so it can't be mistaken for a real cubie.
+    """
+    return (LOW_BITS[faces[cubies]]).sum(axis=1)
+
+LOW_BITS = 1 << np.arange(6)
+SOLVED_FACES = np.repeat(np.arange(6, dtype=np.uint8), 9)
+SOLVED_CORNER_MASKS = cubie_masks(SOLVED_FACES, CORNER_FACELETS)
+SOLVED_EDGE_MASKS = cubie_masks(SOLVED_FACES, EDGE_FACELETS)
+
+def center_layouts():
+    """
+    Get the colors of the 6 centers in every orientation of a cube: the
+    opposite sides are U/D, R/L and F/B, and the sides have the same
+    handedness as the solved cube.
+
+    :returns: set of tuples with the colors of CENTERS
+    """
+    return {tuple(SOLVED_FACES[np.argsort(rotation_permutation(matrix))][CENTERS].tolist()) for matrix in ROTATIONS}
+
+CENTER_LAYOUTS = center_layouts()
+
+# Face mask -> index of the corner or edge cubie with these faces, or -1.
+CORNER_LOOKUP = np.full(128, -1)
+CORNER_LOOKUP[SOLVED_CORNER_MASKS] = np.arange(len(SOLVED_CORNER_MASKS))
+EDGE_LOOKUP = np.full(128, -1)
+EDGE_LOOKUP[SOLVED_EDGE_MASKS] = np.arange(len(SOLVED_EDGE_MASKS))
+
+# The faces of every corner cubie clockwise, starting with its U or D face.
+SOLVED_CORNER_FACES = SOLVED_FACES[CORNER_FACELETS]
+
+# Pairs (i, j) with i < j, to count the inversions of a permutation.
+CORNER_PAIRS = np.triu_indices(len(CORNER_FACELETS), 1)
+EDGE_PAIRS = np.triu_indices(len(EDGE_FACELETS), 1)
+
+U, D, F, B = (FACES.index(face) for face in 'UDFB')
+
+# Facelet letter <-> face index.
+FACE_LETTERS = np.frombuffer(FACES.encode('ascii'), dtype=np.uint8)
+FACE_CODES = np.full(256, 255, dtype=np.uint8)
+FACE_CODES[FACE_LETTERS] = np.arange(6)
+
+class InvalidCubeState(ValueError):
+    """
+    A scanned state that no cube can be in. The reason is one of 'colors',
+    'centers', 'cubies', 'twist', 'flip' or 'parity'.
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+class FaceletState:
+    """
+    The colors of the 54 facelets in URFDLB order as a uint8 array, every
+    color the index of a face in FACES.
+    """
+
+    def __init__(self, colors):
+        """
+        :param colors: 54 ints between 0 and 5.
+        """
+        self.colors = np.asarray(colors, dtype=np.uint8).reshape(54)
+
+    @classmethod
+    def from_facelets(cls, facelets):
+        """Create the state of a facelet string like 'UUUUUUUUURRR...'."""
+        codes = np.frombuffer(facelets.encode('ascii'), dtype=np.uint8)
+        if len(codes) != 54:
+            raise InvalidCubeState('colors', 'expected 54 facelets, got {}'.format(len(codes)))
+        colors = FACE_CODES[codes]
+        if (colors == 255).any():
+            raise InvalidCubeState('colors', 'facelets must be one of {}'.format(FACES))
+        return cls(colors)
+
+    @property
+    def solved(self):
+        """Whether every face has a single color."""
+        return bool((self.colors.reshape(6, 9) == self.colors[CENTERS, None]).all())
+
+    def faces(self):
+        """Map every color to the face whose center has it."""
+        face_of_color = np.zeros(6, dtype=np.uint8)
+        face_of_color[self.colors[CENTERS]] = np.arange(6)
+        return face_of_color[self.colors]
+
+    def validate(self):
+        """
+        Check that a cube can be in this state: every color 9 times, 6
+        different centers arranged like on a cube, every corner and edge cubie
+        exactly once with its colors in the right order, no twisted corner, no
+        flipped edge and no odd permutation.
+
+        :raises InvalidCubeState: at the first violation
+        """
+        counts = np.bincount(self.colors, minlength=6)
+        if len(counts) != 6 or (counts != 9).any():
+            raise InvalidCubeState('colors', 'every color must appear 9 times, got {}'.format(counts.tolist()))
+        if np.bincount(self.colors[CENTERS], minlength=6).max() != 1:
+            raise InvalidCubeState('centers', 'the 6 centers must have different colors')
+        if tuple(self.colors[CENTERS].tolist()) not in CENTER_LAYOUTS:
+            raise InvalidCubeState('centers', 'the centers are not arranged like on a cube')
+
+        faces = self.faces()
+        corners = CORNER_LOOKUP[cubie_masks(faces, CORNER_FACELETS)]
+        edges = EDGE_LOOKUP[cubie_masks(faces, EDGE_FACELETS)]
+        # Masks with opposite or repeated faces don't match any cubie.
+        if (corners < 0).any() or (edges < 0).any() or \
+                np.bincount(corners).max() > 1 or np.bincount(edges).max() > 1:
+            raise InvalidCubeState('cubies', 'some corners or edges do not exist or appear twice')
+
+        # The twist of a corner is the position of its U or D facelet. Read
+        # clockwise from there, its faces must be those of the solved corner,
+        # a mirrored corner has the same faces counterclockwise.
+        up_down = (faces == U) | (faces == D)
+        twists = np.argmax(up_down[CORNER_FACELETS], axis=1)
+        clockwise = CORNER_FACELETS[np.arange(len(corners))[:, None], (twists[:, None] + np.arange(3)) % 3]
+        if (faces[clockwise] != SOLVED_CORNER_FACES[corners]).any():
+            raise InvalidCubeState('cubies', 'a corner has its colors in mirrored order')
+        if twists.sum() % 3:
+            raise InvalidCubeState('twist', 'a corner is twisted')
+
+        # An edge is flipped when its reference facelet doesn't have its U or
+        # D color, or for an edge without one, its F or B color.
+        edge_up_down = up_down[EDGE_FACELETS]
+        reference = faces[EDGE_FACELETS[:, 0]]
+        good = np.where(edge_up_down.any(axis=1), edge_up_down[:, 0], (reference == F) | (reference == B))
+        if np.count_nonzero(~good) % 2:
+            raise InvalidCubeState('flip', 'an edge is flipped')
+
+        corner_parity = (corners[CORNER_PAIRS[0]] > corners[CORNER_PAIRS[1]]).sum() % 2
+        edge_parity = (edges[EDGE_PAIRS[0]] > edges[EDGE_PAIRS[1]]).sum() % 2
+        if corner_parity != edge_parity:
+            raise InvalidCubeState('parity', 'two corners or two edges are swapped')
+
+    def to_facelets(self):
+        """Get the facelet string kociemba expects, named after the centers."""
+        return FACE_LETTERS[self.faces()].tobytes().decode('ascii')
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+The detection stages of the webcam pipeline as plain functions, so they can
+also run outside of the Webcam class, e.g. in worker processes.
+"""
+
+import time
+import cv2
+import numpy as np
+from profiler import profiler
+from constants import (
+    STICKER_SAMPLE_SIZE,
+    DETECTION_REFERENCE_WIDTH,
+    TRACKING_PADDING,
+    TRACKING_MAX_MISSES,
+    TRACKING_REFRESH_INTERVAL
+)
+
+def detection_scale(width):
+    """
+    Get the detection scale of a frame with the given width. Sticker sizes and
+    margins are multiplied by the scale.
+    """
+    return width / DETECTION_REFERENCE_WIDTH
+
+def preprocess_frame(frame, scale=1.0):
+    """Turn a frame into a dilated edge map for find_contours."""
+    with profiler.stage('cvtColor'):
+        grayFrame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    with profiler.stage('blur'):
+        blurredFrame = cv2.blur(grayFrame, (3, 3))
+    with profiler.stage('Canny'):
+        cannyFrame = cv2.Canny(blurredFrame, 30, 60, 3)
+    with profiler.stage('dilate'):
+        size = max(3, int(round(9 * scale)))
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
+        return cv2.dilate(cannyFrame, kernel)
+
+def find_contours(dilatedFrame, scale=1.0):
+    """Find the contours of a 3x3x3 cube."""
+    with profiler.stage('find_contours'):
+        contours, hierarchy = cv2.findContours(dilatedFrame, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        return find_grid(filter_square_contours(contours, scale))
+
+def detect_grid(frame, scale=1.0):
+    """Find the contours of the 9 stickers in a frame, or []."""
+    return find_contours(preprocess_frame(frame, scale), scale)
+
+def detect_grid_pyramid(frame, scale=1.0, working_width=DETECTION_REFERENCE_WIDTH):
+    """
+    Find the contours of the 9 stickers coarse-to-fine: find the grid on a
+    copy of the frame downscaled to working_width, then refine the 9 sticker
+    contours in small regions of the full resolution frame.
+
+    :param scale: The detection scale of the full resolution frame.
+    :returns: The 9 contours in full resolution coordinates, or []
+    """
+    height, width = frame.shape[:2]
+    factor = width / working_width
+    if factor <= 1:
+        return detect_grid(frame, scale)
+
+    with profiler.stage('resize'):
+        small = cv2.resize(frame, (working_width, int(round(height / factor))), interpolation=cv2.INTER_AREA)
+    contours = detect_grid(small, scale / factor)
+    if not contours:
+        return []
+
+    contours = [
+        (int(round(x * factor)), int(round(y * factor)), int(round(w * factor)), int(round(h * factor)))
+        for (x, y, w, h) in contours
+    ]
+    return refine_contours(frame, contours, scale)
+
+def refine_contours(frame, contours, scale=1.0):
+    """
+    Replace every (upscaled) contour by the square-ish contour found closest
+    to its center in a padded region around it, at full resolution. Contours
+    without a match are kept as they are.
+    """
+    height, width = frame.shape[:2]
+    refined = []
+    for (x, y, w, h) in contours:
+        x1, y1 = max(x - w // 2, 0), max(y - h // 2, 0)
+        x2, y2 = min(x + w + w // 2, width), min(y + h + h // 2, height)
+        edges = preprocess_frame(frame[y1:y2, x1:x2], scale)
+        candidates, _ = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+        center_x, center_y = x + w / 2, y + h / 2
+        best, best_distance = (x, y, w, h), w / 4
+        for (cx, cy, cw, ch) in filter_square_contours(candidates, scale):
+            distance = np.hypot(x1 + cx + cw / 2 - center_x, y1 + cy + ch / 2 - center_y)
+            if distance < best_distance:
+                best, best_distance = (x1 + cx, y1 + cy, cw, ch), distance
+        refined.append(best)
+    return refined
+
+def filter_square_contours(contours, scale=1.0):
+    """
+    Filter all contours to only those that are square-ish shapes.
+
+    :param scale: The detection scale, see detection_scale().
+    :returns: list of (x, y, w, h) bounding rectangles
+    """
+    final_contours = []
+    for contour in contours:
+        perimeter = cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, 0.1 * perimeter, True)
+        if len (approx) == 4:
+            area = cv2.contourArea(contour)
+            (x, y, w, h) = cv2.boundingRect(approx)
+
+            # Find aspect ratio of boundary rectangle around the countours.
+            ratio = w / float(h)
+
+            # Check if contour is close to a square.
+            if ratio >= 0.8 and ratio <= 1.2 and w >= 30 * scale and w <= 60 * scale and area / (w * h) > 0.4:
+                final_contours.append((x, y, w, h))
+    return final_contours
+
+def find_grid(final_contours):
+    """
+    Find the 9 sticker contours of a 3x3x3 cube among the square-ish contours.
+
+    :param final_contours: list of (x, y, w, h) bounding rectangles.
+    :returns: The 9 contours sorted from the top-left to the bottom-right, or []
+    """
+    # Return early if we didn't found 9 or more contours.
+    if len(final_contours) < 9:
+        return []
+
+    # Put all contours in a spatial hash, bucketed on the cell of their
+    # top-left corner. A contour (x2, y2, w2, h2) can only contain a point
+    # (x3, y3) when x3 - w2 < x2 < x3 and y3 - h2 < y2 < y3, so with cells as
+    # large as the largest contour only a 2x2 block of cells has to be checked
+    # for every lookup, no matter how many contours there are.
+    cell_w = max(max(w for (_, _, w, _) in final_contours), 1)
+    cell_h = max(max(h for (_, _, _, h) in final_contours), 1)
+    buckets = {}
+    for index, (x, y, w, h) in enumerate(final_contours):
+        buckets.setdefault((x // cell_w, y // cell_h), []).append(index)
+
+    # Find the contour that has 9 neighbors (including itself) and return all
+    # of those neighbors.
+    for contour in final_contours:
+        (x, y, w, h) = contour
+        center_x = x + w / 2
+        center_y = y + h / 2
+        radius = 1.5
+
+        # Create 9 positions for the current contour which are the
+        # neighbors. We'll use this to check how many neighbors each contour
+        # has. The only way all of these can match is if the current contour
+        # is the center of the cube. If we found the center, we also know
+        # all the neighbors, thus knowing all the contours and thus knowing
+        # this shape can be considered a 3x3x3 cube.
+        neighbor_positions = [
+            [(center_x + w * dx * radius), (center_y + h * dy * radius)]
+            for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+        ]
+
+        # Collect (neighbor index, position index) for every position that is
+        # inside a neighbor. The neighbor positions are located in the center
+        # of each contour instead of the top-left corner.
+        matches = []
+        for position_index, (x3, y3) in enumerate(neighbor_positions):
+            for cell_x in range(int((x3 - cell_w) // cell_w), int(x3 // cell_w) + 1):
+                for cell_y in range(int((y3 - cell_h) // cell_h), int(y3 // cell_h) + 1):
+                    for neighbor_index in buckets.get((cell_x, cell_y), ()):
+                        (x2, y2, w2, h2) = final_contours[neighbor_index]
+                        # logic: (top left < center pos) and (bottom right > center pos)
+                        if (x2 < x3 and y2 < y3) and (x2 + w2 > x3 and y2 + h2 > y3):
+                            matches.append((neighbor_index, position_index))
+
+            # More than 9 matches can't become a cube anymore.
+            if len(matches) > 9:
+                break
+
+        # The center piece has 9 neighbors, including itself. These are all the
+        # contours we're looking for. The neighbors are put in the order of the
+        # contour list to get the exact same result as checking every contour
+        # against every other contour.
+        if len(matches) == 9:
+            neighbors = [final_contours[neighbor_index] for neighbor_index, _ in sorted(matches)]
+            return sort_grid(neighbors)
+
+    return []
+
+def sort_grid(contours):
+    """Sort 9 contours on their X and Y values from the top-left to the bottom-right."""
+    # Sort contours on the y-value first.
+    y_sorted = sorted(contours, key=lambda item: item[1])
+
+    # Split into 3 rows and sort each row on the x-value.
+    top_row = sorted(y_sorted[0:3], key=lambda item: item[0])
+    middle_row = sorted(y_sorted[3:6], key=lambda item: item[0])
+    bottom_row = sorted(y_sorted[6:9], key=lambda item: item[0])
+
+    sorted_contours = top_row + middle_row + bottom_row
+    return sorted_contours
+
+def sample_stickers(frame, contours, scale=1.0):
+    """
+    Gather the pixels of all 9 sticker regions in one vectorized operation.
+
+    Every region (the contour minus a margin, like the ROI used for
+    calibrating) is resampled to STICKER_SAMPLE_SIZE x STICKER_SAMPLE_SIZE
+    pixels through a precomputed index grid, so all of them fit in a single
+    array.
+
+    :returns: numpy.ndarray of shape (9, STICKER_SAMPLE_SIZE ** 2, 3)
+    """
+    rects = np.array(contours)
+    margin_x, margin_y = int(14 * scale), int(7 * scale)
+    x1 = rects[:, 0] + margin_x
+    x2 = rects[:, 0] + rects[:, 2] - margin_x
+    y1 = rects[:, 1] + margin_y
+    y2 = rects[:, 1] + rects[:, 3] - margin_y
+
+    steps = (np.arange(STICKER_SAMPLE_SIZE) + 0.5) / STICKER_SAMPLE_SIZE
+    xs = (x1[:, None] + steps * (x2 - x1)[:, None]).astype(np.intp)
+    ys = (y1[:, None] + steps * (y2 - y1)[:, None]).astype(np.intp)
+    xs = np.clip(xs, 0, frame.shape[1] - 1)
+    ys = np.clip(ys, 0, frame.shape[0] - 1)
+
+    samples = frame[ys[:, :, None], xs[:, None, :]]
+    return samples.reshape(len(rects), -1, 3)
+
+class GridTracker:
+    """
+    Find the 3x3 grid by only searching a padded region around the grid found
+    in a previous frame. The full frame is searched again after max_misses
+    consecutive frames without a grid in the region, every refresh_interval
+    frames and as long as no grid has been found.
+    """
+
+    def __init__(self, scale=1.0, full_search=None, padding=TRACKING_PADDING,
+                 max_misses=TRACKING_MAX_MISSES, refresh_interval=TRACKING_REFRESH_INTERVAL):
+        """
+        :param scale: The detection scale of the frames.
+        :param full_search: The function used to search the full frame,
+                            detect_grid by default.
+        """
+        self.scale = scale
+        self.full_search = full_search or (lambda frame: detect_grid(frame, scale))
+        self.padding = padding
+        self.max_misses = max_misses
+        self.refresh_interval = refresh_interval
+        self.bbox = None
+        self.misses = 0
+        self.frames_since_full_search = 0
+
+        self.tracked_frames = 0
+        self.tracked_time = 0.0
+        self.full_frames = 0
+        self.full_time = 0.0
+
+    def search_region(self, frame):
+        """Get the padded region (x1, y1, x2, y2) around the last grid."""
+        x1, y1, x2, y2 = self.bbox
+        pad_x = int((x2 - x1) * self.padding)
+        pad_y = int((y2 - y1) * self.padding)
+        height, width = frame.shape[:2]
+        return (max(x1 - pad_x, 0), max(y1 - pad_y, 0), min(x2 + pad_x, width), min(y2 + pad_y, height))
+
+    def detect(self, frame):
+        """Find the contours of the 9 stickers in a frame, or []."""
+        start = time.perf_counter()
+        track = (
+            self.bbox is not None and
+            self.misses < self.max_misses and
+            self.frames_since_full_search < self.refresh_interval
+        )
+
+        if track:
+            x1, y1, x2, y2 = self.search_region(frame)
+            contours = detect_grid(frame[y1:y2, x1:x2], self.scale)
+            contours = [(x + x1, y + y1, w, h) for (x, y, w, h) in contours]
+            self.frames_since_full_search += 1
+        else:
+            contours = self.full_search(frame)
+            self.frames_since_full_search = 0
+
+        if contours:
+            self.misses = 0
+            self.bbox = (
+                min(x for (x, _, _, _) in contours),
+                min(y for (_, y, _, _) in contours),
+                max(x + w for (x, _, w, _) in contours),
+                max(y + h for (_, y, _, h) in contours),
+            )
+        elif track:
+            self.misses += 1
+        else:
+            self.bbox = None
+
+        elapsed = time.perf_counter() - start
+        if track:
+            self.tracked_frames += 1
+            self.tracked_time += elapsed
+        else:
+            self.full_frames += 1
+            self.full_time += elapsed
+        return contours
+
+    def summary(self):
+        """
+        Get the fraction of frames served by tracking and the average cost
+        per frame of tracked and full frame searches.
+
+        :returns: dict
+        """
+        frames = self.tracked_frames + self.full_frames
+        return {
+            'frames': frames,
+            'tracked_fraction': self.tracked_frames / frames if frames else 0.0,
+            'tracked_ms_per_frame': self.tracked_time * 1000 / self.tracked_frames if self.tracked_frames else None,
+            'full_ms_per_frame': self.full_time * 1000 / self.full_frames if self.full_frames else None,
+            'ms_per_frame': (self.tracked_time + self.full_time) * 1000 / frames if frames else None,
+        }
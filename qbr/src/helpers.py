@@ -3,6 +3,7 @@
 # vim: fenc=utf-8 ts=4 sw=4 et
 
 import math
+import numpy as np
 from constants import LOCALES
 
 def get_next_locale(locale):
@@ -139,3 +140,113 @@ def ciede2000(Lab_1, Lab_2):
 
     dE_00 = math.sqrt(f_L**2 + f_C**2 + f_H**2 + R_T * f_C * f_H)
     return dE_00
+
+# Observer= 2°, Illuminant= D65
+_RGB2XYZ = np.array([
+    [0.4124, 0.3576, 0.1805],
+    [0.2126, 0.7152, 0.0722],
+    [0.0193, 0.1192, 0.9505],
+])
+_XYZ_REF_WHITE = np.array([95.047, 100.0, 108.883])
+
+def bgr2lab_batch(bgr):
+    """
+    Convert an array of BGR colors to LAB in one vectorized pass.
+
+    This mirrors bgr2lab() step by step, including the rounding to 4 decimals
+    of the XYZ and LAB values, so results agree with the scalar function to
+    within one rounding step (1e-4) per component.
+
+    :param bgr: An array-like of shape (N, 3) or (3,) with BGR values.
+    :returns: numpy.ndarray of shape (N, 3), or (3,) for a single color.
+    """
+    bgr = np.asarray(bgr, dtype=np.float64)
+    single = bgr.ndim == 1
+    rgb = np.atleast_2d(bgr)[:, ::-1] / 255
+
+    rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92) * 100
+
+    xyz = np.round(rgb @ _RGB2XYZ.T, 4) / _XYZ_REF_WHITE
+    xyz = np.where(xyz > 0.008856, xyz ** 0.3333333333333333, (7.787 * xyz) + (16 / 116))
+
+    lab = np.empty_like(xyz)
+    lab[:, 0] = (116 * xyz[:, 1]) - 16
+    lab[:, 1] = 500 * (xyz[:, 0] - xyz[:, 1])
+    lab[:, 2] = 200 * (xyz[:, 1] - xyz[:, 2])
+    lab = np.round(lab, 4)
+
+    return lab[0] if single else lab
+
+def ciede2000_matrix(Lab_1, Lab_2):
+    """
+    Calculates the CIEDE2000 color distance between every pair of colors of
+    two sets of CIE L*a*b* colors.
+
+    This is the vectorized equivalent of ciede2000() and agrees with it to
+    within floating point error (1e-9).
+
+    :param Lab_1: An array-like of shape (N, 3).
+    :param Lab_2: An array-like of shape (M, 3).
+    :returns: numpy.ndarray of shape (N, M).
+    """
+    C_25_7 = 6103515625 # 25**7
+
+    Lab_1 = np.atleast_2d(np.asarray(Lab_1, dtype=np.float64))
+    Lab_2 = np.atleast_2d(np.asarray(Lab_2, dtype=np.float64))
+    L1, a1, b1 = (Lab_1[:, i, None] for i in range(3))
+    L2, a2, b2 = (Lab_2[None, :, i] for i in range(3))
+
+    C1 = np.sqrt(a1**2 + b1**2)
+    C2 = np.sqrt(a2**2 + b2**2)
+    C_ave = (C1 + C2) / 2
+    G = 0.5 * (1 - np.sqrt(C_ave**7 / (C_ave**7 + C_25_7)))
+
+    a1_, a2_ = (1 + G) * a1, (1 + G) * a2
+    C1_ = np.sqrt(a1_**2 + b1**2)
+    C2_ = np.sqrt(a2_**2 + b2**2)
+
+    h1_ = np.arctan2(b1, a1_)
+    h1_ = np.where(a1_ >= 0, h1_, h1_ + 2 * np.pi)
+    h1_ = np.where((b1 == 0) & (a1_ == 0), 0, h1_)
+
+    h2_ = np.arctan2(b2, a2_)
+    h2_ = np.where(a2_ >= 0, h2_, h2_ + 2 * np.pi)
+    h2_ = np.where((b2 == 0) & (a2_ == 0), 0, h2_)
+
+    C1C2 = C1_ * C2_
+    dL_ = L2 - L1
+    dC_ = C2_ - C1_
+    dh_ = h2_ - h1_
+    dh_ = np.where(dh_ > np.pi, dh_ - 2 * np.pi, np.where(dh_ < -np.pi, dh_ + 2 * np.pi, dh_))
+    dh_ = np.where(C1C2 == 0, 0, dh_)
+    dH_ = 2 * np.sqrt(C1C2) * np.sin(dh_ / 2)
+
+    L_ave = (L1 + L2) / 2
+    C_ave = (C1_ + C2_) / 2
+
+    _dh = np.abs(h1_ - h2_)
+    _sh = h1_ + h2_
+    h_ave = np.where(
+        C1C2 == 0, _sh, np.where(
+        _dh <= np.pi, _sh / 2, np.where(
+        _sh < 2 * np.pi, _sh / 2 + np.pi, _sh / 2 - np.pi)))
+
+    T = 1 - 0.17 * np.cos(h_ave - np.pi / 6) + 0.24 * np.cos(2 * h_ave) + 0.32 * np.cos(3 * h_ave + np.pi / 30) - 0.2 * np.cos(4 * h_ave - 63 * np.pi / 180)
+
+    h_ave_deg = h_ave * 180 / np.pi
+    h_ave_deg = np.where(h_ave_deg < 0, h_ave_deg + 360, np.where(h_ave_deg > 360, h_ave_deg - 360, h_ave_deg))
+    dTheta = 30 * np.exp(-(((h_ave_deg - 275) / 25)**2))
+
+    R_C = 2 * np.sqrt(C_ave**7 / (C_ave**7 + C_25_7))
+    S_C = 1 + 0.045 * C_ave
+    S_H = 1 + 0.015 * C_ave * T
+
+    Lm50s = (L_ave - 50)**2
+    S_L = 1 + 0.015 * Lm50s / np.sqrt(20 + Lm50s)
+    R_T = -np.sin(dTheta * np.pi / 90) * R_C
+
+    f_L = dL_ / S_L
+    f_C = dC_ / S_C
+    f_H = dH_ / S_H
+
+    return np.sqrt(f_L**2 + f_C**2 + f_H**2 + R_T * f_C * f_H)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Scan several sides of the cube at once, with a camera per side.
+
+Every camera is given as SIDE=SOURCE[@ROTATION]: the side it looks at, as
+the color of its center (green) or as a face (F), a camera index, video file
+or image directory, and how many degrees clockwise the camera sees the side
+rotated compared to the scanning instructions:
+
+    $ ./src/qbr.py --camera green=0 --camera white=2@90 --camera red=scans/red/
+
+Every camera runs its own thread with the whole detection pipeline and votes
+the colors of its side over the last frames. The sides of all cameras are
+fused into a single cube state with a confidence per facelet; cameras on the
+same side are combined by their confidence.
+"""
+
+import time
+import threading
+import cv2
+from collections import namedtuple
+import numpy as np
+from colordetection import color_detector, COLOR_FACES
+from detection import detection_scale, detect_grid, sample_stickers
+from sources import open_source, is_live_source
+from voting import StickerVotes
+from constants import DETECTION_REFERENCE_WIDTH, SCAN_SETTLE_FRAMES
+
+CameraSpec = namedtuple('CameraSpec', ['side', 'source', 'rotation'])
+
+# The color name of every face letter, e.g. 'F' -> 'green'.
+FACE_COLORS = {face: color for color, face in COLOR_FACES.items()}
+
+def parse_camera(spec):
+    """
+    Parse a camera argument like "green=0", "F=scans/green.mp4" or
+    "white=2@90".
+
+    :returns: CameraSpec with the side as color name
+    :raises ValueError: for an unknown side or rotation
+    """
+    side, separator, source = spec.partition('=')
+    if not separator or not source:
+        raise ValueError('expected SIDE=SOURCE[@ROTATION]: {}'.format(spec))
+    side = FACE_COLORS.get(side.upper(), side.lower())
+    if side not in COLOR_FACES:
+        raise ValueError('unknown side: {}'.format(spec.partition('=')[0]))
+    return parse_source(source)._replace(side=side)
+
+def parse_source(spec):
+    """
+    Parse a camera argument without a side like "2" or "2@90".
+
+    :returns: CameraSpec with None as side
+    :raises ValueError: for a rotation which isn't a multiple of 90 degrees
+    """
+    source, rotation = str(spec), 0
+    if '@' in source:
+        source, _, degrees = source.rpartition('@')
+        rotation = int(degrees) % 360
+        if rotation % 90:
+            raise ValueError('rotation must be a multiple of 90 degrees: {}'.format(degrees))
+    return CameraSpec(None, int(source) if is_live_source(source) else source, rotation)
+
+def rotation_order(rotation):
+    """
+    Get the order of the 9 stickers of a side seen rotated by this many
+    degrees clockwise, so that stickers[order] is in the scanning order.
+    """
+    return np.rot90(np.arange(9).reshape(3, 3), rotation // 90).ravel()
+
+class CameraWorker(threading.Thread):
+    """Capture, detect and vote the stickers of one camera."""
+
+    def __init__(self, spec, window, threshold):
+        super().__init__(daemon=True)
+        self.spec = spec
+        self.cam = open_source(spec.source)
+        if not self.cam.isOpened():
+            raise ValueError('cannot open camera: {}'.format(spec.source))
+        self.scale = detection_scale(int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH)) or DETECTION_REFERENCE_WIDTH)
+        self.order = rotation_order(spec.rotation)
+        self.live = is_live_source(spec.source)
+        self.votes = StickerVotes(window, threshold, len(color_detector.palette_names))
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.grids = 0
+        self.winners = None
+        self.confidence = np.zeros(9)
+        self.measured = None
+        # Incremented by reset(), frames read before it don't vote anymore.
+        self.generation = 0
+        self.settle = 0
+        self.running = True
+        self.finished = False
+
+    def run(self):
+        try:
+            while self.running:
+                generation = self.generation
+                ret, frame = self.cam.read()
+                if not ret:
+                    if self.live:
+                        continue
+                    break
+                self.frames += 1
+                contours = detect_grid(frame, self.scale)
+                if len(contours) != 9:
+                    continue
+                dominant_colors = color_detector.get_dominant_colors(sample_stickers(frame, contours, self.scale))
+                indices = color_detector.get_closest_color_indices(dominant_colors)[self.order]
+                with self.lock:
+                    if generation != self.generation:
+                        continue
+                    if self.settle > 0:
+                        self.settle -= 1
+                        continue
+                    self.grids += 1
+                    winners, confidence = self.votes.vote(indices)
+                    self.winners = winners.copy()
+                    self.confidence = confidence.copy()
+                    self.measured = dominant_colors[self.order]
+        finally:
+            self.cam.release()
+            self.finished = True
+
+    def reset(self, settle=SCAN_SETTLE_FRAMES):
+        """
+        Forget all votes, e.g. after the cube has been rotated, and ignore the
+        next settle frames with a cube.
+        """
+        with self.lock:
+            self.generation += 1
+            self.settle = settle
+            self.votes.reset()
+            self.winners = None
+            self.confidence = np.zeros(9)
+            self.measured = None
+
+    def result(self):
+        """
+        :returns: (winners, confidence, measured) of the last voted frame,
+                  measured are its BGR colors. winners and measured are None
+                  while the camera hasn't seen the cube yet.
+        """
+        with self.lock:
+            return self.winners, self.confidence, self.measured
+
+    @property
+    def stable(self):
+        """Whether every sticker reached the vote threshold."""
+        with self.lock:
+            return self.winners is not None and self.votes.stable
+
+    def stop(self):
+        self.running = False
+
+class MultiCameraScanner:
+    """Run a CameraWorker per camera and fuse their sides."""
+
+    def __init__(self, specs, window, threshold):
+        """
+        :param specs: CameraSpec of every camera, see parse_camera.
+        :param window int: Frames every camera votes over.
+        :param threshold float: Confidence every facelet of a side needs.
+        """
+        self.threshold = threshold
+        self.workers = [CameraWorker(spec, window, threshold) for spec in specs]
+        self.sides = sorted({spec.side for spec in specs}, key=list(COLOR_FACES).index)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+
+    def fuse(self):
+        """
+        Combine the votes of all cameras. Every camera votes for a color per
+        facelet with its confidence, the color with the highest sum wins and
+        its confidence is that sum divided by the amount of cameras on the
+        side.
+
+        :returns: (sides, confidence) dicts keyed by color name: the 9 BGR
+                  colors of every side like Webcam.result_state, and the
+                  confidence of every facelet between 0 and 1. Sides which no
+                  camera has seen yet are left out.
+        """
+        palette = color_detector.cube_color_palette
+        names = color_detector.palette_names
+        sides, confidence = {}, {}
+        for side in self.sides:
+            workers = [worker for worker in self.workers if worker.spec.side == side]
+            scores = np.zeros((9, len(names)))
+            for worker in workers:
+                winners, votes, _ = worker.result()
+                if winners is not None:
+                    scores[np.arange(9), winners] += votes
+            if not scores.any():
+                continue
+            winners = scores.argmax(axis=1)
+            sides[side] = [palette[names[index]] for index in winners]
+            confidence[side] = scores[np.arange(9), winners] / len(workers)
+        return sides, confidence
+
+    def measure(self):
+        """
+        Get the measured BGR colors of every side seen so far, the mean of
+        the last frames of all its cameras.
+
+        :returns: dict color name -> array of shape (9, 3)
+        """
+        measured = {}
+        for side in self.sides:
+            colors = [worker.result()[2] for worker in self.workers if worker.spec.side == side]
+            colors = [bgr for bgr in colors if bgr is not None]
+            if colors:
+                measured[side] = np.mean(colors, axis=0)
+        return measured
+
+    def stable(self, confidence):
+        """Whether every facelet of every side reached the threshold."""
+        return not self.unstable(confidence)
+
+    def unstable(self, confidence):
+        """Get the sides which weren't seen or didn't reach the threshold."""
+        return [side for side in self.sides
+                if side not in confidence or (confidence[side] < self.threshold).any()]
+
+    def scan(self, timeout=None, interval=0.01):
+        """
+        Wait until all sides are stable, every file source ended, the
+        timeout passed or Ctrl-C was pressed.
+
+        :returns: (sides, confidence) like fuse()
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            sides, confidence = self.fuse()
+            if self.stable(confidence) or all(worker.finished for worker in self.workers):
+                return sides, confidence
+            if deadline is not None and time.monotonic() > deadline:
+                return sides, confidence
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                return self.fuse()
+
+    def summary(self):
+        """Get the frame counters of every camera, for the output."""
+        return [{
+            'side': worker.spec.side,
+            'source': str(worker.spec.source),
+            'frames': worker.frames,
+            'grids': worker.grids,
+        } for worker in self.workers]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import cv2
+import numpy as np
+
+# Drawings closer than this many pixels are composited as one box.
+OVERLAY_BOX_MARGIN = 8
+
+class OverlayCache:
+    """
+    A layer of interface drawings that is rendered only when its key changes
+    and composited onto every frame.
+
+    The layer is rendered twice, onto a black and onto a white canvas. Pixels
+    which are equal on both are covered by the drawings, pixels which differ
+    are blended with the background (e.g. anti-aliased text): their difference
+    is the amount of background that shines through. So any cv2 drawing
+    function can render into the layer, and the composited frame matches
+    drawing directly onto it up to the rounding of the anti-aliasing.
+
+    Only the boxes around groups of nearby drawings are kept, which makes
+    compositing a multiply and an add per box.
+    """
+
+    def __init__(self, width, height):
+        self.black = np.zeros((height, width, 3), dtype=np.uint8)
+        self.white = np.full((height, width, 3), 255, dtype=np.uint8)
+        self.kernel = np.ones((OVERLAY_BOX_MARGIN * 2 + 1,) * 2, dtype=np.uint8)
+        self.key = None
+        self.renders = 0
+        # (x, y, background, colors) per box: how much of the frame remains,
+        # 0 to 255, and the drawings' colors premultiplied by their coverage.
+        self.boxes = []
+
+    def update(self, key, draw):
+        """
+        Render the layer with draw(canvas), unless it has been rendered with
+        an equal key before.
+
+        :param key: Anything comparable that changes with the drawings.
+        :param draw: Draws onto the BGR canvas it's called with.
+        :returns: bool Whether the layer was rendered.
+        """
+        if key == self.key:
+            return False
+        self.black.fill(0)
+        self.white.fill(255)
+        draw(self.black)
+        draw(self.white)
+
+        # 0 where the drawings cover the pixel, 255 where they don't touch it.
+        background = cv2.subtract(self.white, self.black)
+        touched = (background.min(axis=2) < 255).astype(np.uint8)
+        groups = cv2.dilate(touched, self.kernel)
+        count, _, stats, _ = cv2.connectedComponentsWithStats(groups)
+        self.boxes = []
+        for x, y, w, h, _ in stats[1:count]:
+            self.boxes.append((
+                x, y,
+                background[y:y+h, x:x+w].copy(),
+                self.black[y:y+h, x:x+w].copy(),
+            ))
+        self.key = key
+        self.renders += 1
+        return True
+
+    def composite(self, frame):
+        """Draw the layer onto a frame of the same size, in place."""
+        for x, y, background, colors in self.boxes:
+            h, w = background.shape[:2]
+            roi = frame[y:y+h, x:x+w]
+            cv2.multiply(roi, background, dst=roi, scale=1 / 255)
+            cv2.add(roi, colors, dst=roi)
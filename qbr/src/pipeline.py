@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import threading
+import time
+from collections import deque
+import numpy as np
+from profiler import profiler
+
+class LatestQueue:
+    """
+    A bounded queue that never blocks the producer. When the queue is full the
+    oldest item is dropped, so the consumer always gets the newest items.
+    """
+
+    def __init__(self, maxsize=1):
+        self.items = deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        """Add an item, dropping the oldest one if the queue is full."""
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Get the oldest item, waiting at most timeout seconds for one.
+
+        :returns: The item, or None on timeout or when the queue is closed.
+        """
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        """Wake up all consumers, get() returns None from now on when empty."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class PipelineStats:
+    """Frame counters and end-to-end latencies of the threaded pipeline."""
+
+    def __init__(self, window=300):
+        self.lock = threading.Lock()
+        self.captured = 0
+        self.processed = 0
+        self.displayed = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=window)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def add_latency(self, seconds):
+        with self.lock:
+            self.displayed += 1
+            self.latencies.append(seconds)
+
+    def summary(self, capture_queue, result_queue):
+        """
+        Get a summary of the counters. Frames are dropped either before
+        processing (processing is slower than the camera) or before display
+        (rendering is slower than processing).
+
+        :returns: dict
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+        return {
+            'captured': self.captured,
+            'processed': self.processed,
+            'displayed': self.displayed,
+            'dropped_before_processing': capture_queue.dropped,
+            'dropped_before_display': result_queue.dropped,
+            'latency_mean_ms': float(latencies.mean()) if len(latencies) else None,
+            'latency_p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        }
+
+class CaptureThread(threading.Thread):
+    """Read frames from the camera as fast as it delivers them."""
+
+    def __init__(self, cam, queue, stats):
+        super().__init__(daemon=True)
+        self.cam = cam
+        self.queue = queue
+        self.stats = stats
+        self.running = True
+
+    def run(self):
+        frame_id = 0
+        while self.running:
+            with profiler.stage('capture'):
+                ret, frame = self.cam.read()
+            if not ret:
+                continue
+            frame_id += 1
+            self.stats.count('captured')
+            self.queue.put((frame_id, time.perf_counter(), frame))
+        self.queue.close()
+
+    def stop(self):
+        self.running = False
+
+class ProcessingThread(threading.Thread):
+    """
+    Run the detection and classification stages of the webcam on the newest
+    captured frame and publish the result for the UI.
+    """
+
+    def __init__(self, webcam, capture_queue, result_queue, stats):
+        super().__init__(daemon=True)
+        self.webcam = webcam
+        self.capture_queue = capture_queue
+        self.result_queue = result_queue
+        self.stats = stats
+        self.running = True
+
+    def run(self):
+        while self.running:
+            item = self.capture_queue.get(timeout=0.1)
+            if item is None:
+                if self.capture_queue.closed:
+                    break
+                continue
+            frame_id, captured_at, frame = item
+            contours = self.webcam.detect(frame)
+            self.webcam.process_frame(frame, contours)
+            self.stats.count('processed')
+            self.result_queue.put((frame_id, captured_at, frame, contours))
+        self.result_queue.close()
+
+    def stop(self):
+        self.running = False
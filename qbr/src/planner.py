@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Choose the solution which the robot executes fastest.
+
+kociemba minimizes the amount of face turns, but on EspQbr a U or F turn
+needs four regrips of the whole cube, L and R two and D and B none. The
+planner solves the whole-cube rotations of the scanned state, which leads
+kociemba to different solutions, maps them back to the sides of the robot and
+picks the one with the lowest actuation cost.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import kociemba
+from cube import ROTATIONS, rotate_cube, unrotate_moves
+from constants import (
+    ESPQBR_SWEEP_DELAY,
+    ESPQBR_SETTLE_DELAY,
+    ESPQBR_TURN_STEPS,
+    ESPQBR_GRIP_STEPS,
+    ESPQBR_SCAN_DELAY,
+    ESPQBR_REGRIPS,
+    ESPQBR_SCAN_ROTATIONS,
+    ESPQBR_SCAN_PAUSES,
+    ESPQBR_CUBE_ROTATIONS,
+    DEFAULT_PLANNER_CANDIDATES,
+    DEFAULT_PLANNER_MAX_DEPTHS
+)
+
+def espqbr_timings():
+    """
+    Get the durations of the firmware's building blocks, derived from its
+    delays.
+
+    :returns: dict name -> seconds
+    """
+    grip = ESPQBR_GRIP_STEPS * ESPQBR_SWEEP_DELAY + ESPQBR_SETTLE_DELAY # openGrip() or closeGrip()
+    sweep = ESPQBR_TURN_STEPS * ESPQBR_SWEEP_DELAY + ESPQBR_SETTLE_DELAY # turn() of a face
+    snap = ESPQBR_SETTLE_DELAY # turn() with ms=0, back to the middle
+    return {
+        'grip': grip,
+        'turn_cube': sweep + grip + snap + grip,
+        'rotate_cube': 2 * (grip + snap + grip),
+        'scan_delay': ESPQBR_SCAN_DELAY,
+    }
+
+def espqbr_move_costs():
+    """
+    Get the seconds every command takes on EspQbr. After every command the
+    robot is back in its home position, so the cost of a solution is the sum
+    of the costs of its moves.
+
+    :returns: dict command -> seconds, e.g. {'U': 33.9, "U'": 33.9, 'U2': 39.0, ...}
+    """
+    timings = espqbr_timings()
+    costs = {}
+    for face, regrips in ESPQBR_REGRIPS.items():
+        costs[face] = costs[face + "'"] = regrips * timings['rotate_cube'] + timings['turn_cube']
+        costs[face + '2'] = regrips * timings['rotate_cube'] + 2 * timings['turn_cube']
+    costs['S'] = ESPQBR_SCAN_ROTATIONS * timings['rotate_cube'] + ESPQBR_SCAN_PAUSES * timings['scan_delay']
+    costs['T'] = 4 * timings['grip'] # test() opens and closes both grips
+    for axis in ESPQBR_CUBE_ROTATIONS:
+        costs[axis] = costs[axis + "'"] = timings['rotate_cube']
+        costs[axis + '2'] = 2 * timings['rotate_cube']
+    return costs
+
+class MoveCostModel:
+    """The actuation cost of every move, in seconds."""
+
+    def __init__(self, costs=None):
+        """
+        :param costs dict: Costs overriding the EspQbr defaults, e.g.
+                           {'U': 20.0}. A face applies to all its moves
+                           unless they're given too.
+        """
+        self.costs = espqbr_move_costs()
+        costs = costs or {}
+        # The faces first and the single moves after them, so the moves given
+        # too win whatever the key order of the JSON config.
+        for face in ESPQBR_REGRIPS:
+            if face in costs:
+                self.costs[face] = self.costs[face + "'"] = self.costs[face + '2'] = costs[face]
+        for move, cost in costs.items():
+            if move not in ESPQBR_REGRIPS:
+                self.costs[move] = cost
+        self.key = hashlib.sha1(json.dumps(self.costs, sort_keys=True).encode()).hexdigest()[:12]
+
+    def cost(self, moves):
+        """Get the cost of a solution, a list of moves."""
+        return sum(self.costs[move] for move in moves)
+
+def solve_candidate(facelets, rotation_index, max_depth):
+    """
+    Solve a whole-cube rotation of the state and map the solution back to the
+    sides of the unrotated cube. Runs in the planner's worker processes.
+
+    :returns: list of moves
+    """
+    rotated, face_map = rotate_cube(facelets, ROTATIONS[rotation_index])
+    solution = kociemba.solve(rotated, max_depth=max_depth)
+    return unrotate_moves(solution.split(), face_map)
+
+class Planner:
+    """
+    Solve several candidates in parallel worker processes and pick the one
+    with the lowest cost.
+    """
+
+    def __init__(self, cost_model=None, candidates=DEFAULT_PLANNER_CANDIDATES,
+                 max_depths=DEFAULT_PLANNER_MAX_DEPTHS, workers=None):
+        """
+        :param candidates int: The amount of cube rotations to solve, at
+                               most 24. The first one is the scanned state.
+        :param max_depths tuple: kociemba max_depth values to solve every
+                                 rotation with.
+        """
+        self.cost_model = cost_model or MoveCostModel()
+        self.jobs = [
+            (rotation_index, max_depth)
+            for rotation_index in range(min(max(candidates, 1), len(ROTATIONS)))
+            for max_depth in max_depths
+        ]
+        self.workers = workers or os.cpu_count()
+        self.pool = None
+        self.last_summary = None
+
+    @property
+    def key(self):
+        """Identifies the planner's choices, e.g. for caching."""
+        return 'plan-{}-{}'.format(len(self.jobs), self.cost_model.key)
+
+    def start(self):
+        """Start the worker processes, if not running yet."""
+        if self.pool is None:
+            context = multiprocessing.get_context('spawn')
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=context)
+
+    def plan(self, facelets, timeout=None, cancelled=None):
+        """
+        Find the cheapest solution among the candidates.
+
+        Candidates which aren't solved within the timeout are skipped, as long
+        as at least one candidate has been solved.
+
+        :param cancelled: A function which returns True to stop waiting.
+        :returns: list of moves, or None when cancelled
+        :raises TimeoutError: when no candidate was solved in time
+        :raises ValueError: when the state can't be solved
+        """
+        self.start()
+        start = time.monotonic()
+        deadline = start + timeout if timeout else None
+        jobs = {
+            self.pool.submit(solve_candidate, facelets, rotation_index, max_depth): (rotation_index, max_depth)
+            for rotation_index, max_depth in self.jobs
+        }
+        pending = set(jobs)
+        solutions = {}
+        errors = []
+        try:
+            while pending:
+                if cancelled is not None and cancelled():
+                    return None
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        errors.append(future.exception())
+                    else:
+                        solutions[jobs[future]] = future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+        if not solutions:
+            if errors:
+                raise ValueError(str(errors[0]))
+            raise TimeoutError('no solution after {} seconds'.format(timeout))
+
+        best = min(solutions.values(), key=lambda moves: (self.cost_model.cost(moves), len(moves)))
+        baseline = solutions.get(self.jobs[0])
+        self.last_summary = {
+            'candidates': len(solutions),
+            'seconds': round(time.monotonic() - start, 3),
+            'moves': len(best),
+            'cost': round(self.cost_model.cost(best), 2),
+            'kociemba_moves': len(baseline) if baseline is not None else None,
+            'kociemba_cost': round(self.cost_model.cost(baseline), 2) if baseline is not None else None,
+        }
+        return best
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
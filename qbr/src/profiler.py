@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Per-stage latency instrumentation of the frame loop.
+
+Stages are timed with `with profiler.stage('name'):`. While the profiler is
+disabled stage() returns a shared no-op context manager, so the hooks can stay
+in the hot path.
+"""
+
+import csv
+import json
+import os
+import threading
+import time
+from collections import deque
+import cv2
+import numpy as np
+from constants import (
+    PROFILER_WINDOW,
+    PROFILER_DUMP_INTERVAL,
+    PROFILER_OVERLAY_REFRESH,
+    PROFILER_HISTOGRAM_BINS
+)
+
+class _NullStage:
+    """The context manager of a disabled profiler, it does nothing."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    """Time the body of a with statement and record it in the profiler."""
+
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+class StageProfiler:
+    """
+    Keep the latencies of the last `window` calls of every stage, to report
+    their p50/p95/p99 and histograms on screen and in periodic dumps.
+    """
+
+    def __init__(self, window=PROFILER_WINDOW, enabled=False):
+        self.window = window
+        self.enabled = enabled
+        self.overlay = False
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.dump_path = None
+        self.dump_interval = PROFILER_DUMP_INTERVAL
+        self.last_dump = time.monotonic()
+        self.overlay_summary = {}
+        self.overlay_updated = 0
+
+    def stage(self, name):
+        """
+        Get a context manager which times a stage.
+
+        :param name str: The name of the stage.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        """Record one latency of the given stage."""
+        samples = self.latencies.get(name)
+        if samples is None:
+            with self.lock:
+                samples = self.latencies.setdefault(name, deque(maxlen=self.window))
+        samples.append(seconds)
+
+    def configure(self, dump_path=None, dump_interval=PROFILER_DUMP_INTERVAL):
+        """
+        Enable the profiler and dump the statistics to a .json or .csv file
+        every dump_interval seconds.
+        """
+        self.enabled = True
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+
+    def toggle_overlay(self):
+        """
+        Show or hide the overlay. Showing it enables the profiler, hiding it
+        disables the profiler again unless it's also dumping to a file.
+        """
+        self.overlay = not self.overlay
+        self.enabled = self.overlay or self.dump_path is not None
+
+    def summary(self):
+        """
+        Get the statistics of every stage, in milliseconds.
+
+        :returns: dict stage name -> dict with count, mean, p50, p95, p99, max
+                  and the histogram counts and bin edges
+        """
+        with self.lock:
+            stages = list(self.latencies.items())
+        summary = {}
+        for name, samples in stages:
+            ms = np.array(samples) * 1000
+            if not len(ms):
+                continue
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            counts, edges = np.histogram(ms, PROFILER_HISTOGRAM_BINS, (0, max(p99, 1e-3)))
+            summary[name] = {
+                'count': len(ms),
+                'mean_ms': round(float(ms.mean()), 4),
+                'p50_ms': round(float(p50), 4),
+                'p95_ms': round(float(p95), 4),
+                'p99_ms': round(float(p99), 4),
+                'max_ms': round(float(ms.max()), 4),
+                'histogram': counts.tolist(),
+                'histogram_edges_ms': [round(float(e), 4) for e in edges],
+            }
+        return summary
+
+    def dump(self, path=None):
+        """
+        Write the statistics to a JSON file, or to a CSV file without the
+        histograms when the path ends with .csv.
+        """
+        path = path or self.dump_path
+        summary = self.summary()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            if path.endswith('.csv'):
+                fields = ['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+                writer = csv.DictWriter(f, fields, extrasaction='ignore')
+                writer.writeheader()
+                for name, stats in summary.items():
+                    writer.writerow(dict(stats, stage=name))
+            else:
+                json.dump({'timestamp': time.time(), 'window': self.window, 'stages': summary}, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def maybe_dump(self):
+        """Dump the statistics if the dump interval has elapsed."""
+        if self.dump_path is None:
+            return
+        now = time.monotonic()
+        if now - self.last_dump >= self.dump_interval:
+            self.last_dump = now
+            self.dump()
+
+    def draw_overlay(self, frame, origin=(10, None)):
+        """
+        Draw a table with the p50/p95/p99 and a latency histogram of every
+        stage onto the frame. The statistics are refreshed a few times per
+        second, not on every frame.
+        """
+        now = time.monotonic()
+        if now - self.overlay_updated >= PROFILER_OVERLAY_REFRESH:
+            self.overlay_updated = now
+            self.overlay_summary = self.summary()
+        if not self.overlay_summary:
+            return
+
+        row_height = 14
+        text_width = 310
+        bar_width = 3
+        width = text_width + PROFILER_HISTOGRAM_BINS * bar_width + 10
+        height = (len(self.overlay_summary) + 1) * row_height + 8
+        x1 = origin[0]
+        y1 = origin[1] if origin[1] is not None else frame.shape[0] - height - 40
+        x1, y1 = max(x1, 0), max(y1, 0)
+        x2, y2 = min(x1 + width, frame.shape[1]), min(y1 + height, frame.shape[0])
+
+        # Darken the background of the table.
+        frame[y1:y2, x1:x2] //= 3
+
+        # The font isn't monospaced, so every column gets its own position.
+        font = cv2.FONT_HERSHEY_PLAIN
+        columns = [x1 + 4, x1 + 175, x1 + 220, x1 + 265]
+        rows = [('stage', 'p50', 'p95', 'p99 ms')] + [
+            (name, '{:.2f}'.format(stats['p50_ms']), '{:.2f}'.format(stats['p95_ms']), '{:.2f}'.format(stats['p99_ms']))
+            for name, stats in self.overlay_summary.items()
+        ]
+        for index, row in enumerate(rows):
+            y = y1 + (index + 1) * row_height
+            for x, text in zip(columns, row):
+                cv2.putText(frame, text, (x, y), font, 0.9, (255, 255, 255), 1, cv2.LINE_AA)
+
+        for index, stats in enumerate(self.overlay_summary.values()):
+            y = y1 + (index + 2) * row_height
+            counts = np.array(stats['histogram'])
+            heights = np.int32(counts * (row_height - 3) / max(counts.max(), 1))
+            for bin_index, bar_height in enumerate(heights):
+                if bar_height:
+                    bx = x1 + text_width + bin_index * bar_width
+                    cv2.rectangle(frame, (bx, y - bar_height), (bx + bar_width - 2, y), (36, 255, 12), -1)
+
+profiler = StageProfiler()
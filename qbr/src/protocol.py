@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+The messages between Qbr and the EspQbr robot.
+
+- ascii: the original line protocol. Every move is sent as a line of text,
+  e.g. "R2", and the firmware prints "Completed Step N" after every move.
+- binary: frames with a sequence number, a length prefix and a CRC, one byte
+  per move. The firmware neither tokenizes nor allocates Strings and a
+  solution may have any length.
+
+The binary frame layout is specified in EspQbr/PROTOCOL.md. The protocol
+classes only encode and decode bytes, the robot link does the I/O.
+"""
+
+import binascii
+import re
+import struct
+import time
+from collections import namedtuple
+
+FRAME_MAGIC = b'\x51\xb7'
+FRAME_HEADER = struct.Struct('<2sBHH') # magic, type, sequence number, payload length
+FRAME_CHECKSUM = struct.Struct('<H')
+FRAME_MAX_PAYLOAD = 1024
+# A partial frame is dropped when no byte arrived for this many seconds, in
+# case its length got damaged and the bytes it waits for never come.
+FRAME_IDLE_TIMEOUT = 0.1
+
+# Frame types, host to robot...
+FRAME_MOVES = 0x01
+FRAME_SYNC = 0x02
+# ... and robot to host.
+FRAME_ACK = 0x81
+FRAME_NAK = 0x82
+
+FRAME_NAMES = {
+    FRAME_MOVES : 'MOVES',
+    FRAME_SYNC  : 'SYNC',
+    FRAME_ACK   : 'ACK',
+    FRAME_NAK   : 'NAK',
+}
+
+# Reasons of a NAK, its only payload byte.
+NAK_CHECKSUM = 1
+NAK_SEQUENCE = 2
+NAK_TOO_LONG = 3
+NAK_UNKNOWN_MOVE = 4
+
+# A move byte is the command in the high nibble and the amount of clockwise
+# quarter turns in the low nibble: 'U' is 0x01, 'U2' 0x02 and "U'" 0x03.
+# S (scan) and T (test) take no turns, X and Z rotate the whole cube.
+MOVE_COMMANDS = 'URFDLBSTXZ'
+MOVE_TURNS = {'': 1, '2': 2, "'": 3}
+
+ACK_PATTERN = re.compile(r'Completed Step (\d+)')
+
+# Events returned by the protocols' feed().
+EVENT_ACK = 'ack'
+EVENT_NAK = 'nak'
+EVENT_LOG = 'log'
+
+Frame = namedtuple('Frame', ['type', 'seq', 'payload'])
+# A response of the robot: kind is one of the EVENT_*, seq the sequence number
+# it refers to (None in the ascii protocol) and line a human readable text.
+Event = namedtuple('Event', ['kind', 'seq', 'line', 'payload'])
+
+class ProtocolError(ValueError):
+    """A move or frame can't be encoded or decoded."""
+
+def move_codes():
+    """
+    Get the byte of every move.
+
+    :returns: dict move -> int, e.g. {'U': 0x01, 'U2': 0x02, "U'": 0x03, ...}
+    """
+    codes = {}
+    for command, letter in enumerate(MOVE_COMMANDS):
+        if letter in 'ST':
+            codes[letter] = command << 4
+            continue
+        for suffix, turns in MOVE_TURNS.items():
+            codes[letter + suffix] = command << 4 | turns
+    return codes
+
+MOVE_CODES = move_codes()
+MOVE_NAMES = {code: move for move, code in MOVE_CODES.items()}
+
+def encode_moves(moves):
+    """
+    Encode moves, one byte each.
+
+    :param moves: A list of moves or a string like "R U2 F'".
+    :returns: bytes
+    :raises ProtocolError: for an unknown move
+    """
+    if isinstance(moves, str):
+        moves = moves.split()
+    try:
+        return bytes(MOVE_CODES[move] for move in moves)
+    except KeyError as e:
+        raise ProtocolError('unknown move: {}'.format(e.args[0]))
+
+def decode_moves(payload):
+    """
+    Decode the payload of a MOVES frame.
+
+    :returns: list of moves
+    :raises ProtocolError: for an unknown move byte
+    """
+    try:
+        return [MOVE_NAMES[code] for code in payload]
+    except KeyError as e:
+        raise ProtocolError('unknown move byte: 0x{:02x}'.format(e.args[0]))
+
+def checksum(data):
+    """CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xffff)."""
+    return binascii.crc_hqx(data, 0xffff)
+
+def encode_frame(frame_type, seq, payload=b''):
+    """
+    Build a frame. The checksum covers everything in-between the magic and
+    the checksum itself.
+
+    :param seq int: Sequence number, taken modulo 2^16.
+    :returns: bytes
+    """
+    if len(payload) > FRAME_MAX_PAYLOAD:
+        raise ProtocolError('payload of {} bytes exceeds {} bytes'.format(len(payload), FRAME_MAX_PAYLOAD))
+    header = FRAME_HEADER.pack(FRAME_MAGIC, frame_type, seq & 0xffff, len(payload))
+    body = header[len(FRAME_MAGIC):] + bytes(payload)
+    return FRAME_MAGIC + body + FRAME_CHECKSUM.pack(checksum(body))
+
+def describe_frame(frame):
+    """Get a human readable line of a frame, e.g. for logs."""
+    name = FRAME_NAMES.get(frame.type, '0x{:02x}'.format(frame.type))
+    if frame.type == FRAME_MOVES:
+        try:
+            return '{} {} {}'.format(name, frame.seq, ' '.join(decode_moves(frame.payload)))
+        except ProtocolError:
+            pass
+    if frame.payload:
+        return '{} {} {}'.format(name, frame.seq, frame.payload.hex())
+    return '{} {}'.format(name, frame.seq)
+
+class FrameDecoder:
+    """
+    Split a byte stream into frames.
+
+    Bytes in front of a frame are skipped, e.g. debug output of the firmware.
+    A frame whose checksum doesn't match or whose length is implausible is
+    dropped and the search for the next magic continues right behind the
+    rejected one. Rejected frames are kept in `rejected` as (sequence number,
+    NAK reason) pairs, for a receiver which answers them with a NAK.
+    """
+
+    def __init__(self, max_payload=FRAME_MAX_PAYLOAD, idle_timeout=FRAME_IDLE_TIMEOUT):
+        self.max_payload = max_payload
+        self.idle_timeout = idle_timeout
+        self.buffer = bytearray()
+        self.received_at = 0.0
+        self.rejected = []
+        self.skipped = 0
+
+    def feed(self, data):
+        """
+        Add received bytes.
+
+        :returns: list of Frame completed by them
+        """
+        if not data:
+            return []
+        now = time.monotonic()
+        if self.buffer and now - self.received_at > self.idle_timeout:
+            self.skipped += len(self.buffer)
+            self.buffer.clear()
+        self.received_at = now
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(FRAME_MAGIC)
+            if start < 0:
+                # Keep a trailing first magic byte, the next read may complete it.
+                keep = 1 if self.buffer.endswith(FRAME_MAGIC[:1]) else 0
+                self.skipped += len(self.buffer) - keep
+                del self.buffer[:len(self.buffer) - keep]
+                return frames
+            self.skipped += start
+            del self.buffer[:start]
+            if len(self.buffer) < FRAME_HEADER.size:
+                return frames
+
+            _, frame_type, seq, length = FRAME_HEADER.unpack_from(self.buffer)
+            if length > self.max_payload:
+                self.rejected.append((seq, NAK_TOO_LONG))
+                del self.buffer[:len(FRAME_MAGIC)]
+                continue
+            end = FRAME_HEADER.size + length + FRAME_CHECKSUM.size
+            if len(self.buffer) < end:
+                return frames
+
+            body = bytes(self.buffer[len(FRAME_MAGIC):end - FRAME_CHECKSUM.size])
+            expected, = FRAME_CHECKSUM.unpack_from(self.buffer, end - FRAME_CHECKSUM.size)
+            if checksum(body) != expected:
+                self.rejected.append((seq, NAK_CHECKSUM))
+                del self.buffer[:len(FRAME_MAGIC)]
+                continue
+            frames.append(Frame(frame_type, seq, body[FRAME_HEADER.size - len(FRAME_MAGIC):]))
+            del self.buffer[:end]
+
+class AsciiProtocol:
+    """
+    The original line protocol, understood by the current firmware. Every
+    "Completed Step N" line acknowledges the oldest move in flight, as lines
+    carry no sequence numbers.
+    """
+
+    name = 'ascii'
+    # Whether moves carry sequence numbers and can be sent again.
+    sequenced = False
+
+    def __init__(self):
+        self.buffer = b''
+
+    def sync(self, seq):
+        """Lines can't be synchronized, there's nothing to send."""
+        return None
+
+    def completed(self, event):
+        return None
+
+    def encode(self, move, seq):
+        return (move + '\n').encode('utf-8')
+
+    def feed(self, data):
+        """
+        Add received bytes.
+
+        :returns: list of Event
+        """
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        events = []
+        for line in lines:
+            text = line.decode('utf-8', 'replace').rstrip('\r')
+            events.append(Event(EVENT_ACK if ACK_PATTERN.search(text) else EVENT_LOG, None, text, b''))
+        return events
+
+class BinaryProtocol:
+    """
+    Binary frames, one move per MOVES frame. The robot acknowledges every
+    frame with an ACK once its moves are done, or with a NAK carrying the
+    sequence number it expects next when a frame was damaged or out of order.
+    The ACK of a SYNC frame carries the sequence number of the last MOVES
+    frame the robot completed.
+    """
+
+    name = 'binary'
+    sequenced = True
+
+    def __init__(self):
+        self.decoder = FrameDecoder()
+
+    def sync(self, seq):
+        """Get the SYNC frame which makes the robot expect seq + 1 next."""
+        return encode_frame(FRAME_SYNC, seq)
+
+    def completed(self, event):
+        """
+        Get the sequence number of the last completed MOVES frame from the ACK
+        of a SYNC frame, or None if the robot didn't complete any yet.
+        """
+        if len(event.payload) < 2:
+            return None
+        return int.from_bytes(event.payload[:2], 'little')
+
+    def encode(self, move, seq):
+        return encode_frame(FRAME_MOVES, seq, encode_moves([move]))
+
+    def feed(self, data):
+        """
+        Add received bytes.
+
+        :returns: list of Event
+        """
+        events = []
+        for frame in self.decoder.feed(data):
+            if frame.type == FRAME_ACK:
+                kind = EVENT_ACK
+            elif frame.type == FRAME_NAK:
+                kind = EVENT_NAK
+            else:
+                kind = EVENT_LOG
+            events.append(Event(kind, frame.seq, describe_frame(frame), frame.payload))
+        return events
+
+PROTOCOLS = {
+    'ascii'  : AsciiProtocol,
+    'binary' : BinaryProtocol,
+}
@@ -3,16 +3,46 @@
 # vim: fenc=utf-8 ts=4 sw=4 et
 
 import sys
+import json
+import time
 import kociemba
 import argparse
-import serial
-import socket
+import numpy as np
 from video import Webcam
+from multicam import MultiCameraScanner, CameraWorker, parse_camera, parse_source
+from scanning import ScanOrchestrator, ScanError, SCAN_PLAN
+from colordetection import color_detector, DOMINANT_COLOR_ESTIMATORS
+from profiler import profiler
+from solution_cache import create_solution_cache
+from solver import AsyncSolver
+from planner import Planner, MoveCostModel
+from cube import FaceletState, InvalidCubeState
+from transport import open_transport, RobotLink, TransportError
+from protocol import PROTOCOLS
 import i18n
 import os
 from config import config
 from constants import (
     ROOT_DIR,
+    DETECTION_REFERENCE_WIDTH,
+    PROFILER_DUMP_INTERVAL,
+    SOLVE_TIMEOUT,
+    DEFAULT_SOLVE_TIMEOUT,
+    REMOTE_URL,
+    DEFAULT_REMOTE_URL,
+    ROBOT_WINDOW,
+    DEFAULT_ROBOT_WINDOW,
+    ROBOT_PROTOCOL,
+    DEFAULT_ROBOT_PROTOCOL,
+    ROBOT_MOVE_COSTS,
+    PLANNER_CANDIDATES,
+    DEFAULT_PLANNER_CANDIDATES,
+    PREVIEW_VOTE_WINDOW,
+    DEFAULT_PREVIEW_VOTE_WINDOW,
+    PREVIEW_VOTE_CONFIDENCE,
+    DEFAULT_PREVIEW_VOTE_CONFIDENCE,
+    DEFAULT_CAMERA_SCAN_TIMEOUT,
+    SCAN_SIDE_TIMEOUT,
     E_INCORRECTLY_SCANNED,
     E_ALREADY_SOLVED
 )
@@ -32,67 +62,239 @@ i18n.set('fallback', 'en')
 
 class Qbr:
 
-    def __init__(self, normalize, autoscan, remote):
+    def __init__(self, normalize, autoscan, remote, threaded=False, render_fps=30, workers=0,
+                 track=False, resolution=None, pyramid_width=None, headless=None, output=None,
+                 solve_timeout=None, remote_url=None, robot_window=None, candidates=None,
+                 robot_protocol=None, vote_window=None, vote_confidence=None, cameras=None,
+                 robot_scan=None, scan_timeout=None):
         self.normalize = normalize
         self.autoscan = autoscan
         self.remote = remote
+        self.threaded = threaded
+        self.render_fps = render_fps
+        self.workers = workers
+        self.track = track
+        self.resolution = resolution
+        self.pyramid_width = pyramid_width
+        self.headless = headless
+        self.output = output
+        self.cameras = cameras
+        self.robot_scan = robot_scan
+        self.scan_timeout = scan_timeout
+        if vote_window is None:
+            vote_window = config.get_setting(PREVIEW_VOTE_WINDOW, DEFAULT_PREVIEW_VOTE_WINDOW)
+        if vote_confidence is None:
+            vote_confidence = config.get_setting(PREVIEW_VOTE_CONFIDENCE, DEFAULT_PREVIEW_VOTE_CONFIDENCE)
+        self.vote_window = vote_window
+        self.vote_confidence = vote_confidence
+        self.solution_cache = create_solution_cache()
 
-    def send_to_remote_serial(self, sol):
-        buf = bytes(sol, 'utf-8')
-        ard_client = serial.Serial(port='/dev/ttyUSB0', baudrate=115200, timeout=.1)
-        ard_client.write(buf)
-        ard_client.close()
+        # Let the robot execute the solution it's fastest at.
+        if candidates is None:
+            candidates = config.get_setting(PLANNER_CANDIDATES, DEFAULT_PLANNER_CANDIDATES)
+        self.cost_model = MoveCostModel(config.get_setting(ROBOT_MOVE_COSTS))
+        self.planner = None
+        if remote and candidates > 0:
+            self.planner = Planner(self.cost_model, candidates)
 
-    def send_to_remote_tcp(self, sol):
-        buf = bytes(sol, 'utf-8')
-        try:
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client.connect(("192.168.4.1", 50001))
-            client.send(buf)
-            client.close()
-        except Exception as e:
-            print("Exception: {0}".format(e))
+        self.solver = AsyncSolver(
+            self.solution_cache,
+            solve_timeout or config.get_setting(SOLVE_TIMEOUT, DEFAULT_SOLVE_TIMEOUT),
+            self.planner
+        )
+        self.robot = None
+        if remote:
+            # The connection is opened on the first solve and then kept open.
+            self.robot = RobotLink(
+                open_transport(remote_url or config.get_setting(REMOTE_URL, DEFAULT_REMOTE_URL)),
+                robot_window or config.get_setting(ROBOT_WINDOW, DEFAULT_ROBOT_WINDOW),
+                protocol=robot_protocol or config.get_setting(ROBOT_PROTOCOL, DEFAULT_ROBOT_PROTOCOL)
+            )
 
-    def send_to_remote_bluet(self, sol):
-        buf = bytes(sol, 'utf-8')
-        serverMACAddress = '00:1f:e1:dd:08:3d'
-        port = 3
+    def send_to_robot(self, algorithm):
+        """
+        Stream the moves to the robot and print how long every move took.
+
+        :returns: dict The report of RobotLink.send_moves, or None on failure.
+        """
+        moves = algorithm.split()
+        print('robot predicted: {:.2f} s'.format(self.cost_model.cost(moves)))
         try:
-            blue_client = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
-            blue_client.connect((serverMACAddress, port))
-            blue_client.send(buf)
-            blue_client.close()
-        except Exception as e:
-            print("Exception: {0}".format(e))            
+            report = self.robot.send_moves(moves)
+        except TransportError as e:
+            print("Exception: {0}".format(e))
+            return None
+        for index, (move, seconds) in enumerate(zip(report['moves'], report['actuation'])):
+            print('robot move {}. {}: {:.2f} s'.format(index + 1, move, seconds))
+        print('robot total: {:.2f} s'.format(report['total']))
+        return report
 
     def solve_cube(self, note):
+        """
+        Solve the cube like solve_async, planned for the robot if enabled,
+        and wait until the solution has been reported.
+        """
         try:
-            algorithm = kociemba.solve(note)
-            length = len(algorithm.split(' '))
+            self.solve_async(note).result()
         except Exception as e:
             print("Exception: {0}".format(e))
             #self.print_E_and_exit(E_INCORRECTLY_SCANNED)
 
+    def solve_async(self, note):
+        """
+        Solve the cube in the background. The solution is reported (printed
+        and sent to the remote client) from the solver's thread.
+
+        :returns: concurrent.futures.Future of the algorithm
+        """
+        return self.solver.submit(note, self.report_solution)
+
+    def report_solution(self, algorithm):
+        """Print the solution and send it to the remote client if enabled."""
+        length = len(algorithm.split(' '))
         print(i18n.t('startingPosition'))
         print(i18n.t('moves', moves=length))
         print(i18n.t('solution', algorithm=algorithm))
-        
-        if(self.remote):
-            # send data to remote client
-            self.send_to_remote_serial(algorithm)
-            #self.send_to_remote_tcp(algorithm)
-            #self.send_to_remote_bluet(algorithm)
 
         if self.normalize:
             for index, notation in enumerate(algorithm.split(' ')):
                 text = i18n.t('solveManual.{}'.format(notation))
-                print('{}. {}'.format(index + 1, text))                
+                print('{}. {}'.format(index + 1, text))
+
+        if self.robot is not None:
+            if self.planner is not None and self.planner.last_summary is not None:
+                for name, value in self.planner.last_summary.items():
+                    print('plan {}: {}'.format(name, value))
+            self.send_to_robot(algorithm)
+
+    def run_headless(self):
+        """
+        Scan all headless sources (video files or image directories) without a
+        user interface and write JSON lines to the output file or stdout.
+        """
+        output = open(self.output, 'w') if self.output else sys.stdout
+        try:
+            for source in self.headless:
+                Webcam(self, source).run_headless(output)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+    def run_cameras(self):
+        """
+        Scan the sides of all --camera sources at once and write a JSON line
+        per camera and one with the fused cube state to the output file or
+        stdout. The cube is solved once all 6 sides were scanned.
+        """
+        start = time.perf_counter()
+        scanner = MultiCameraScanner(self.cameras, self.vote_window, self.vote_confidence).start()
+        try:
+            sides, confidence = scanner.scan(
+                self.scan_timeout if self.scan_timeout is not None else DEFAULT_CAMERA_SCAN_TIMEOUT)
+        finally:
+            scanner.stop()
+        elapsed = time.perf_counter() - start
+
+        unstable = scanner.unstable(confidence)
+        if unstable:
+            print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t(
+                'unstableSides', sides=', '.join(i18n.t(side) for side in unstable))))
+
+        facelets = margins = None
+        if len(sides) == 6:
+            # Assign the measured colors of all sides at once, 9 per color.
+            measured = scanner.measure()
+            faces, margins = color_detector.assign_sides_to_faces(
+                {side: measured.get(side, colors) for side, colors in sides.items()})
+            try:
+                state = FaceletState(faces)
+                state.validate()
+                facelets = state.to_facelets()
+            except InvalidCubeState as e:
+                print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('invalidState.{}'.format(e.reason))))
+
+        output = open(self.output, 'w') if self.output else sys.stdout
+        try:
+            for camera in scanner.summary():
+                side = camera['side']
+                if side in sides:
+                    camera['colors'] = [color_detector.get_closest_color(bgr)['color_name'] for bgr in sides[side]]
+                    camera['confidence'] = [round(float(c), 4) for c in confidence[side]]
+                output.write(json.dumps(camera) + '\n')
+            output.write(json.dumps({
+                'sides': sorted(sides.keys()),
+                'seconds': round(elapsed, 3),
+                'unstable': unstable,
+                'facelets': facelets,
+                'margins': None if margins is None else [
+                    round(float(m), 4) if np.isfinite(m) else None for m in margins],
+            }) + '\n')
+            output.flush()
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        if facelets is None:
+            if len(sides) != 6:
+                print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('haventScannedAllSides')))
+            return
+        self.solve_cube(facelets)
+
+    def run_robot_scan(self):
+        """
+        Let the robot rotate the cube in front of the --robot-scan camera,
+        commanding the next rotation as soon as a side is stable, and solve
+        the scanned cube.
+        """
+        worker = CameraWorker(self.robot_scan, self.vote_window, self.vote_confidence)
+        worker.start()
+        print('robot scan predicted: {:.2f} s'.format(self.cost_model.cost(
+            [rotation for rotations in SCAN_PLAN for rotation in rotations])))
+        try:
+            timeout = self.scan_timeout if self.scan_timeout is not None else SCAN_SIDE_TIMEOUT
+            result = ScanOrchestrator(self.robot, worker, timeout).scan(lambda side: print(
+                'robot scan {}: {:.2f} s robot, {:.2f} s camera'.format(
+                    ' '.join(side['rotations']) or '-', side['robot_seconds'], side['camera_seconds'])))
+        except (ScanError, TransportError) as e:
+            print("Exception: {0}".format(e))
+            return
+        except InvalidCubeState as e:
+            print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('invalidState.{}'.format(e.reason))))
+            return
+        finally:
+            worker.stop()
+            worker.join()
+        print('robot scan total: {:.2f} s'.format(result['total']))
+        self.solve_cube(result['facelets'])
 
     def run(self):
         """The main function that will run the Qbr program."""
+        if self.headless:
+            self.run_headless()
+            return
+
+        if self.robot_scan or self.cameras:
+            # Load the pruning tables while scanning.
+            self.solver.start()
+            if self.robot_scan:
+                self.run_robot_scan()
+            else:
+                self.run_cameras()
+            self.solver.close()
+            if self.robot is not None:
+                self.robot.close()
+            return
+
+        # Load the pruning tables while the user is scanning.
+        self.solver.start()
+
         webcam = Webcam(self)
 
         state = webcam.run()
+        self.solver.close()
+        if self.robot is not None:
+            self.robot.cancel()
+            self.robot.close()
 
         # If we receive a number then it's an error code.
         # if isinstance(state, int) and state > 0:
@@ -113,8 +315,17 @@ class Qbr:
         #         text = i18n.t('solveManual.{}'.format(notation))
         #         print('{}. {}'.format(index + 1, text))
 
+        self.print_solution_cache_summary()
         print("Exiting Qbr!")
 
+    def print_solution_cache_summary(self):
+        """Print the hit and miss counters of the solution cache, if it was used."""
+        summary = self.solution_cache.summary()
+        if summary['hit_rate'] is None:
+            return
+        for name, value in summary.items():
+            print('solution cache {}: {}'.format(name, value))
+
     def print_E_and_exit(self, code):
         """Print an error message based on the code and exit the program."""
         if code == E_INCORRECTLY_SCANNED:
@@ -149,7 +360,176 @@ if __name__ == '__main__':
         action='store_true',
         help='send solution to remote client'
     )
+    parser.add_argument(
+        '-t',
+        '--threaded',
+        default=False,
+        action='store_true',
+        help='capture, process and display frames in separate threads'
+    )
+    parser.add_argument(
+        '--render-fps',
+        default=30,
+        type=int,
+        help='frames per second of the user interface in threaded mode'
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        default=0,
+        type=int,
+        help='run detection in this many worker processes'
+    )
+    parser.add_argument(
+        '--track',
+        default=False,
+        action='store_true',
+        help='only search around the last found cube, not in multi-process mode'
+    )
+    parser.add_argument(
+        '--resolution',
+        default=None,
+        type=lambda value: tuple(int(v) for v in value.lower().split('x')),
+        help='capture resolution, e.g. 1280x720, defaults to the \
+              capture_resolution setting or 640x480'
+    )
+    parser.add_argument(
+        '--pyramid',
+        dest='pyramid_width',
+        default=None,
+        nargs='?',
+        const=DETECTION_REFERENCE_WIDTH,
+        type=int,
+        help='find the cube on a frame downscaled to this width (default 640) \
+              and refine the stickers at full resolution'
+    )
+    parser.add_argument(
+        '--headless',
+        default=None,
+        nargs='+',
+        metavar='SOURCE',
+        help='scan video files or image directories without a user interface \
+              and print a JSON line per frame'
+    )
+    parser.add_argument(
+        '--robot-scan',
+        default=None,
+        nargs='?',
+        const=parse_source('2'),
+        type=parse_source,
+        metavar='SOURCE[@ROTATION]',
+        help='let the robot (--remote) rotate the cube in front of this camera \
+              and rotate on as soon as a side is stable, defaults to camera 2'
+    )
+    parser.add_argument(
+        '--scan-timeout',
+        default=None,
+        type=float,
+        help='seconds --camera waits for all sides to be stable (default 60), \
+              or --robot-scan for every side (default 10)'
+    )
+    parser.add_argument(
+        '--camera',
+        dest='cameras',
+        default=None,
+        action='append',
+        type=parse_camera,
+        metavar='SIDE=SOURCE[@ROTATION]',
+        help='scan a side with its own camera, video file or image directory, \
+              e.g. green=0 or white=2@90, may be given once per camera'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        default=None,
+        help='write the JSON lines of --headless or --camera to this file \
+              instead of stdout'
+    )
+    parser.add_argument(
+        '--vote-window',
+        default=None,
+        type=int,
+        help='frames the sticker colors are voted over, 1 for a single image \
+              per side, defaults to the preview_vote_window setting or 8'
+    )
+    parser.add_argument(
+        '--vote-confidence',
+        default=None,
+        type=float,
+        help='share of the vote window every sticker needs before a side is \
+              captured automatically, defaults to the \
+              preview_vote_confidence setting or 0.75'
+    )
+    parser.add_argument(
+        '-d',
+        '--dominant-color',
+        default=None,
+        choices=DOMINANT_COLOR_ESTIMATORS.keys(),
+        help='method to estimate the color of a sticker, defaults to the \
+              dominant_color_method setting or kmeans'
+    )
+    parser.add_argument(
+        '--remote-url',
+        default=None,
+        help='the robot to send the solution to, e.g. serial:///dev/ttyUSB0, \
+              tcp://192.168.4.1:50001 or bluetooth://00:1f:e1:dd:08:3d:3, \
+              defaults to the remote_url setting or /dev/ttyUSB0'
+    )
+    parser.add_argument(
+        '--robot-window',
+        default=None,
+        type=int,
+        help='moves sent to the robot ahead of their acknowledgement, \
+              defaults to the robot_window setting or 4'
+    )
+    parser.add_argument(
+        '--robot-protocol',
+        default=None,
+        choices=PROTOCOLS.keys(),
+        help='ascii sends every move as a line of text, binary as a checksummed \
+              frame (see EspQbr/PROTOCOL.md), defaults to the robot_protocol \
+              setting or ascii'
+    )
+    parser.add_argument(
+        '--candidates',
+        default=None,
+        type=int,
+        help='solve this many whole-cube rotations of the scanned state and \
+              send the robot the fastest solution, 0 sends kociemba\'s \
+              solution, defaults to the planner_candidates setting or 24'
+    )
+    parser.add_argument(
+        '--solve-timeout',
+        default=None,
+        type=float,
+        help='seconds a solve may take, defaults to the solve_timeout \
+              setting or 10'
+    )
+    parser.add_argument(
+        '--profile',
+        default=None,
+        metavar='FILE',
+        help='time every stage of the frame loop and periodically write the \
+              latency percentiles to FILE (.json or .csv)'
+    )
+    parser.add_argument(
+        '--profile-interval',
+        default=PROFILER_DUMP_INTERVAL,
+        type=float,
+        help='seconds in-between two writes of --profile'
+    )
     args = parser.parse_args()
+    if args.robot_scan and not args.remote:
+        parser.error('--robot-scan needs --remote')
+
+    if args.dominant_color:
+        color_detector.set_dominant_color_method(args.dominant_color)
+
+    if args.profile:
+        profiler.configure(args.profile, args.profile_interval)
 
     # Run Qbr with all arguments.
-    Qbr(args.normalize, args.autoscan, args.remote).run()
+    Qbr(args.normalize, args.autoscan, args.remote, args.threaded, args.render_fps, args.workers, args.track,
+        args.resolution, args.pyramid_width, args.headless, args.output, args.solve_timeout,
+        args.remote_url, args.robot_window, args.candidates, args.robot_protocol, args.vote_window,
+        args.vote_confidence, args.cameras, args.robot_scan, args.scan_timeout).run()
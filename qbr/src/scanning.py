@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Scan the cube in the robot one side at a time.
+
+EspQbr's S command rotates the cube through all sides on its own and waits
+SCAN_DELAY (5 s) after every side, whether the camera needed that long or
+not. The orchestrator sends single X and Z rotations instead, waits until the
+camera has voted a stable new side and commands the next rotation right away.
+
+It keeps track of the orientation of the cube, so the sides may be shown in
+any order and orientation: the plan is the shortest sequence of rotations
+which shows every side to the camera (7 instead of the firmware's 16). The
+cube isn't rotated back, the facelets are those of the cube as it sits in the
+grippers afterwards, which is what the robot's moves refer to.
+"""
+
+import time
+from collections import deque
+import numpy as np
+from cube import FACES, CENTERS, ROBOT_ROTATIONS, FaceletState
+from planner import espqbr_move_costs
+from colordetection import color_detector
+from constants import SCAN_SIDE_TIMEOUT
+
+# The facelets of the side the camera looks at.
+CAMERA_FACELETS = np.arange(9) + FACES.index('F') * 9
+
+class ScanError(RuntimeError):
+    """The camera didn't report a stable new side in time."""
+
+def scan_plan(rotations=('X', "X'", 'Z', "Z'")):
+    """
+    Find the shortest sequence of rotations which shows every side to the
+    camera, by a breadth-first search over the orientations of the cube and
+    the sides seen so far.
+
+    :returns: list of lists of commands, the rotations before every side,
+              starting with [] for the side the camera sees right away.
+    """
+    def rotate(position, rotation):
+        moved = [0] * 54
+        for index, target in enumerate(ROBOT_ROTATIONS[rotation]):
+            moved[target] = position[index]
+        return tuple(moved)
+
+    # The original index of the facelet at every position, the side in front
+    # is the one whose center is in front of the camera.
+    start = tuple(range(54))
+    front = lambda position: position[CAMERA_FACELETS[4]]
+    queue = deque([(start, frozenset([front(start)]), [])])
+    visited = {queue[0][:2]}
+    while queue:
+        position, sides, path = queue.popleft()
+        if len(sides) == len(FACES):
+            break
+        for rotation in rotations:
+            moved = rotate(position, rotation)
+            key = (moved, sides | {front(moved)})
+            if key not in visited:
+                visited.add(key)
+                queue.append(key + (path + [rotation],))
+
+    # Split the path into the rotations before every new side.
+    plan, steps, position, sides = [[]], [], start, {front(start)}
+    for rotation in path:
+        steps.append(rotation)
+        position = rotate(position, rotation)
+        if front(position) not in sides:
+            sides.add(front(position))
+            plan.append(steps)
+            steps = []
+    return plan
+
+SCAN_PLAN = scan_plan()
+
+def facelets_from_indices(indices):
+    """
+    Name the palette index of every facelet after the face whose center has
+    the same color, like kociemba expects.
+
+    :param indices: 54 palette indices in URFDLB order.
+    :returns: str facelets
+    :raises InvalidCubeState: when no cube can be in the scanned state, e.g.
+                              two centers have the same color
+    """
+    # Validated with the face of every palette color, the facelets named
+    # after the centers can't tell mirrored centers apart any more.
+    state = FaceletState(color_detector.palette_faces[indices])
+    state.validate()
+    return state.to_facelets()
+
+class ScanOrchestrator:
+    """Scan the cube in the robot with a camera, one rotation at a time."""
+
+    def __init__(self, robot, camera, timeout=SCAN_SIDE_TIMEOUT, interval=0.005):
+        """
+        :param robot: A RobotLink.
+        :param camera: A started multicam.CameraWorker looking at F.
+        :param timeout float: Seconds to wait for a stable side.
+        :param interval float: Seconds in-between polling the camera.
+        """
+        self.robot = robot
+        self.camera = camera
+        self.timeout = timeout
+        self.interval = interval
+
+    def wait_for_side(self, captured):
+        """
+        Wait until the camera voted a stable side whose center isn't one of
+        the captured ones.
+
+        :returns: (winners, confidence, measured) of the 9 stickers
+        :raises ScanError: after the timeout
+        """
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            if self.camera.stable:
+                winners, confidence, measured = self.camera.result()
+                if int(winners[4]) not in captured:
+                    return winners, confidence, measured
+            if self.camera.finished:
+                break
+            time.sleep(self.interval)
+        raise ScanError('no stable side after {} sides'.format(len(captured)))
+
+    def scan(self, on_side=None):
+        """
+        Rotate the cube through the plan and capture every side.
+
+        :param on_side: Called with the report of every captured side.
+        :returns: dict with the 'facelets', vote 'confidence' and assignment
+                  'margins' of the cube in its final orientation, a report
+                  per side (the rotations, how long the robot and the camera
+                  took) and the totals
+        :raises ScanError: when the camera didn't see a stable new side
+        :raises InvalidCubeState: when no cube can be in the scanned state
+        :raises TransportError: when the robot is unreachable
+        """
+        start = time.perf_counter()
+        # The original index of the facelet at every position of the robot.
+        origin = np.arange(54)
+        indices = np.zeros(54, dtype=np.intp)
+        confidence = np.zeros(54)
+        measured = np.zeros((54, 3))
+        captured = set()
+        sides = []
+        for rotations in SCAN_PLAN:
+            rotated_at = time.perf_counter()
+            if rotations:
+                self.robot.send_moves(rotations)
+                for rotation in rotations:
+                    moved = np.empty_like(origin)
+                    moved[ROBOT_ROTATIONS[rotation]] = origin
+                    origin = moved
+            self.camera.reset()
+            seen_at = time.perf_counter()
+            winners, votes, colors = self.wait_for_side(captured)
+            captured.add(int(winners[4]))
+            indices[origin[CAMERA_FACELETS]] = winners
+            confidence[origin[CAMERA_FACELETS]] = votes
+            measured[origin[CAMERA_FACELETS]] = colors
+            side = {
+                'rotations': rotations,
+                'robot_seconds': seen_at - rotated_at,
+                'camera_seconds': time.perf_counter() - seen_at,
+            }
+            sides.append(side)
+            if on_side is not None:
+                on_side(side)
+
+        # Assign the measured colors of all sides at once, 9 per color, with
+        # the voted colors of the centers.
+        indices, measured = indices[origin], measured[origin]
+        fixed = np.full(54, -1)
+        fixed[CENTERS] = indices[CENTERS]
+        indices, margins = color_detector.assign_colors(measured, fixed)
+
+        costs = espqbr_move_costs()
+        return {
+            'facelets': facelets_from_indices(indices),
+            'confidence': confidence[origin],
+            'margins': margins,
+            'sides': sides,
+            'rotations': sum(len(side['rotations']) for side in sides),
+            'total': time.perf_counter() - start,
+            'predicted': sum(costs[rotation] for side in sides for rotation in side['rotations']),
+            'firmware_predicted': costs['S'],
+        }
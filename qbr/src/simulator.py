@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+A stand-in for the EspQbr robot, to test and benchmark the path from a
+solution to the robot's last move without the hardware.
+
+The simulated robot handles the commands like EspQbr.ino (U, R, F, D, L and
+B with the ' and 2 modifiers, S to scan, T to test and the X and Z
+rotations), takes as long as the firmware's delays make the real one take and
+keeps track of the cube. It speaks the ascii and the binary protocol (see
+protocol.py) behind a localhost TCP socket or a pseudo terminal:
+
+    $ ./src/simulator.py --tcp 50001 --speed 100
+    $ ./src/qbr.py -r --remote-url tcp://127.0.0.1:50001
+
+Without an endpoint it prints the predicted time of a solution:
+
+    $ ./src/simulator.py --predict "R U2 F' D"
+"""
+
+import argparse
+import os
+import select
+import socket
+import threading
+import time
+import tty
+import cv2
+import numpy as np
+from cube import SOLVED_STATE, FACES, ROBOT_ROTATIONS, apply_moves, apply_permutation
+from colordetection import COLOR_FACES
+from planner import espqbr_move_costs
+from synthetic import generate_frame, random_frame_params, draw_background
+from protocol import (
+    PROTOCOLS,
+    FrameDecoder,
+    encode_frame,
+    decode_moves,
+    ProtocolError,
+    FRAME_MOVES,
+    FRAME_SYNC,
+    FRAME_ACK,
+    FRAME_NAK,
+    NAK_SEQUENCE,
+    NAK_UNKNOWN_MOVE
+)
+from constants import DEFAULT_ROBOT_PROTOCOL, ESPQBR_MAX_COMMANDS
+
+def predict_time(commands, costs=None):
+    """
+    Predict how long the robot takes for a solution.
+
+    :param commands: A list of commands or a string like "R U2 F'".
+    :param costs dict: Seconds per command, defaults to the EspQbr timing.
+    :returns: float seconds
+    """
+    if isinstance(commands, str):
+        commands = commands.split()
+    costs = costs or espqbr_move_costs()
+    return sum(costs.get(command, 0.0) for command in commands)
+
+class SimulatedRobot:
+    """
+    The command handling of the EspQbr firmware.
+
+    Like the firmware it handles one command at a time and only reads new
+    input in-between, so feed() blocks for as long as the commands take.
+    """
+
+    def __init__(self, protocol=DEFAULT_ROBOT_PROTOCOL, facelets=SOLVED_STATE, speed=1.0):
+        """
+        :param protocol str: A key of protocol.PROTOCOLS.
+        :param facelets str: The state of the cube in the grippers.
+        :param speed float: How many times faster than the real robot the
+                            commands are executed, 0 doesn't wait at all.
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError('unknown protocol: {}'.format(protocol))
+        self.protocol = protocol
+        self.facelets = facelets
+        self.speed = speed
+        self.costs = espqbr_move_costs()
+        # Modelled seconds of all executed commands.
+        self.elapsed = 0.0
+        self.commands = []
+        self.buffer = b''
+        self.decoder = FrameDecoder()
+        self.expected = None
+        self.completed = 0
+        self.moving = False
+        self.lock = threading.Lock()
+
+    @property
+    def solved(self):
+        """Whether every face has a single color, in any orientation."""
+        return all(len(set(self.facelets[start:start + 9])) == 1 for start in range(0, 54, 9))
+
+    def execute(self, command):
+        """Execute one command, e.g. "U'", and wait as long as the robot would."""
+        seconds = self.costs.get(command, 0.0)
+        self.moving = True
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        with self.lock:
+            if command[:1] in 'URFDLB' and command in self.costs:
+                # The regrips around a turn cancel out, only the turn is left.
+                self.facelets = apply_moves(self.facelets, [command])
+            elif command in ROBOT_ROTATIONS:
+                self.facelets = apply_permutation(self.facelets, ROBOT_ROTATIONS[command])
+            self.commands.append(command)
+            self.elapsed += seconds
+        self.moving = False
+
+    def feed(self, data, write):
+        """
+        Handle received bytes.
+
+        :param write: Called with the bytes of every response.
+        """
+        if self.protocol == 'ascii':
+            self.feed_lines(data, write)
+        else:
+            self.feed_frames(data, write)
+
+    def feed_lines(self, data, write):
+        """The firmware's start(): tokenize a line and execute its commands."""
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        for line in lines:
+            line = line.decode('utf-8', 'replace').rstrip('\r')
+            if not line:
+                continue
+            write('Received: {}\r\n'.format(line).encode('utf-8'))
+            tokens = line.split()
+            for token in tokens:
+                write('{}\r\n'.format(token).encode('utf-8'))
+            # Tokens beyond cmds[30] corrupt the firmware's memory, drop them.
+            for step, command in enumerate(tokens[:ESPQBR_MAX_COMMANDS], 1):
+                write('Step {} Cmd {}\r\n'.format(step, command).encode('utf-8'))
+                self.execute(command)
+                write('Completed Step {}\r\n'.format(step).encode('utf-8'))
+
+    def feed_frames(self, data, write):
+        """Handle frames as specified in EspQbr/PROTOCOL.md."""
+        frames = self.decoder.feed(data)
+        for _, reason in self.decoder.rejected:
+            write(encode_frame(FRAME_NAK, self.expected or 0, bytes([reason])))
+        self.decoder.rejected.clear()
+
+        for frame in frames:
+            if frame.type == FRAME_SYNC:
+                self.expected = (frame.seq + 1) & 0xffff
+                write(encode_frame(FRAME_ACK, frame.seq, self.completed.to_bytes(2, 'little')))
+            elif frame.type != FRAME_MOVES:
+                continue
+            elif frame.seq != self.expected:
+                write(encode_frame(FRAME_NAK, self.expected or 0, bytes([NAK_SEQUENCE])))
+            else:
+                try:
+                    commands = decode_moves(frame.payload)
+                except ProtocolError:
+                    write(encode_frame(FRAME_NAK, self.expected, bytes([NAK_UNKNOWN_MOVE])))
+                    continue
+                for command in commands:
+                    self.execute(command)
+                self.completed = frame.seq
+                self.expected = (frame.seq + 1) & 0xffff
+                write(encode_frame(FRAME_ACK, frame.seq))
+
+class SimulatedCamera:
+    """
+    A cv2.VideoCapture look-alike of a camera looking at the F side of the
+    cube in a simulated robot. Frames show the robot's current cube, or no
+    cube while the robot is moving, and are delivered at the camera's rate.
+    """
+
+    def __init__(self, robot, fps=30, seed=0, difficulty=0.5, shape=(480, 640, 3)):
+        self.robot = robot
+        self.interval = 1 / fps
+        self.rng = np.random.default_rng(seed)
+        self.difficulty = difficulty
+        self.shape = shape
+        self.next_frame = time.perf_counter()
+        # The color name of every face letter, e.g. 'F' -> 'green'.
+        self.colors = {face: color for color, face in COLOR_FACES.items()}
+
+    def isOpened(self):
+        return True
+
+    def read(self, image=None):
+        delay = self.next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame = max(self.next_frame, time.perf_counter() - self.interval) + self.interval
+        if self.robot.moving:
+            return True, draw_background(self.rng, self.shape)
+        with self.robot.lock:
+            front = self.robot.facelets[FACES.index('F') * 9:FACES.index('F') * 9 + 9]
+        stickers = [self.colors[face] for face in front]
+        frame, _ = generate_frame(self.rng, self.shape, stickers, **random_frame_params(self.rng, self.difficulty))
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.shape[1]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.shape[0]
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        pass
+
+class SimulatorServer:
+    """
+    Serve a simulated robot on a localhost TCP port, one connection at a time
+    like the ESP32. The robot keeps its state across connections.
+    """
+
+    def __init__(self, robot, host='127.0.0.1', port=0):
+        self.robot = robot
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.thread = None
+        self.running = False
+
+    @property
+    def url(self):
+        """The remote URL to connect to, e.g. tcp://127.0.0.1:50001."""
+        return 'tcp://{}:{}'.format(*self.server.getsockname())
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve(self):
+        while self.running:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                break
+            with connection:
+                try:
+                    while True:
+                        data = connection.recv(4096)
+                        if not data:
+                            break
+                        self.robot.feed(data, connection.sendall)
+                except OSError:
+                    pass
+
+    def close(self):
+        self.running = False
+        self.server.close()
+
+class PtySimulator:
+    """
+    Serve a simulated robot on a pseudo terminal, which stands in for the
+    ESP32's USB serial port.
+    """
+
+    def __init__(self, robot):
+        self.robot = robot
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.thread = None
+        self.running = False
+
+    @property
+    def url(self):
+        """The remote URL to connect to, e.g. serial:///dev/pts/3."""
+        return 'serial://{}'.format(os.ttyname(self.slave))
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self.master, data):]
+
+    def serve(self):
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            self.robot.feed(data, self.write)
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        os.close(self.master)
+        os.close(self.slave)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate the EspQbr robot.')
+    endpoint = parser.add_mutually_exclusive_group()
+    endpoint.add_argument('--tcp', type=int, metavar='PORT', help='serve on this localhost TCP port')
+    endpoint.add_argument('--pty', action='store_true', help='serve on a pseudo terminal')
+    endpoint.add_argument('--predict', metavar='SOLUTION', help='print the predicted time of a solution and exit')
+    parser.add_argument('--protocol', default=DEFAULT_ROBOT_PROTOCOL, choices=PROTOCOLS.keys())
+    parser.add_argument('--speed', type=float, default=1.0, help='how many times faster than the real robot')
+    parser.add_argument('--state', default=SOLVED_STATE, help='facelet string of the cube in the grippers')
+    args = parser.parse_args()
+
+    if args.predict is not None:
+        print('{:.2f} s'.format(predict_time(args.predict)))
+        raise SystemExit
+
+    robot = SimulatedRobot(args.protocol, args.state, args.speed)
+    simulator = PtySimulator(robot) if args.pty else SimulatorServer(robot, port=args.tcp or 0)
+    simulator.start()
+    print('Simulating EspQbr ({}) on {}'.format(args.protocol, simulator.url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+    print('{} commands, {:.2f} s, cube {}'.format(
+        len(robot.commands), robot.elapsed, 'solved' if robot.solved else 'not solved'))
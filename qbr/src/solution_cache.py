@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import kociemba
+from config import config
+from constants import (
+    SOLUTION_CACHE_SIZE,
+    SOLUTION_CACHE_DISK_SIZE,
+    DEFAULT_SOLUTION_CACHE_SIZE,
+    DEFAULT_SOLUTION_CACHE_DISK_SIZE,
+    SOLUTION_CACHE_FILENAME
+)
+
+class SolutionCache:
+    """
+    Memoize kociemba solutions by facelet string, in an in-memory LRU in front
+    of an SQLite database in the config directory, so scrambles that have been
+    solved before don't have to be solved again, not even after a restart.
+    """
+
+    def __init__(self, path=None, size=None, disk_size=None):
+        """
+        :param path str: The SQLite database, None keeps the cache in memory.
+        :param size int: The amount of solutions kept in memory, 0 disables
+                         the whole cache.
+        :param disk_size int: The amount of solutions kept on disk, the least
+                              recently used ones are evicted.
+        """
+        self.path = path
+        self.size = size if size is not None else DEFAULT_SOLUTION_CACHE_SIZE
+        self.disk_size = disk_size if disk_size is not None else DEFAULT_SOLUTION_CACHE_DISK_SIZE
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def connect(self):
+        """Open the database on first use, or None when there is no disk store."""
+        if self.connection is None and self.path is not None and self.disk_size > 0:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            # Only the last few writes can be lost on a power failure, but
+            # looking up a solution doesn't wait for the disk.
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS solutions ('
+                'facelets TEXT PRIMARY KEY, solution TEXT NOT NULL, last_used REAL NOT NULL)'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS solutions_last_used ON solutions (last_used)')
+            self.connection.commit()
+        return self.connection
+
+    def remember(self, facelets, solution):
+        """Put a solution in the memory LRU, evicting the oldest one if full."""
+        self.memory[facelets] = solution
+        self.memory.move_to_end(facelets)
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, facelets):
+        """
+        Look up the solution of a facelet string.
+
+        :returns: str The solution, or None if it isn't cached.
+        """
+        if self.size <= 0:
+            return None
+        with self.lock:
+            solution = self.memory.get(facelets)
+            if solution is not None:
+                self.memory.move_to_end(facelets)
+                self.memory_hits += 1
+                return solution
+
+            connection = self.connect()
+            if connection is not None:
+                row = connection.execute('SELECT solution FROM solutions WHERE facelets = ?', (facelets,)).fetchone()
+                if row is not None:
+                    connection.execute('UPDATE solutions SET last_used = ? WHERE facelets = ?', (time.time(), facelets))
+                    connection.commit()
+                    self.remember(facelets, row[0])
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, facelets, solution):
+        """Store a solution in memory and on disk."""
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.remember(facelets, solution)
+            connection = self.connect()
+            if connection is None:
+                return
+            connection.execute(
+                'INSERT OR REPLACE INTO solutions (facelets, solution, last_used) VALUES (?, ?, ?)',
+                (facelets, solution, time.time())
+            )
+            # Evict the least recently used solutions beyond the size bound.
+            cursor = connection.execute(
+                'DELETE FROM solutions WHERE facelets IN ('
+                'SELECT facelets FROM solutions ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.disk_size,)
+            )
+            self.evictions += max(cursor.rowcount, 0)
+            connection.commit()
+
+    def solve(self, facelets, solver=kociemba.solve):
+        """
+        Get the solution of a facelet string from the cache, or solve it and
+        cache the result. Invalid states raise the solver's exception and are
+        never cached.
+
+        :returns: str The solution in cube notation.
+        """
+        solution = self.get(facelets)
+        if solution is None:
+            solution = solver(facelets)
+            self.put(facelets, solution)
+        return solution
+
+    def summary(self):
+        """
+        Get the hit and miss counters.
+
+        :returns: dict
+        """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+def create_solution_cache():
+    """Create the solution cache of the config directory with the configured sizes."""
+    return SolutionCache(
+        os.path.join(config.config_dir, SOLUTION_CACHE_FILENAME),
+        config.get_setting(SOLUTION_CACHE_SIZE, DEFAULT_SOLUTION_CACHE_SIZE),
+        config.get_setting(SOLUTION_CACHE_DISK_SIZE, DEFAULT_SOLUTION_CACHE_DISK_SIZE)
+    )
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+import kociemba
+from cube import SOLVED_STATE, FaceletState, InvalidCubeState
+from constants import DEFAULT_SOLVE_TIMEOUT
+
+def solve_worker(tasks, results):
+    """
+    Worker process main: solve the facelet strings received through the tasks
+    queue. Results are (job id, solution, error message).
+    """
+    # Load the pruning tables before the first real job arrives.
+    try:
+        kociemba.solve(SOLVED_STATE)
+    except Exception:
+        pass
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, facelets = task
+        try:
+            results.put((job_id, kociemba.solve(facelets), None))
+        except Exception as e:
+            results.put((job_id, None, str(e)))
+
+class AsyncSolver:
+    """
+    Solve cubes in a worker process without blocking the caller.
+
+    submit() returns a concurrent.futures.Future which resolves to the
+    solution. Jobs are handled one at a time by a dispatcher thread: it looks
+    the state up in the solution cache, otherwise hands it to the worker
+    process, and finally runs the on_solved callback (e.g. to send the
+    solution to the robot) before resolving the future. A job that takes
+    longer than its timeout fails with a TimeoutError and the worker is
+    restarted.
+
+    With a planner (see planner.py) every job is solved by the planner's
+    worker processes instead, which choose among several candidate solutions.
+
+    Futures stay pending until they're done, so they can be cancel()ed at any
+    time. Cancelling a job which is being solved restarts the worker, but a
+    callback that already started runs to completion.
+    """
+
+    def __init__(self, solution_cache=None, timeout=DEFAULT_SOLVE_TIMEOUT, planner=None):
+        self.solution_cache = solution_cache
+        self.timeout = timeout
+        self.planner = planner
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.jobs = queue.Queue()
+        self.dispatcher = None
+        self.lock = threading.Lock()
+        self.next_job_id = 0
+        self.current = None
+
+    def start(self):
+        """Start the worker process and the dispatcher thread, if not running yet."""
+        with self.lock:
+            if self.planner is not None:
+                self.planner.start()
+            elif self.process is None:
+                self.start_worker()
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+                self.dispatcher.start()
+
+    def start_worker(self):
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.process = self.context.Process(target=solve_worker, args=(self.tasks, self.results), daemon=True)
+        self.process.start()
+
+    def restart_worker(self):
+        """Kill the worker, e.g. in the middle of a job, and start a new one."""
+        with self.lock:
+            self.process.terminate()
+            self.process.join()
+            # Don't wait for unsent items of the old queues at exit.
+            self.tasks.cancel_join_thread()
+            self.results.cancel_join_thread()
+            self.start_worker()
+
+    def submit(self, facelets, on_solved=None, timeout=None):
+        """
+        Queue a facelet string to be solved.
+
+        :param on_solved: Called with the solution in the dispatcher thread
+                          before the future resolves, unless cancelled.
+        :param timeout float: Seconds the worker may take, defaults to the
+                              timeout of the solver.
+        :returns: Future, failed with InvalidCubeState right away when no
+                  cube can be in the state
+        """
+        future = Future()
+        future.submitted_at = time.monotonic()
+        try:
+            FaceletState.from_facelets(facelets).validate()
+        except InvalidCubeState as e:
+            future.set_exception(e)
+            return future
+        self.start()
+        self.jobs.put((future, facelets, on_solved, timeout or self.timeout))
+        return future
+
+    def dispatch(self):
+        """Dispatcher thread main."""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, facelets, on_solved, timeout = job
+            if future.cancelled():
+                continue
+            self.current = future
+            # Planned solutions depend on the cost model, so they're cached
+            # apart from plain kociemba solutions.
+            key = facelets if self.planner is None else '{}:{}'.format(self.planner.key, facelets)
+            if self.planner is not None:
+                self.planner.last_summary = None
+            try:
+                solution = self.solution_cache.get(key) if self.solution_cache else None
+                if solution is None:
+                    solution = self.solve(future, facelets, timeout)
+                    if solution is None:
+                        continue
+                    if self.solution_cache:
+                        self.solution_cache.put(key, solution)
+                if future.cancelled():
+                    continue
+                if on_solved is not None:
+                    on_solved(solution)
+                future.set_result(solution)
+            except InvalidStateError:
+                # Cancelled in the meantime.
+                pass
+            except Exception as e:
+                try:
+                    future.set_exception(e)
+                except InvalidStateError:
+                    pass
+
+    def solve(self, future, facelets, timeout):
+        """
+        Solve a facelet string with the planner or the worker.
+
+        :returns: str The solution, or None when the job was cancelled.
+        """
+        if self.planner is None:
+            return self.solve_in_worker(future, facelets, timeout)
+        moves = self.planner.plan(facelets, timeout, future.cancelled)
+        return ' '.join(moves) if moves is not None else None
+
+    def solve_in_worker(self, future, facelets, timeout):
+        """
+        Let the worker solve a facelet string, while watching for the timeout
+        and cancellation.
+
+        :returns: str The solution, or None when the job was cancelled.
+        """
+        with self.lock:
+            self.next_job_id += 1
+            job_id = self.next_job_id
+        self.tasks.put((job_id, facelets))
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result_id, solution, error = self.results.get(timeout=0.05)
+            except queue.Empty:
+                result_id = None
+            if result_id == job_id:
+                if error is not None:
+                    raise ValueError(error)
+                return solution
+            if future.cancelled():
+                self.restart_worker()
+                return None
+            if not self.process.is_alive():
+                self.restart_worker()
+                raise RuntimeError('the solve worker stopped unexpectedly')
+            if time.monotonic() > deadline:
+                self.restart_worker()
+                raise TimeoutError('no solution after {} seconds'.format(timeout))
+
+    def close(self):
+        """Cancel all queued jobs and stop the dispatcher and the worker."""
+        with self.lock:
+            if self.dispatcher is None:
+                return
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job[0].cancel()
+        if self.current is not None:
+            self.current.cancel()
+        self.jobs.put(None)
+        self.dispatcher.join(timeout=1)
+        if self.planner is not None:
+            self.planner.close()
+        if self.process is not None:
+            self.tasks.put(None)
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.terminate()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import os
+import cv2
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+class ImageSequenceCapture:
+    """
+    A cv2.VideoCapture look-alike that reads the images of a directory in
+    alphabetical order, so an image folder can be used like a video file.
+    """
+
+    def __init__(self, directory):
+        self.paths = sorted(
+            os.path.join(directory, filename)
+            for filename in os.listdir(directory)
+            if filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        self.index = 0
+        self.width = 0
+        self.height = 0
+        if self.paths:
+            first = cv2.imread(self.paths[0])
+            if first is not None:
+                self.height, self.width = first.shape[:2]
+
+    def isOpened(self):
+        return len(self.paths) > 0
+
+    def read(self, image=None):
+        """Read the next image, returns (False, None) after the last one."""
+        while self.index < len(self.paths):
+            frame = cv2.imread(self.paths[self.index])
+            self.index += 1
+            if frame is None:
+                continue
+            if image is not None and image.shape == frame.shape:
+                image[...] = frame
+                return True, image
+            return True, frame
+        return False, None
+
+    def grab(self):
+        self.index += 1
+        return self.index <= len(self.paths)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.paths)
+        return 0
+
+    def set(self, prop, value):
+        """The size of the images can't be changed, like with video files."""
+        return False
+
+    def release(self):
+        self.paths = []
+
+def is_live_source(source):
+    """Whether the source is a camera index instead of a file or directory."""
+    return isinstance(source, int) or str(source).isdigit()
+
+def open_source(source):
+    """
+    Open a frame source: a camera index, a video file, a directory of images
+    or an already opened capture object, which is returned as is.
+
+    :returns: cv2.VideoCapture or a look-alike
+    """
+    if hasattr(source, 'read'):
+        return source
+    if is_live_source(source):
+        return cv2.VideoCapture(int(source))
+    if os.path.isdir(source):
+        return ImageSequenceCapture(source)
+    return cv2.VideoCapture(source)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Render synthetic frames of a cube face with known stickers, for benchmarks
+and regression runs without a webcam.
+"""
+
+import cv2
+import numpy as np
+from colordetection import color_detector
+
+# Sticker size and the gap in-between stickers at a scale of 1, in pixels of
+# a 640x480 frame.
+STICKER_SIZE = 40
+STICKER_GAP = 10
+
+def draw_background(rng, shape=(480, 640, 3), clutter=20):
+    """
+    Draw a noisy background with random rectangles as clutter.
+
+    :param clutter int: The amount of random rectangles.
+    """
+    frame = np.uint8(rng.integers(40, 80, shape))
+    height, width = shape[:2]
+    for _ in range(clutter):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        size = rng.integers(10, 80, 2)
+        cv2.rectangle(frame, (int(x), int(y)), (int(x + size[0]), int(y + size[1])), rng.integers(0, 256, 3).tolist(), -1)
+    return frame
+
+def face_transform(center, scale=1.0, angle=0.0, tilt=(0.0, 0.0)):
+    """
+    Get the homography which maps face coordinates, with (0, 0) in the center
+    of the face, onto the frame.
+
+    :param angle float: In-plane rotation in degrees.
+    :param tilt tuple: Perspective tilt around the x and y axis, as the
+                       relative amount one side of the face shrinks.
+    """
+    half = 1.5 * (STICKER_SIZE + STICKER_GAP)
+    source = np.float32([[-half, -half], [half, -half], [half, half], [-half, half]])
+    tilt_x, tilt_y = tilt
+    target = source * scale
+    target[[0, 1], 0] *= 1 - tilt_x
+    target[[2, 3], 0] *= 1 + tilt_x
+    target[[0, 3], 1] *= 1 - tilt_y
+    target[[1, 2], 1] *= 1 + tilt_y
+
+    theta = np.deg2rad(angle)
+    rotation = np.float32([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    target = target @ rotation.T + np.float32(center)
+    return cv2.getPerspectiveTransform(source, np.float32(target))
+
+def draw_face(frame, colors, center, scale=1.0, angle=0.0, tilt=(0.0, 0.0)):
+    """
+    Draw a cube face with 9 stickers of the given BGR colors onto the frame.
+
+    :returns: The bounding rectangles (x, y, w, h) of the 9 stickers, from the
+              top-left to the bottom-right.
+    """
+    transform = face_transform(center, scale, angle, tilt)
+    pitch = STICKER_SIZE + STICKER_GAP
+    half = 1.5 * pitch
+
+    def project(points):
+        return cv2.perspectiveTransform(np.float32([points]), transform)[0]
+
+    body = project([[-half, -half], [half, -half], [half, half], [-half, half]])
+    cv2.fillConvexPoly(frame, np.int32(np.round(body)), (0, 0, 0), cv2.LINE_AA)
+
+    rects = []
+    for index, color in enumerate(colors):
+        x1 = -half + (index % 3) * pitch + STICKER_GAP / 2
+        y1 = -half + (index // 3) * pitch + STICKER_GAP / 2
+        x2, y2 = x1 + STICKER_SIZE, y1 + STICKER_SIZE
+        corners = np.int32(np.round(project([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])))
+        cv2.fillConvexPoly(frame, corners, np.asarray(color, dtype=np.float64).tolist(), cv2.LINE_AA)
+        rects.append(cv2.boundingRect(corners))
+    return rects
+
+def generate_frame(rng, shape=(480, 640, 3), stickers=None, center=None, scale=1.0,
+                   angle=0.0, tilt=(0.0, 0.0), brightness=1.0, gradient=0.0,
+                   noise=0.0, blur=0.0, clutter=20, palette=None):
+    """
+    Render a frame with one cube face.
+
+    :param stickers: The 9 color names, random when None.
+    :param center: The center of the face in the frame, random when None.
+    :param brightness float: Multiplier of the whole frame.
+    :param gradient float: Lighting falling off from left to right, as the
+                           relative brightness lost at the right edge.
+    :param noise float: Standard deviation of gaussian pixel noise.
+    :param blur float: Sigma of a gaussian blur, 0 disables it.
+    :param clutter int: The amount of random rectangles in the background.
+    :param palette dict: Color name -> BGR, the detector's palette by default.
+    :returns: (frame, truth) where truth is a dict with the 'stickers' color
+              names and their 'rects'.
+    """
+    palette = palette or color_detector.cube_color_palette
+    names = list(palette.keys())
+    if stickers is None:
+        stickers = [names[i] for i in rng.integers(0, len(names), 9)]
+
+    height, width = shape[:2]
+    if center is None:
+        margin = 1.5 * (STICKER_SIZE + STICKER_GAP) * scale * 1.5
+        center = (rng.uniform(margin, width - margin), rng.uniform(margin, height - margin))
+
+    frame = draw_background(rng, shape, clutter)
+    rects = draw_face(frame, [palette[name] for name in stickers], center, scale, angle, tilt)
+
+    if brightness != 1.0 or gradient:
+        light = brightness * (1 - gradient * np.linspace(0, 1, width, dtype=np.float32))
+        frame = np.uint8(np.clip(frame * light[None, :, None], 0, 255))
+    if noise:
+        frame = np.uint8(np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255))
+    if blur:
+        frame = cv2.GaussianBlur(frame, (0, 0), blur)
+
+    return frame, {'stickers': list(stickers), 'rects': rects}
+
+def random_frame_params(rng, difficulty=1.0):
+    """
+    Draw random generate_frame parameters. A difficulty of 0 gives a clean,
+    frontal face, higher values add more pose, lighting and image variations.
+    """
+    return {
+        'scale': float(rng.uniform(1 - 0.15 * difficulty, 1 + 0.15 * difficulty)),
+        'angle': float(rng.normal(0, 3 * difficulty)),
+        'tilt': (float(rng.normal(0, 0.03 * difficulty)), float(rng.normal(0, 0.03 * difficulty))),
+        'brightness': float(rng.uniform(1 - 0.3 * difficulty, 1 + 0.1 * difficulty)),
+        'gradient': float(rng.uniform(0, 0.3 * difficulty)),
+        'noise': float(rng.uniform(0, 8 * difficulty)),
+        'blur': float(rng.uniform(0, 1.2 * difficulty)),
+        'clutter': int(rng.integers(0, 1 + 40 * difficulty)),
+    }
+
+class SyntheticCapture:
+    """
+    A cv2.VideoCapture look-alike which renders random frames, so the whole
+    Webcam pipeline can run on synthetic frames. The ground truth of the last
+    read frame is kept in self.truth.
+    """
+
+    def __init__(self, frames, seed=0, difficulty=1.0, shape=(480, 640, 3)):
+        self.rng = np.random.default_rng(seed)
+        self.frames = frames
+        self.difficulty = difficulty
+        self.shape = shape
+        self.index = 0
+        self.truth = None
+
+    def isOpened(self):
+        return True
+
+    def read(self, image=None):
+        if self.index >= self.frames:
+            return False, None
+        self.index += 1
+        frame, self.truth = generate_frame(self.rng, self.shape, **random_frame_params(self.rng, self.difficulty))
+        return True, frame
+
+    def grab(self):
+        return self.read()[0]
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.shape[1]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.shape[0]
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.frames
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        pass
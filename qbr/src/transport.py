@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Long-lived connections to the EspQbr robot and streaming of moves.
+
+Moves are sent one at a time, each in its own line (ascii protocol) or frame
+(binary protocol), so every acknowledgement belongs to exactly one move. See
+protocol.py.
+"""
+
+import socket
+import time
+from urllib.parse import urlparse, parse_qs
+import serial
+from protocol import PROTOCOLS, EVENT_ACK, EVENT_NAK
+from constants import (
+    DEFAULT_REMOTE_URL,
+    DEFAULT_ROBOT_WINDOW,
+    DEFAULT_ROBOT_PROTOCOL,
+    ROBOT_ACK_TIMEOUT,
+    ROBOT_CONNECT_TIMEOUT,
+    ROBOT_SERIAL_POLL,
+    ROBOT_RECONNECT_ATTEMPTS,
+    ROBOT_RECONNECT_DELAY,
+    ROBOT_SYNC_TIMEOUT
+)
+
+class TransportError(Exception):
+    """The robot can't be reached or the connection was lost."""
+
+class Transport:
+    """
+    A line based connection that is opened on first use and reopened
+    automatically after it failed.
+
+    Subclasses implement open(), close_connection(), write_bytes() and
+    read_bytes().
+    """
+
+    def __init__(self, reconnect_attempts=ROBOT_RECONNECT_ATTEMPTS, reconnect_delay=ROBOT_RECONNECT_DELAY):
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.connection = None
+        self.buffer = b''
+        self.connects = 0
+
+    def connect(self):
+        """Open the connection if needed, retrying with an increasing delay."""
+        if self.connection is not None:
+            return
+        for attempt in range(self.reconnect_attempts):
+            try:
+                self.connection = self.open()
+                self.buffer = b''
+                self.connects += 1
+                return
+            except OSError as e:
+                error = e
+                time.sleep(self.reconnect_delay * (2 ** attempt))
+        raise TransportError('cannot connect to {}: {}'.format(self, error))
+
+    def disconnect(self):
+        """Close the connection, the next write reconnects."""
+        if self.connection is not None:
+            try:
+                self.close_connection()
+            except OSError:
+                pass
+            self.connection = None
+
+    def write_line(self, line):
+        """Send a line, reconnecting once if the connection was lost."""
+        self.write((line + '\n').encode('utf-8'))
+
+    def write(self, data):
+        """Send bytes, reconnecting once if the connection was lost."""
+        self.connect()
+        try:
+            self.write_bytes(data)
+        except OSError:
+            self.disconnect()
+            self.connect()
+            try:
+                self.write_bytes(data)
+            except OSError as e:
+                self.disconnect()
+                raise TransportError('cannot write to {}: {}'.format(self, e))
+
+    def read_line(self, timeout):
+        """
+        Read the next line.
+
+        :returns: str The line without its line ending, or None on timeout.
+        """
+        self.connect()
+        deadline = time.monotonic() + timeout
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                self.buffer += self.read_bytes(remaining)
+            except OSError as e:
+                self.disconnect()
+                raise TransportError('connection to {} lost: {}'.format(self, e))
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line.decode('utf-8', 'replace').rstrip('\r')
+
+    def read(self, timeout):
+        """
+        Read whatever arrives first.
+
+        :returns: bytes, empty on timeout
+        """
+        self.connect()
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        try:
+            return self.read_bytes(timeout)
+        except OSError as e:
+            self.disconnect()
+            raise TransportError('connection to {} lost: {}'.format(self, e))
+
+    def close(self):
+        self.disconnect()
+
+class SerialTransport(Transport):
+    """A serial port, e.g. the ESP32's USB serial or a pty."""
+
+    def __init__(self, port, baudrate=115200, **kwargs):
+        super().__init__(**kwargs)
+        self.port = port
+        self.baudrate = baudrate
+
+    def __str__(self):
+        return 'serial://{}'.format(self.port)
+
+    def open(self):
+        connection = serial.Serial()
+        connection.port = self.port
+        connection.baudrate = self.baudrate
+        # Keep DTR and RTS low while opening, toggling them resets the ESP32.
+        connection.dtr = False
+        connection.rts = False
+        connection.timeout = ROBOT_SERIAL_POLL
+        connection.open()
+        return connection
+
+    def close_connection(self):
+        self.connection.close()
+
+    def write_bytes(self, data):
+        self.connection.write(data)
+        self.connection.flush()
+
+    def read_bytes(self, timeout):
+        # Setting the timeout reconfigures the port, so reads block for the
+        # ROBOT_SERIAL_POLL set on open instead, the callers read until their
+        # deadline anyway.
+        return self.connection.read(max(1, self.connection.in_waiting))
+
+class SocketTransport(Transport):
+    """A stream socket, TCP over WiFi or RFCOMM over Bluetooth."""
+
+    def __init__(self, address, family=socket.AF_INET, proto=0, **kwargs):
+        super().__init__(**kwargs)
+        self.address = address
+        self.family = family
+        self.proto = proto
+
+    def __str__(self):
+        scheme = 'bluetooth' if self.family != socket.AF_INET else 'tcp'
+        return '{}://{}:{}'.format(scheme, *self.address)
+
+    def open(self):
+        connection = socket.socket(self.family, socket.SOCK_STREAM, self.proto)
+        try:
+            connection.settimeout(ROBOT_CONNECT_TIMEOUT)
+            connection.connect(self.address)
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+    def close_connection(self):
+        self.connection.close()
+
+    def write_bytes(self, data):
+        self.connection.sendall(data)
+
+    def read_bytes(self, timeout):
+        self.connection.settimeout(timeout)
+        try:
+            data = self.connection.recv(4096)
+        except socket.timeout:
+            return b''
+        if not data:
+            raise ConnectionError('connection closed by the robot')
+        return data
+
+def open_transport(url=DEFAULT_REMOTE_URL):
+    """
+    Create the transport of a remote URL:
+
+        serial:///dev/ttyUSB0?baudrate=115200
+        tcp://192.168.4.1:50001
+        bluetooth://00:1f:e1:dd:08:3d:3
+
+    A plain path is a serial port. The connection is opened on first use.
+
+    :returns: Transport
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ('', 'serial'):
+        baudrate = int(parse_qs(parsed.query).get('baudrate', [115200])[0])
+        return SerialTransport(parsed.path, baudrate)
+    if parsed.scheme == 'tcp':
+        return SocketTransport((parsed.hostname, parsed.port))
+    if parsed.scheme == 'bluetooth':
+        address, channel = parsed.netloc.rsplit(':', 1)
+        return SocketTransport((address, int(channel)), socket.AF_BLUETOOTH, socket.BTPROTO_RFCOMM)
+    raise ValueError('unsupported remote URL: {}'.format(url))
+
+class RobotLink:
+    """
+    Stream moves to the robot over a transport with at most `window` moves
+    sent but not yet acknowledged, and measure how long every move took.
+
+    With the binary protocol every call of send_moves() starts with a SYNC
+    frame, so the robot and the link agree on the sequence numbers. When the
+    robot rejects a frame it drops all frames out of sequence, so the link
+    synchronizes again and sends all moves which aren't acknowledged yet once
+    more (go-back-N).
+    """
+
+    def __init__(self, transport, window=DEFAULT_ROBOT_WINDOW, ack_timeout=ROBOT_ACK_TIMEOUT,
+                 protocol=DEFAULT_ROBOT_PROTOCOL):
+        """
+        :param protocol str: A key of protocol.PROTOCOLS.
+        """
+        self.transport = transport
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.protocol = PROTOCOLS[protocol]()
+        self.seq = 0
+        self.cancelled = False
+        # (acknowledged, total) while moves are being sent, otherwise None.
+        self.progress = None
+        self.log = []
+
+    def cancel(self):
+        """Stop sending moves, the moves already sent are still awaited."""
+        self.cancelled = True
+
+    def read_events(self, timeout):
+        """
+        Wait for the next responses of the robot.
+
+        :returns: list of protocol.Event, empty on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.protocol.feed(self.transport.read(max(deadline - time.monotonic(), 0.001)))
+            self.log.extend(event.line for event in events)
+            if events or time.monotonic() >= deadline:
+                return events
+
+    def synchronize(self):
+        """
+        Make the robot expect the sequence number following a new one, if the
+        protocol supports it. Frames sent before are dropped by the robot and
+        their responses are skipped.
+
+        :returns: The sequence number of the last move the robot completed,
+                  or None if unknown.
+        :raises TransportError: when the robot doesn't acknowledge it
+        """
+        self.seq = (self.seq + 1) & 0xffff
+        frame = self.protocol.sync(self.seq)
+        if frame is None:
+            return None
+        for attempt in range(ROBOT_RECONNECT_ATTEMPTS):
+            self.transport.write(frame)
+            deadline = time.monotonic() + ROBOT_SYNC_TIMEOUT
+            while time.monotonic() < deadline:
+                for event in self.read_events(deadline - time.monotonic()):
+                    if event.kind == EVENT_ACK and event.seq == self.seq:
+                        return self.protocol.completed(event)
+        raise TransportError('the robot did not acknowledge SYNC {}'.format(self.seq))
+
+    def acknowledge(self, acked_at, done, total, on_progress):
+        """Mark the moves up to index `done` (exclusive) as acknowledged."""
+        while len(acked_at) < done:
+            acked_at.append(time.perf_counter())
+        self.progress = (len(acked_at), total)
+        if on_progress is not None:
+            on_progress(len(acked_at), total)
+
+    def send_moves(self, moves, on_progress=None):
+        """
+        Send the moves and wait until all of them have been acknowledged.
+
+        :param moves list: Moves or other commands, e.g. ['U', "R'", 'F2'].
+        :param on_progress: Called with (acknowledged, total) after every
+                            acknowledgement.
+        :returns: dict with the moves, per move latencies (acknowledged minus
+                  sent), per move actuation times (acknowledged minus the
+                  previous acknowledgement or its send time, whatever came
+                  last) and the total actuation time, all in seconds
+        :raises TransportError: when the robot is unreachable or stopped
+                                responding
+        """
+        self.cancelled = False
+        self.log = []
+        total = len(moves)
+        sent_at = []
+        seqs = []
+        acked_at = []
+        # Go-backs since the last acknowledgement.
+        resends = 0
+        self.progress = (0, total)
+        try:
+            self.synchronize()
+            while len(acked_at) < len(sent_at) or (len(sent_at) < total and not self.cancelled):
+                while len(sent_at) < total and len(sent_at) - len(acked_at) < self.window and not self.cancelled:
+                    self.seq = (self.seq + 1) & 0xffff
+                    self.transport.write(self.protocol.encode(moves[len(sent_at)], self.seq))
+                    seqs.append(self.seq)
+                    sent_at.append(time.perf_counter())
+
+                if len(acked_at) == len(sent_at):
+                    continue
+                events = self.read_events(self.ack_timeout)
+                rejected = False
+                for event in events:
+                    in_flight = seqs[len(acked_at):]
+                    if event.kind == EVENT_ACK and event.seq is None and in_flight:
+                        self.acknowledge(acked_at, len(acked_at) + 1, total, on_progress)
+                        resends = 0
+                    elif event.kind == EVENT_ACK and event.seq in in_flight:
+                        # The robot works in order, so an acknowledgement
+                        # implies the ones before, even if they got lost.
+                        self.acknowledge(acked_at, seqs.index(event.seq, len(acked_at)) + 1, total, on_progress)
+                        resends = 0
+                    elif event.kind == EVENT_NAK and in_flight and event.seq == in_flight[0]:
+                        # The robot dropped the oldest move in flight and
+                        # drops everything after it.
+                        rejected = True
+                if events and not rejected:
+                    continue
+
+                if not self.protocol.sequenced or resends == ROBOT_RECONNECT_ATTEMPTS:
+                    if rejected:
+                        raise TransportError('move {} ({}) rejected by the robot'.format(
+                            len(acked_at) + 1, moves[len(acked_at)]))
+                    raise TransportError('move {} ({}) not acknowledged within {} seconds'.format(
+                        len(acked_at) + 1, moves[len(acked_at)], self.ack_timeout))
+                # Go back to the oldest move in flight with new sequence
+                # numbers, skipping the moves the robot did complete.
+                resends += 1
+                completed = self.synchronize()
+                if completed in seqs[len(acked_at):]:
+                    self.acknowledge(acked_at, seqs.index(completed, len(acked_at)) + 1, total, on_progress)
+                del sent_at[len(acked_at):]
+                del seqs[len(acked_at):]
+        except TransportError as e:
+            raise TransportError('{} ({} of {} moves done)'.format(e, len(acked_at), total))
+        finally:
+            self.progress = None
+
+        latencies = [ack - sent for sent, ack in zip(sent_at, acked_at)]
+        actuation = [
+            ack - max(sent, acked_at[index - 1] if index else sent)
+            for index, (sent, ack) in enumerate(zip(sent_at, acked_at))
+        ]
+        return {
+            'moves': list(moves[:len(acked_at)]),
+            'latencies': latencies,
+            'actuation': actuation,
+            'total': acked_at[-1] - sent_at[0] if acked_at else 0.0,
+            'cancelled': len(acked_at) < total,
+        }
+
+    def close(self):
+        self.transport.close()
@@ -3,9 +3,30 @@
 # vim: fenc=utf-8 ts=4 sw=4 et
 
 import cv2
+import json
+import time
+import queue
+import threading
+import numpy as np
 from colordetection import color_detector
+from cube import FaceletState, InvalidCubeState
 from config import config
 from helpers import get_next_locale
+from detection import (
+    preprocess_frame,
+    find_contours,
+    detect_grid,
+    detect_grid_pyramid,
+    detection_scale,
+    sample_stickers,
+    GridTracker
+)
+from workers import DetectionPool
+from sources import open_source, is_live_source
+from pipeline import LatestQueue, PipelineStats, CaptureThread, ProcessingThread
+from profiler import profiler
+from overlay import OverlayCache
+from voting import StickerVotes
 import i18n
 
 from constants import (
@@ -15,6 +36,8 @@ from constants import (
     RESET_CUBE_KEY,
     ROOT_DIR,
     CUBE_PALETTE,
+    CAPTURE_RESOLUTION,
+    DEFAULT_CAPTURE_RESOLUTION,
     MINI_STICKER_AREA_TILE_SIZE,
     MINI_STICKER_AREA_TILE_GAP,
     MINI_STICKER_AREA_OFFSET,
@@ -24,6 +47,7 @@ from constants import (
     STICKER_AREA_OFFSET,
     STICKER_CONTOUR_COLOR,
     CALIBRATE_MODE_KEY,
+    PROFILER_OVERLAY_KEY,
     SWITCH_LANGUAGE_KEY,
     TEXT_SIZE,
     E_INCORRECTLY_SCANNED,
@@ -34,6 +58,10 @@ class Webcam:
 
     def reset(self):
         self.result_state = {}
+        self.measured_state = {}
+        self.preview_measured = None
+        self.preview_indices = None
+        self.preview_confidence = None
 
         self.snapshot_state = [(255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255),
@@ -41,21 +69,37 @@ class Webcam:
         self.preview_state  = [(255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255)]
+        self.votes.reset()
         self.calib_next = False
 
-    def __init__(self, qbr):
-        print('Starting webcam... (this might take a while, please be patient)')
-        self.cam = cv2.VideoCapture(2)
+    def __init__(self, qbr, source=2):
+        """
+        :param source: A camera index, a video file or a directory of images.
+        """
+        self.qbr = qbr
+        self.source = source
+        self.headless = qbr.headless
+        if not self.headless:
+            print('Starting webcam... (this might take a while, please be patient)')
+        self.cam = open_source(source)
         if not self.cam.isOpened():
             print("Cannot open camera")
             exit()
-        print('Webcam successfully started')
-        
-        self.qbr = qbr
+        if not self.headless:
+            print('Webcam successfully started')
 
         self.colors_to_calibrate = ['green', 'red', 'blue', 'orange', 'white', 'yellow']
-        self.average_sticker_colors = {}
+        self.votes = StickerVotes(qbr.vote_window, qbr.vote_confidence, len(color_detector.palette_names))
         self.result_state = {}
+        # The measured BGR colors of the scanned sides, before they were
+        # matched against the palette, see get_result_state.
+        self.measured_state = {}
+        self.preview_measured = None
+        # The palette indices the stickers of the last frame voted for and
+        # the vote confidence of every sticker's winner.
+        self.preview_indices = None
+        self.preview_confidence = None
+        self.result_margins = None
 
         self.snapshot_state = [(255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255),
@@ -63,13 +107,28 @@ class Webcam:
         self.preview_state  = [(255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255)]
-        self.calib_next = False                               
-
-        self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        self.calib_next = False
+        self.calibrate_requested = False
+        self.lock = threading.RLock()
+        self.solve_future = None
+
+        if is_live_source(source):
+            width, height = qbr.resolution or config.get_setting(CAPTURE_RESOLUTION, DEFAULT_CAPTURE_RESOLUTION)
+            self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
         self.width = int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
+        # Sticker sizes depend on the resolution. With the pyramid enabled the
+        # grid is found on a downscaled frame and refined at full resolution.
+        self.scale = detection_scale(self.width)
+        self.pyramid_width = qbr.pyramid_width
+        self.tracker = GridTracker(self.scale, self.full_search) if qbr.track else None
+
+        # The parts of the interface which only change on a key press or a
+        # scanned side, drawn once and composited onto every frame.
+        self.hud = OverlayCache(self.width, self.height)
+
         self.calibrate_mode = False
         self.calibrated_colors = {}
         self.current_color_to_calibrate_index = 0
@@ -120,125 +179,17 @@ class Webcam:
 
     def find_contours(self, dilatedFrame):
         """Find the contours of a 3x3x3 cube."""
-        contours, hierarchy = cv2.findContours(dilatedFrame, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        final_contours = []
-
-        # Step 1/4: filter all contours to only those that are square-ish shapes.
-        for contour in contours:
-            perimeter = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.1 * perimeter, True)
-            if len (approx) == 4:
-                area = cv2.contourArea(contour)
-                (x, y, w, h) = cv2.boundingRect(approx)
-
-                # Find aspect ratio of boundary rectangle around the countours.
-                ratio = w / float(h)
-
-                # Check if contour is close to a square.
-                if ratio >= 0.8 and ratio <= 1.2 and w >= 30 and w <= 60 and area / (w * h) > 0.4:
-                    final_contours.append((x, y, w, h))
-
-        # Return early if we didn't found 9 or more contours.
-        if len(final_contours) < 9:
-            return []
-
-        # Step 2/4: Find the contour that has 9 neighbors (including itself)
-        # and return all of those neighbors.
-        found = False
-        contour_neighbors = {}
-        for index, contour in enumerate(final_contours):
-            (x, y, w, h) = contour
-            contour_neighbors[index] = []
-            center_x = x + w / 2
-            center_y = y + h / 2
-            radius = 1.5
-
-            # Create 9 positions for the current contour which are the
-            # neighbors. We'll use this to check how many neighbors each contour
-            # has. The only way all of these can match is if the current contour
-            # is the center of the cube. If we found the center, we also know
-            # all the neighbors, thus knowing all the contours and thus knowing
-            # this shape can be considered a 3x3x3 cube. When we've found those
-            # contours, we sort them and return them.
-            neighbor_positions = [
-                # top left
-                [(center_x - w * radius), (center_y - h * radius)],
-
-                # top middle
-                [center_x, (center_y - h * radius)],
-
-                # top right
-                [(center_x + w * radius), (center_y - h * radius)],
-
-                # middle left
-                [(center_x - w * radius), center_y],
-
-                # center
-                [center_x, center_y],
-
-                # middle right
-                [(center_x + w * radius), center_y],
-
-                # bottom left
-                [(center_x - w * radius), (center_y + h * radius)],
-
-                # bottom middle
-                [center_x, (center_y + h * radius)],
-
-                # bottom right
-                [(center_x + w * radius), (center_y + h * radius)],
-            ]
-
-            for neighbor in final_contours:
-                (x2, y2, w2, h2) = neighbor
-                for (x3, y3) in neighbor_positions:
-                    # The neighbor_positions are located in the center of each
-                    # contour instead of top-left corner.
-                    # logic: (top left < center pos) and (bottom right > center pos)
-                    if (x2 < x3 and y2 < y3) and (x2 + w2 > x3 and y2 + h2 > y3):
-                        contour_neighbors[index].append(neighbor)
-
-        # Step 3/4: Now that we know how many neighbors all contours have, we'll
-        # loop over them and find the contour that has 9 neighbors, which
-        # includes itself. This is the center piece of the cube. If we come
-        # across it, then the 'neighbors' are actually all the contours we're
-        # looking for.
-        for (contour, neighbors) in contour_neighbors.items():
-            if len(neighbors) == 9:
-                found = True
-                final_contours = neighbors
-                break
-
-        if not found:
-            return []
-
-        # Step 4/4: When we reached this part of the code we found a cube-like
-        # contour. The code below will sort all the contours on their X and Y
-        # values from the top-left to the bottom-right.
-
-        # Sort contours on the y-value first.
-        y_sorted = sorted(final_contours, key=lambda item: item[1])
-
-        # Split into 3 rows and sort each row on the x-value.
-        top_row = sorted(y_sorted[0:3], key=lambda item: item[0])
-        middle_row = sorted(y_sorted[3:6], key=lambda item: item[0])
-        bottom_row = sorted(y_sorted[6:9], key=lambda item: item[0])
-
-        sorted_contours = top_row + middle_row + bottom_row
-        return sorted_contours
+        return find_contours(dilatedFrame, self.scale)
 
     def scanned_successfully(self):
-        """Validate if the user scanned 9 colors for each side."""
-        color_count = {}
-        for side, preview in self.result_state.items():
-            for bgr in preview:
-                key = str(bgr)
-                if not key in color_count:
-                    color_count[key] = 1
-                else:
-                    color_count[key] = color_count[key] + 1
-        invalid_colors = [k for k, v in color_count.items() if v != 9]
-        return len(invalid_colors) == 0
+        """Validate if the user scanned all sides and a cube can be in that state."""
+        if len(self.result_state.keys()) != 6:
+            return False
+        try:
+            self.get_result_state().validate()
+        except InvalidCubeState:
+            return False
+        return True
 
     def draw_contours(self, frame, contours):
         """Draw contours onto the given frame."""
@@ -250,50 +201,68 @@ class Webcam:
             for index, (x, y, w, h) in enumerate(contours):
                 cv2.rectangle(frame, (x, y), (x + w, y + h), STICKER_CONTOUR_COLOR, 2)
 
-    def update_preview_state(self, frame, contours):
-        """
-        Get the average color value for the contour for every X amount of frames
-        to prevent flickering and more precise results.
-        """
-        max_average_rounds = 8
-        for index, (x, y, w, h) in enumerate(contours):
-            if index in self.average_sticker_colors and len(self.average_sticker_colors[index]) == max_average_rounds:
-                sorted_items = {}
-                for bgr in self.average_sticker_colors[index]:
-                    key = str(bgr)
-                    if key in sorted_items:
-                        sorted_items[key] += 1
-                    else:
-                        sorted_items[key] = 1
-                most_common_color = max(sorted_items, key=lambda i: sorted_items[i])
-                self.average_sticker_colors[index] = []
-                self.preview_state[index] = eval(most_common_color)
-                break
+    def sample_stickers(self, frame, contours):
+        """Gather the pixels of all 9 sticker regions, see detection.sample_stickers."""
+        return sample_stickers(frame, contours, self.scale)
 
-            roi = frame[y+7:y+h-7, x+14:x+w-14]
-            avg_bgr = color_detector.get_dominant_color(roi)
-            closest_color = color_detector.get_closest_color(avg_bgr)['color_bgr']
-            self.preview_state[index] = closest_color
-            if index in self.average_sticker_colors:
-                self.average_sticker_colors[index].append(closest_color)
-            else:
-                self.average_sticker_colors[index] = [closest_color]
+    def get_sticker_colors(self, frame, contours, dominant_colors=None):
+        """
+        Get the closest palette color of all 9 stickers at once.
+
+        :param dominant_colors: The already estimated dominant colors of the
+                                stickers, e.g. by a detection worker.
+        :returns: numpy array of indices into color_detector.palette_names
+        """
+        if dominant_colors is None:
+            dominant_colors = color_detector.get_dominant_colors(self.sample_stickers(frame, contours))
+        return color_detector.get_closest_color_indices(dominant_colors)
+
+    def update_preview_state(self, frame, contours, dominant_colors=None):
+        """
+        Show the color every sticker had most often in the last frames, to
+        prevent flickering and get more precise results.
+        """
+        if dominant_colors is None:
+            dominant_colors = color_detector.get_dominant_colors(self.sample_stickers(frame, contours))
+        self.preview_measured = np.array(dominant_colors, dtype=np.float64)
+        self.preview_indices = self.get_sticker_colors(frame, contours, dominant_colors)
+        winners, self.preview_confidence = self.votes.vote(self.preview_indices)
+        palette = color_detector.cube_color_palette
+        self.preview_state = [palette[color_detector.palette_names[index]] for index in winners]
 
     def update_snapshot_state(self, frame):
         """Update the snapshot state based on the current preview state."""
         self.snapshot_state = list(self.preview_state)
         center_color_name = color_detector.get_closest_color(self.snapshot_state[4])['color_name']
         self.result_state[center_color_name] = self.snapshot_state
+        self.update_measured_state(center_color_name)
         self.draw_snapshot_stickers(frame)
 
+    def update_measured_state(self, side):
+        """Keep the measured colors of a just scanned side."""
+        if self.preview_measured is None:
+            self.measured_state.pop(side, None)
+        else:
+            self.measured_state[side] = self.preview_measured
+
     def auto_update_snapshot_state(self, frame):
-        """Update the snapshot state based on the current preview state."""
+        """
+        Update the snapshot state based on the current preview state, once the
+        votes of all stickers are confident enough.
+
+        :returns: str The name of the captured side, or None.
+        """
+        if not self.votes.stable:
+            return None
         self.snapshot_state = list(self.preview_state)
         center_color_name = color_detector.get_closest_color(self.snapshot_state[4])['color_name']
         if center_color_name not in self.result_state:
                 self.result_state[center_color_name] = self.snapshot_state
-                self.draw_snapshot_stickers(frame)
+                self.update_measured_state(center_color_name)
+                if frame is not None:
+                    self.draw_snapshot_stickers(frame)
                 #self.calib_next = True
+                return center_color_name
 
     def get_freetype2_font(self):
         """Get the freetype2 font, load it and return it."""
@@ -375,9 +344,12 @@ class Webcam:
 
     def reset_calibrate_mode(self):
         """Reset calibrate mode variables."""
+        self.calibrate_requested = False
         self.calibrated_colors = {}
         self.current_color_to_calibrate_index = 0
         self.done_calibrating = False
+        # The palette indices of the votes may refer to other colors now.
+        self.votes.reset()
 
     def draw_current_language(self, frame):
         # text = '{}: {}'.format(
@@ -394,6 +366,7 @@ class Webcam:
         self.render_text(frame, '(c)alibrate', (self.width - 100, 30), fontScale=0.6)
         self.render_text(frame, '(s)olve',     (self.width - 100, 45), fontScale=0.6)
         self.render_text(frame, '(r)eset',     (self.width - 100, 60), fontScale=0.6)
+        self.render_text(frame, '(p)rofiler',  (self.width - 100, 75), fontScale=0.6)
 
     def draw_2d_cube_state(self, frame):
         """
@@ -468,118 +441,244 @@ class Webcam:
                         -1
                     )
 
+    def get_result_state(self):
+        """
+        Get the scanned colors of all sides as a FaceletState. The measured
+        colors of all sides are assigned to the palette colors at once, 9
+        facelets per color, and the margin of every facelet is kept in
+        self.result_margins. Sides without measured colors, e.g. of the saved
+        state, use their palette colors.
+        """
+        sides = {side: self.measured_state.get(side, colors) for side, colors in self.result_state.items()}
+        faces, self.result_margins = color_detector.assign_sides_to_faces(sides)
+        return FaceletState(faces)
+
     def get_result_notation(self):
         """Convert all the sides and their BGR colors to cube notation."""
-        notation = dict(self.result_state)
-        for side, preview in notation.items():
-            for sticker_index, bgr in enumerate(preview):
-                notation[side][sticker_index] = color_detector.convert_bgr_to_notation(bgr)
-
-        # Join all the sides together into one single string.
-        # Order must be URFDLB (white, red, green, yellow, orange, blue)
-        combined = ''
-        for side in ['white', 'red', 'green', 'yellow', 'orange', 'blue']:
-            combined += ''.join(notation[side])
-        return combined
+        return self.get_result_state().to_facelets()
 
     def state_already_solved(self):
         """Find out if the cube hasn't been solved already."""
         if len(self.result_state.keys()) != 6:
             return False
-
-        for side in ['white', 'red', 'green', 'yellow', 'orange', 'blue']:
-            # Get the center color of the current side.
-            center_bgr = self.result_state[side][4]
-
-            # Compare the center color to all neighbors. If we come across a
-            # different color, then we can assume the cube isn't solved yet.
-            for bgr in self.result_state[side]:
-                if center_bgr != bgr:
-                    return False
-        return True
+        return self.get_result_state().solved
 
     def start_solve(self):
         if len(self.result_state.keys()) != 6:
             print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('haventScannedAllSides')))
             return
 
-        if not self.scanned_successfully():
-            print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('haventScannedAllSides')))
+        # Reject impossible scans right away, with the reason, instead of
+        # letting kociemba fail on them.
+        state = self.get_result_state()
+        try:
+            state.validate()
+        except InvalidCubeState as e:
+            print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('invalidState.{}'.format(e.reason))))
             return
 
-        if self.state_already_solved():
+        if state.solved:
             print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('cubeAlreadySolved')))
             return
 
         else:
-            note = self.get_result_notation()
-            self.qbr.solve_cube(note)
+            note = state.to_facelets()
+            self.solve_future = self.qbr.solve_async(note)
+            self.solve_future.add_done_callback(self.print_solve_error)
             return
 
-    def run(self):
+    def print_solve_error(self, future):
+        """Print why a solve failed, done callback of the solve future."""
+        if not future.cancelled() and future.exception() is not None:
+            print("Exception: {0}".format(future.exception()))
+
+    def cancel_solve(self):
+        """Cancel the running solve, if any."""
+        if self.solve_future is not None:
+            self.solve_future.cancel()
+        if self.qbr.robot is not None:
+            self.qbr.robot.cancel()
+
+    def get_solve_status(self):
         """
-        Open up the webcam and present the user with the Qbr user interface.
+        Get the status of the last solve to display.
 
-        Returns a string of the scanned state in rubik's cube notation.
+        :returns: str or None when nothing has been solved yet
         """
-        while True:
-            ret, frame = self.cam.read()
-            if not ret:
-               continue
-            grayFrame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            blurredFrame = cv2.blur(grayFrame, (3, 3))
-            cannyFrame = cv2.Canny(blurredFrame, 30, 60, 3)
-            kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
-            dilatedFrame = cv2.dilate(cannyFrame, kernel)
+        future = self.solve_future
+        if future is None:
+            return None
+        if future.cancelled():
+            return i18n.t('solveStatus.cancelled')
+        progress = self.qbr.robot.progress if self.qbr.robot is not None else None
+        if not future.done() and progress is not None:
+            return i18n.t('solveStatus.moving', done=progress[0], total=progress[1])
+        if not future.done():
+            seconds = '{:.1f}'.format(time.monotonic() - future.submitted_at)
+            return i18n.t('solveStatus.solving', seconds=seconds)
+        error = future.exception()
+        if isinstance(error, TimeoutError):
+            return i18n.t('solveStatus.timedOut')
+        if error is not None:
+            return i18n.t('solveStatus.failed')
+        return i18n.t('solveStatus.solved', moves=len(future.result().split()))
+
+    def draw_solve_status(self, frame):
+        """Display the status of the last solve above the scanned sides."""
+        text = self.get_solve_status()
+        if text is not None:
+            self.render_text(frame, text, (20, self.height - 45), bottomLeftOrigin=True)
+
+    def preprocess(self, frame):
+        """Turn a frame into a dilated edge map for find_contours."""
+        return preprocess_frame(frame, self.scale)
+
+    def detect(self, frame):
+        """Find the contours of the 9 stickers in a frame, or []."""
+        if self.tracker is not None:
+            return self.tracker.detect(frame)
+        return self.full_search(frame)
+
+    def full_search(self, frame):
+        """Search the whole frame for the 9 stickers."""
+        if self.pyramid_width:
+            return detect_grid_pyramid(frame, self.scale, self.pyramid_width)
+        return detect_grid(frame, self.scale)
+
+    def print_tracking_summary(self):
+        """Print how many frames were served by tracking and what they cost."""
+        if self.tracker is None:
+            return
+        for name, value in self.tracker.summary().items():
+            print('tracking {}: {}'.format(name, value))
 
-            contours = self.find_contours(dilatedFrame)
+    def process_frame(self, frame, contours, dominant_colors=None):
+        """
+        Update the preview state, or take the calibration sample when one has
+        been requested, based on the detected contours. This must be called
+        before anything is drawn onto the frame.
+        """
+        if len(contours) != 9:
+            return
+
+        with self.lock:
+            if not self.calibrate_mode:
+                with profiler.stage('update_preview_state'):
+                    self.update_preview_state(frame, contours, dominant_colors)
+            elif self.calibrate_requested and self.done_calibrating == False:
+                self.calibrate_requested = False
+                current_color = self.colors_to_calibrate[self.current_color_to_calibrate_index]
+                (x, y, w, h) = contours[4]
+                margin_x, margin_y = int(14 * self.scale), int(7 * self.scale)
+                roi = frame[y+margin_y:y+h-margin_y, x+margin_x:x+w-margin_x]
+                avg_bgr = color_detector.get_dominant_color(roi)
+                self.calibrated_colors[current_color] = avg_bgr
+                self.current_color_to_calibrate_index += 1
+                self.done_calibrating = self.current_color_to_calibrate_index == len(self.colors_to_calibrate)
+                if self.done_calibrating:
+                    color_detector.set_cube_color_pallete(self.calibrated_colors)
+                    config.set_setting(CUBE_PALETTE, color_detector.cube_color_palette)
+
+    def get_hud_key(self):
+        """
+        Get everything the cached interface layer depends on, so it's redrawn
+        whenever one of them changes.
+
+        :returns: tuple
+        """
+        if self.calibrate_mode:
+            return (
+                True,
+                i18n.get('locale'),
+                self.current_color_to_calibrate_index,
+                self.done_calibrating,
+                tuple((name, tuple(int(c) for c in bgr)) for name, bgr in self.calibrated_colors.items()),
+            )
+        return (
+            False,
+            i18n.get('locale'),
+            tuple(tuple(bgr) for bgr in self.snapshot_state),
+            tuple(sorted((side, tuple(tuple(bgr) for bgr in stickers)) for side, stickers in self.result_state.items())),
+            tuple(color_detector.cube_color_palette.items()),
+        )
+
+    def draw_hud(self, frame):
+        """Draw the interface that doesn't follow the camera onto the frame."""
+        if self.calibrate_mode:
+            self.draw_current_color_to_calibrate(frame)
+            self.draw_calibrated_colors(frame)
+        else:
+            self.draw_keys(frame)
+            self.draw_snapshot_stickers(frame)
+            self.draw_scanned_sides(frame)
+            self.draw_2d_cube_state(frame)
+
+    def draw_interface(self, frame, contours):
+        """Draw the contours and the user interface onto the given frame."""
+        with profiler.stage('draw'):
             if len(contours) == 9:
                 self.draw_contours(frame, contours)
-                if not self.calibrate_mode:
-                    self.update_preview_state(frame, contours)
-                elif key == 32 and self.done_calibrating == False:
-                    current_color = self.colors_to_calibrate[self.current_color_to_calibrate_index]
-                    (x, y, w, h) = contours[4]
-                    roi = frame[y+7:y+h-7, x+14:x+w-14]
-                    avg_bgr = color_detector.get_dominant_color(roi)
-                    self.calibrated_colors[current_color] = avg_bgr
-                    self.current_color_to_calibrate_index += 1
-                    self.done_calibrating = self.current_color_to_calibrate_index == len(self.colors_to_calibrate)
-                    if self.done_calibrating:
-                        color_detector.set_cube_color_pallete(self.calibrated_colors)
-                        config.set_setting(CUBE_PALETTE, color_detector.cube_color_palette)
 
-            if self.calibrate_mode:
-                self.draw_current_color_to_calibrate(frame)
-                self.draw_calibrated_colors(frame)
-            else:
-                self.draw_keys(frame)
+            with self.lock:
+                self.hud.update(self.get_hud_key(), self.draw_hud)
+            self.hud.composite(frame)
+
+            if not self.calibrate_mode:
                 self.draw_preview_stickers(frame)
-                self.draw_snapshot_stickers(frame)
-                self.draw_scanned_sides(frame)
-                self.draw_2d_cube_state(frame)
+                self.draw_solve_status(frame)
+
+        if profiler.overlay:
+            profiler.draw_overlay(frame)
 
+    def show(self, frame):
+        """Display a frame in the Qbr window."""
+        with profiler.stage('imshow'):
             cv2.imshow("Qbr - Rubik's cube solver", frame)
 
-            key = cv2.waitKey(10) & 0xff
+    def wait_key(self, delay):
+        """
+        Wait for a key press like cv2.waitKey and dump the profiler
+        statistics when they are due.
 
-            # Quit on escape.
-            if key == 27:
-                break
+        :returns: int The key code, 255 when no key was pressed.
+        """
+        with profiler.stage('waitKey'):
+            key = cv2.waitKey(delay) & 0xff
+        profiler.maybe_dump()
+        return key
+
+    def close_profiler(self):
+        """Write the final profiler statistics when dumping to a file."""
+        if profiler.dump_path is not None:
+            profiler.dump()
+
+    def handle_key(self, key, frame):
+        """
+        Handle a key press of the user.
+
+        :returns: bool False when the user wants to quit
+        """
+        if self.quit_requested(key):
+            return False
 
+        with self.lock:
             if key == ord(SOLVE_CUBE_KEY):
-                
-                #self.qbr.send_to_remote_serial("U B")
+
+                #self.qbr.send_to_robot("U B")
                 if not self.calibrate_mode:
                     config.set_setting(CUBE_SAVED_STATE, self.result_state)
                     self.start_solve()
                     self.reset()
 
-            if not self.calibrate_mode:
+            if self.calibrate_mode:
+                # Take a calibration sample of the next frame with a cube.
+                if key == 32:
+                    self.calibrate_requested = True
+            else:
                 # Update the snapshot when space bar is pressed.
                 if key == 32:
                     self.update_snapshot_state(frame)
-                
+
                 if(self.qbr.autoscan):
                     self.auto_update_snapshot_state(frame)
 
@@ -589,18 +688,231 @@ class Webcam:
                 #     config.set_setting('locale', next_locale)
                 #     i18n.set('locale', next_locale)
 
+            if key == ord(PROFILER_OVERLAY_KEY):
+                profiler.toggle_overlay()
+
             # Toggle calibrate mode.
             if key == ord(CALIBRATE_MODE_KEY):
                 self.reset_calibrate_mode()
                 self.calibrate_mode = not self.calibrate_mode
 
             if key == ord(RESET_CUBE_KEY):
-                self.reset()             
+                self.cancel_solve()
+                self.reset()
+        return True
+
+    def quit_requested(self, key):
+        """Whether the user pressed escape or closed the window."""
+        return key == 27 or cv2.getWindowProperty("Qbr - Rubik's cube solver", 0) == -1
 
-            # Exit on window close
-            if cv2.getWindowProperty("Qbr - Rubik's cube solver", 0) == -1:
+    def run(self):
+        """
+        Open up the webcam and present the user with the Qbr user interface.
+
+        Returns a string of the scanned state in rubik's cube notation.
+        """
+        if self.qbr.workers:
+            self.run_multiprocess(self.qbr.workers)
+            return
+
+        if self.qbr.threaded:
+            self.run_threaded()
+            return
+
+        while True:
+            with profiler.stage('capture'):
+                ret, frame = self.cam.read()
+            if not ret:
+               continue
+
+            contours = self.detect(frame)
+            self.process_frame(frame, contours)
+            self.draw_interface(frame, contours)
+
+            self.show(frame)
+
+            key = self.wait_key(10)
+            if not self.handle_key(key, frame):
                 break
 
+        self.cam.release()
+        cv2.destroyAllWindows()
+        self.print_tracking_summary()
+        self.close_profiler()
+
+    def run_threaded(self):
+        """
+        Run the user interface with capturing, processing and displaying in
+        their own stage.
+
+        A capture thread reads the camera as fast as it delivers frames and
+        only keeps the newest one, a processing thread detects and classifies
+        the newest captured frame and the UI (this thread) displays the newest
+        processed frame at its own render rate. Frame counters and latencies
+        are printed on exit.
+        """
+        stats = PipelineStats()
+        capture_queue = LatestQueue()
+        result_queue = LatestQueue()
+        capture = CaptureThread(self.cam, capture_queue, stats)
+        processing = ProcessingThread(self, capture_queue, result_queue, stats)
+        capture.start()
+        processing.start()
+
+        render_interval = max(1, int(1000 / self.qbr.render_fps))
+        frame = None
+        while True:
+            item = result_queue.get(timeout=0 if frame is not None else 0.1)
+            if item is not None:
+                _, captured_at, frame, contours = item
+                self.draw_interface(frame, contours)
+                self.show(frame)
+                stats.add_latency(time.perf_counter() - captured_at)
+
+            key = self.wait_key(render_interval)
+            if frame is not None and not self.handle_key(key, frame):
+                break
+
+        capture.stop()
+        processing.stop()
+        capture.join()
+        processing.join()
+        self.cam.release()
+        cv2.destroyAllWindows()
+
+        for name, value in stats.summary(capture_queue, result_queue).items():
+            print('{}: {}'.format(name, value))
+        self.print_tracking_summary()
+        self.close_profiler()
+
+    def capture_into_ring(self, pool, submitted, stats):
+        """
+        Capture thread of run_multiprocess: read camera frames straight into
+        free slots of the shared frame ring and submit them to the workers.
+        When all slots are busy the frame is dropped. The thread ends with
+        the frames of a video file or image directory, cameras may stall.
+        """
+        while self.capturing:
+            slot = pool.acquire()
+            if slot is None:
+                if not self.cam.grab() and not is_live_source(self.source):
+                    break
+                stats.count('dropped')
+                continue
+
+            with profiler.stage('capture'):
+                ret, frame = self.cam.read(pool.ring.frames[slot])
+            if not ret:
+                pool.release(slot)
+                if not is_live_source(self.source):
+                    break
+                continue
+            if not np.shares_memory(frame, pool.ring.frames[slot]):
+                pool.ring.frames[slot] = frame
+            stats.count('captured')
+            submitted.put(time.perf_counter())
+            pool.submit(slot)
+
+    def run_multiprocess(self, workers):
+        """
+        Run the user interface with detection in a pool of worker processes.
+
+        Frames are captured into a shared memory ring, the workers find the
+        contours and dominant sticker colors and the results are handled here
+        in the order the frames were captured.
+        """
+        pool = DetectionPool(workers, (self.height, self.width, 3), self.scale, self.pyramid_width)
+        stats = PipelineStats()
+        submitted = queue.Queue()
+        self.capturing = True
+        capture = threading.Thread(target=self.capture_into_ring, args=(pool, submitted, stats), daemon=True)
+        capture.start()
 
+        while True:
+            result = pool.get(timeout=0.1)
+            if result is None:
+                # No frames arrive, keep handling escape and window close.
+                if self.quit_requested(self.wait_key(1)):
+                    break
+                if not capture.is_alive() and submitted.empty():
+                    break
+                continue
+            _, slot, contours, dominant_colors = result
+            frame = pool.ring.frames[slot]
+            self.process_frame(frame, contours, dominant_colors)
+            stats.count('processed')
+            self.draw_interface(frame, contours)
+            self.show(frame)
+            stats.add_latency(time.perf_counter() - submitted.get())
+
+            key = self.wait_key(1)
+            running = self.handle_key(key, frame)
+            pool.release(slot)
+            if not running:
+                break
+
+        self.capturing = False
+        capture.join()
+        pool.close()
         self.cam.release()
         cv2.destroyAllWindows()
+
+        latencies = np.array(stats.latencies) * 1000
+        print('captured: {}'.format(stats.captured))
+        print('processed: {}'.format(stats.processed))
+        print('dropped: {}'.format(stats.dropped))
+        if len(latencies):
+            print('latency_mean_ms: {}'.format(latencies.mean()))
+        self.close_profiler()
+
+    def run_headless(self, output):
+        """
+        Run the detection and classification pipeline over all frames of the
+        source without a user interface, as fast as possible.
+
+        Every frame is written to output as a JSON line with whether the grid
+        was found, the 9 sticker colors the frame voted for and the vote
+        confidence of every sticker, see StickerVotes. Faces are
+        captured automatically like with autoscan, the last line contains the
+        facelet string once all 6 sides have been scanned.
+
+        :param output: A writable text file.
+        :returns: str The facelet string, or None if not all sides were found.
+        """
+        frames = 0
+        start = time.perf_counter()
+        while True:
+            ret, frame = self.cam.read()
+            if not ret:
+                break
+
+            contours = self.detect(frame)
+            line = {'source': str(self.source), 'frame': frames, 'grid': len(contours) == 9}
+            if len(contours) == 9:
+                self.process_frame(frame, contours)
+                line['colors'] = [color_detector.palette_names[index] for index in self.preview_indices]
+                line['confidence'] = [round(float(c), 4) for c in self.preview_confidence]
+                line['stable'] = self.votes.stable
+                line['captured'] = self.auto_update_snapshot_state(None)
+            output.write(json.dumps(line) + '\n')
+            frames += 1
+            profiler.maybe_dump()
+
+        self.cam.release()
+        self.close_profiler()
+        elapsed = time.perf_counter() - start
+
+        facelets = margins = None
+        if self.scanned_successfully():
+            facelets = self.get_result_notation()
+            margins = [round(float(m), 4) if np.isfinite(m) else None for m in self.result_margins]
+        output.write(json.dumps({
+            'source': str(self.source),
+            'frames': frames,
+            'fps': round(frames / elapsed, 2) if elapsed else None,
+            'sides': sorted(self.result_state.keys()),
+            'facelets': facelets,
+            'margins': margins,
+        }) + '\n')
+        output.flush()
+        return facelets
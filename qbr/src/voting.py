@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import numpy as np
+
+class StickerVotes:
+    """
+    Majority voting over the palette colors the stickers had in the last
+    `window` frames, to prevent flickering of the preview.
+
+    The votes are a (stickers x window) ring of palette indices and the
+    counts of every color per sticker are updated with the vote that enters
+    and the vote that leaves the ring, so a frame costs the same for any
+    window. A sticker's confidence is the share of the whole window that
+    voted for its color, and the face is stable once every sticker's
+    confidence reached the threshold.
+    """
+
+    def __init__(self, window, threshold, colors=6, stickers=9):
+        """
+        :param window int: Amount of frames to vote over.
+        :param threshold float: Confidence from which a sticker is stable.
+        :param colors int: Amount of palette colors.
+        """
+        self.window = max(1, window)
+        self.threshold = threshold
+        self.rows = np.arange(stickers)
+        # Index of every sticker's first color in the flattened counts.
+        self.offsets = self.rows * colors
+        self.ring = np.zeros((stickers, self.window), dtype=np.intp)
+        self.counts = np.zeros((stickers, colors), dtype=np.intp)
+        self.reset()
+
+    def reset(self):
+        """Forget all votes."""
+        self.ring.fill(0)
+        self.counts.fill(0)
+        self.position = 0
+        self.frames = 0
+        self.winners = np.zeros(len(self.rows), dtype=np.intp)
+        self.confidence = np.zeros(len(self.rows))
+
+    def vote(self, indices):
+        """
+        Add the palette indices of the stickers in a frame.
+
+        :param indices: The palette index of every sticker.
+        :returns: (winners, confidence) numpy arrays, the color with the most
+                  votes of every sticker and its share of the window.
+        """
+        counts = self.counts.reshape(-1)
+        column = self.ring[:, self.position]
+        if self.frames >= self.window:
+            counts[self.offsets + column] -= 1
+        column[:] = indices
+        counts[self.offsets + column] += 1
+        self.position = (self.position + 1) % self.window
+        self.frames += 1
+
+        self.winners = self.counts.argmax(axis=1)
+        self.confidence = counts[self.offsets + self.winners] / self.window
+        return self.winners, self.confidence
+
+    @property
+    def stable(self):
+        """Whether every sticker has reached the confidence threshold."""
+        return self.frames > 0 and bool((self.confidence >= self.threshold).all())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+from colordetection import color_detector
+from detection import detect_grid, detect_grid_pyramid, sample_stickers
+
+class SharedFrameRing:
+    """
+    A ring of frame slots in shared memory. The camera writes frames directly
+    into a slot and worker processes read them from there, so frames are never
+    copied or pickled between processes.
+    """
+
+    def __init__(self, slots, shape, name=None):
+        """
+        :param slots int: The amount of frames the ring can hold.
+        :param shape tuple: The shape of a frame, e.g. (480, 640, 3).
+        :param name str: Attach to an existing ring instead of creating one.
+        """
+        self.owner = name is None
+        size = slots * int(np.prod(shape))
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.frames = np.ndarray((slots,) + tuple(shape), dtype=np.uint8, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        """Detach from the ring and free it when this process created it."""
+        del self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def detection_worker(ring_name, slots, shape, scale, pyramid_width, dominant_color_method, tasks, results):
+    """
+    Worker process main: find the contours and the dominant sticker colors of
+    the frames in the ring slots received through the tasks queue.
+
+    Results are (sequence number, slot, contours, dominant colors or None).
+    """
+    # Every worker gets one core, the parallelism comes from the processes.
+    cv2.setNumThreads(1)
+    color_detector.set_dominant_color_method(dominant_color_method)
+    ring = SharedFrameRing(slots, shape, name=ring_name)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, slot = task
+        frame = ring.frames[slot]
+        if pyramid_width:
+            contours = detect_grid_pyramid(frame, scale, pyramid_width)
+        else:
+            contours = detect_grid(frame, scale)
+        dominant_colors = None
+        if len(contours) == 9:
+            dominant_colors = color_detector.get_dominant_colors(sample_stickers(frame, contours, scale))
+        results.put((seq, slot, contours, dominant_colors))
+    ring.close()
+
+class DetectionPool:
+    """
+    A pool of detection worker processes sharing a frame ring.
+
+    Usage: acquire() a free slot, write a frame into ring.frames[slot],
+    submit() it and get() the results, which are returned in the order the
+    frames were submitted. A slot must be release()d once its frame is no
+    longer needed.
+    """
+
+    def __init__(self, workers, shape, scale=1.0, pyramid_width=None, slots=None, dominant_color_method=None):
+        slots = slots or workers * 2
+        self.ring = SharedFrameRing(slots, shape)
+        self.free_slots = deque(range(slots))
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.next_result = 0
+        self.pending = {}
+
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        method = dominant_color_method or color_detector.dominant_color_method
+        self.processes = [
+            context.Process(
+                target=detection_worker,
+                args=(self.ring.name, slots, shape, scale, pyramid_width, method, self.tasks, self.results),
+                daemon=True
+            )
+            for _ in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def acquire(self):
+        """Get a free slot, or None when all slots are in use."""
+        with self.lock:
+            return self.free_slots.popleft() if self.free_slots else None
+
+    def release(self, slot):
+        """Give a slot back to the ring."""
+        with self.lock:
+            self.free_slots.append(slot)
+
+    def submit(self, slot):
+        """Queue the frame in the given slot for detection."""
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+        self.tasks.put((seq, slot))
+        return seq
+
+    def get(self, timeout=None):
+        """
+        Get the result of the oldest submitted frame.
+
+        :returns: (seq, slot, contours, dominant colors), or None on timeout.
+        """
+        while self.next_result not in self.pending:
+            try:
+                result = self.results.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            self.pending[result[0]] = result
+        result = self.pending.pop(self.next_result)
+        self.next_result += 1
+        return result
+
+    def close(self):
+        """Stop all workers and free the ring."""
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.ring.close()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import itertools
+import math
+import numpy as np
+import pytest
+from assignment import assign_with_counts
+
+def brute_force(distances, counts, fixed=None):
+    """The cheapest total distance over every assignment with the counts."""
+    items, classes = distances.shape
+    best = math.inf
+    for labels in itertools.product(range(classes), repeat=items):
+        if (np.bincount(labels, minlength=classes) != counts).any():
+            continue
+        if fixed is not None and any(0 <= f != l for f, l in zip(fixed, labels)):
+            continue
+        best = min(best, distances[np.arange(items), labels].sum())
+    return best
+
+def total(distances, labels):
+    return distances[np.arange(len(labels)), labels].sum()
+
+@pytest.mark.parametrize('seed', range(20))
+def test_optimal_with_the_counts(seed):
+    rng = np.random.default_rng(seed)
+    distances = rng.random((8, 3))
+    counts = np.array([3, 3, 2])
+    labels, _ = assign_with_counts(distances, counts)
+    assert (np.bincount(labels, minlength=3) == counts).all()
+    assert total(distances, labels) == pytest.approx(brute_force(distances, counts))
+
+@pytest.mark.parametrize('seed', range(10))
+def test_fixed_items_keep_their_class(seed):
+    rng = np.random.default_rng(seed)
+    distances = rng.random((8, 3))
+    counts = np.array([3, 3, 2])
+    fixed = np.array([2, 2, -1, -1, 0, -1, -1, -1])
+    labels, margins = assign_with_counts(distances, counts, fixed)
+    assert (labels[fixed >= 0] == fixed[fixed >= 0]).all()
+    assert np.isinf(margins[fixed >= 0]).all()
+    assert total(distances, labels) == pytest.approx(brute_force(distances, counts, fixed))
+
+@pytest.mark.parametrize('seed', range(10))
+def test_margins_match_forcing_another_class(seed):
+    rng = np.random.default_rng(seed)
+    distances = rng.random((7, 3))
+    counts = np.array([3, 2, 2])
+    labels, margins = assign_with_counts(distances, counts)
+    best = total(distances, labels)
+    for item in range(len(labels)):
+        forced = math.inf
+        for label in range(3):
+            if label != labels[item]:
+                fixed = np.full(len(labels), -1)
+                fixed[item] = label
+                forced = min(forced, brute_force(distances, counts, fixed))
+        assert margins[item] == pytest.approx(forced - best)
+
+def test_closest_classes_are_kept_when_the_counts_match():
+    distances = np.array([[0, 1], [1, 0], [0, 1], [1, 0]])
+    labels, margins = assign_with_counts(distances, [2, 2])
+    assert labels.tolist() == [0, 1, 0, 1]
+    assert (margins == 2).all()
+
+def test_wrong_total_count():
+    with pytest.raises(ValueError):
+        assign_with_counts(np.zeros((4, 2)), [2, 1])
+
+def test_fixed_items_exceeding_a_count():
+    with pytest.raises(ValueError):
+        assign_with_counts(np.zeros((4, 2)), [1, 3], fixed=[0, 0, -1, -1])
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import itertools
+import random
+import pytest
+from cube import (
+    SOLVED_STATE,
+    MOVES,
+    CENTERS,
+    CORNER_FACELETS,
+    EDGE_FACELETS,
+    ROBOT_ROTATIONS,
+    FaceletState,
+    InvalidCubeState,
+    apply_moves,
+    apply_permutation
+)
+
+def scramble(seed, length=25):
+    rng = random.Random(seed)
+    return apply_moves(SOLVED_STATE, [rng.choice(list(MOVES)) for _ in range(length)])
+
+def swap(facelets, pairs):
+    facelets = list(facelets)
+    for i, j in pairs:
+        facelets[i], facelets[j] = facelets[j], facelets[i]
+    return ''.join(facelets)
+
+def reason(facelets):
+    try:
+        FaceletState.from_facelets(facelets).validate()
+    except InvalidCubeState as e:
+        return e.reason
+    return None
+
+@pytest.mark.parametrize('seed', range(20))
+def test_scrambles_are_valid(seed):
+    facelets = scramble(seed)
+    assert reason(facelets) is None
+    assert FaceletState.from_facelets(facelets).to_facelets() == facelets
+
+def test_whole_cube_rotations_are_valid():
+    facelets = scramble(0)
+    for permutation in ROBOT_ROTATIONS.values():
+        rotated = apply_permutation(facelets, permutation)
+        # Named after the new centers like a scan would.
+        assert reason(FaceletState.from_facelets(rotated).to_facelets()) is None
+
+def test_solved():
+    assert FaceletState.from_facelets(SOLVED_STATE).solved
+    assert not FaceletState.from_facelets(scramble(1)).solved
+
+def test_wrong_color_counts():
+    facelets = scramble(2)
+    replacement = 'R' if facelets[0] != 'R' else 'U'
+    assert reason(replacement + facelets[1:]) == 'colors'
+
+def test_duplicate_centers():
+    # Every color 9 times, but two centers share a color.
+    facelets = swap(SOLVED_STATE, [(CENTERS[0], CENTERS[1] - 1)])
+    assert reason(facelets) == 'centers'
+
+def test_swapped_opposite_centers():
+    # Every center differs, but F and B are mirrored: kociemba would return
+    # a solution for this.
+    facelets = swap(SOLVED_STATE, [(CENTERS[2], CENTERS[5])])
+    assert facelets == 'UUUUUUUUURRRRRRRRRFFFFBFFFFDDDDDDDDDLLLLLLLLLBBBBFBBBB'
+    assert reason(facelets) == 'centers'
+
+def test_rotated_centers_are_valid():
+    # The colors of a whole cube rotation, not named after the new centers.
+    for permutation in ROBOT_ROTATIONS.values():
+        assert reason(apply_permutation(scramble(3), permutation)) is None
+
+def test_impossible_cubie():
+    # A corner with two facelets of the same color.
+    corner = CORNER_FACELETS[0]
+    edge = EDGE_FACELETS[0]
+    facelets = swap(SOLVED_STATE, [(corner[1], edge[0])])
+    assert reason(facelets) == 'cubies'
+
+def test_mirrored_corner():
+    # The two side facelets of the UBL corner swapped: the right colors, but
+    # counterclockwise.
+    facelets = 'UUUUUUUUURRRRRRRRRFFFFFFFFFDDDDDDDDDBLLLLLLLLBBLBBBBBB'
+    assert swap(SOLVED_STATE, [CORNER_FACELETS[0][1:]]) == facelets
+    assert reason(facelets) == 'cubies'
+
+def test_twisted_corner():
+    corner = CORNER_FACELETS[0]
+    facelets = swap(scramble(4), [(corner[0], corner[1]), (corner[1], corner[2])])
+    assert reason(facelets) == 'twist'
+
+def test_flipped_edge():
+    edge = EDGE_FACELETS[0]
+    assert reason(swap(scramble(5), [(edge[0], edge[1])])) == 'flip'
+
+def test_swapped_edges():
+    assert reason(swap(scramble(6), zip(EDGE_FACELETS[0], EDGE_FACELETS[1]))) == 'parity'
+
+def test_invalid_facelet_strings():
+    with pytest.raises(InvalidCubeState):
+        FaceletState.from_facelets(SOLVED_STATE[:53])
+    with pytest.raises(InvalidCubeState):
+        FaceletState.from_facelets('X' + SOLVED_STATE[1:])
+
+def test_agrees_with_kociemba():
+    # Every swap of two facelets, centers included. kociemba accepts some
+    # impossible states and returns a solution anyway, so a state counts as
+    # solvable only when the solution actually solves it.
+    kociemba = pytest.importorskip('kociemba')
+    facelets = scramble(7)
+    solvable = {}
+    for i, j in itertools.combinations(range(54), 2):
+        swapped = swap(facelets, [(i, j)])
+        if swapped not in solvable:
+            try:
+                solvable[swapped] = apply_moves(swapped, kociemba.solve(swapped)) == SOLVED_STATE
+            except ValueError:
+                solvable[swapped] = False
+        assert (reason(swapped) is None) == solvable[swapped], (i, j)
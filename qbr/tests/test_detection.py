@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import numpy as np
+import pytest
+from detection import find_grid, sort_grid
+
+def find_grid_bruteforce(final_contours):
+    """The original O(n^2) neighbor search, the reference of find_grid."""
+    if len(final_contours) < 9:
+        return []
+    for (x, y, w, h) in final_contours:
+        center_x, center_y = x + w / 2, y + h / 2
+        positions = [(center_x + w * dx * 1.5, center_y + h * dy * 1.5) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+        neighbors = [
+            (x2, y2, w2, h2) for (x2, y2, w2, h2) in final_contours for (x3, y3) in positions
+            if x2 < x3 and y2 < y3 and x2 + w2 > x3 and y2 + h2 > y3
+        ]
+        if len(neighbors) == 9:
+            return sort_grid(neighbors)
+    return []
+
+def grid(x0, y0, size=40, pitch=50):
+    return [(x0 + col * pitch, y0 + row * pitch, size, size) for row in range(3) for col in range(3)]
+
+def random_candidates(rng, amount, shape=(480, 640)):
+    """A 3x3 grid plus random square-ish clutter, shuffled."""
+    height, width = shape
+    candidates = grid(int(rng.integers(0, width - 150)), int(rng.integers(0, height - 150)))
+    while len(candidates) < amount:
+        w = int(rng.integers(30, 61))
+        h = int(np.clip(w * rng.uniform(0.85, 1.2), 30, 75))
+        candidates.append((int(rng.integers(0, width - w)), int(rng.integers(0, height - h)), w, h))
+    rng.shuffle(candidates)
+    return candidates
+
+def test_finds_a_shuffled_grid_sorted():
+    contours = grid(100, 80)
+    shuffled = list(reversed(contours))
+    assert find_grid(shuffled) == contours
+
+def test_needs_9_contours():
+    assert find_grid(grid(100, 80)[:8]) == []
+
+def test_no_grid_among_scattered_contours():
+    contours = [(index * 100, (index % 3) * 150, 40, 40) for index in range(12)]
+    assert find_grid(contours) == []
+
+@pytest.mark.parametrize('amount', [9, 20, 50, 120])
+def test_matches_the_bruteforce_search(amount):
+    rng = np.random.default_rng(amount)
+    for _ in range(50):
+        candidates = random_candidates(rng, amount)
+        assert find_grid(candidates) == find_grid_bruteforce(candidates)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import threading
+import time
+from pipeline import LatestQueue
+
+def test_get_returns_items_oldest_first():
+    items = LatestQueue(maxsize=3)
+    for item in range(3):
+        items.put(item)
+    assert [items.get(0) for _ in range(3)] == [0, 1, 2]
+    assert items.dropped == 0
+
+def test_put_drops_the_oldest_item_when_full():
+    items = LatestQueue(maxsize=2)
+    for item in range(5):
+        items.put(item)
+    assert items.dropped == 3
+    assert [items.get(0), items.get(0)] == [3, 4]
+
+def test_get_times_out_with_none():
+    items = LatestQueue()
+    start = time.monotonic()
+    assert items.get(timeout=0.05) is None
+    assert time.monotonic() - start >= 0.04
+
+def test_get_wakes_up_on_put():
+    items = LatestQueue()
+    threading.Timer(0.02, items.put, args=('frame',)).start()
+    assert items.get(timeout=5) == 'frame'
+
+def test_close_wakes_up_consumers_and_keeps_remaining_items():
+    items = LatestQueue(maxsize=2)
+    threading.Timer(0.02, items.close).start()
+    start = time.monotonic()
+    assert items.get(timeout=5) is None
+    assert time.monotonic() - start < 4
+
+    items = LatestQueue(maxsize=2)
+    items.put('last')
+    items.close()
+    assert items.get() == 'last'
+    assert items.get() is None
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+from planner import MoveCostModel, espqbr_move_costs
+
+def test_defaults():
+    assert MoveCostModel().costs == espqbr_move_costs()
+
+def test_face_applies_to_all_its_moves():
+    costs = MoveCostModel({'U': 20}).costs
+    assert costs['U'] == costs["U'"] == costs['U2'] == 20
+    assert costs['R'] == espqbr_move_costs()['R']
+
+def test_given_moves_win_over_their_face_in_any_order():
+    for overrides in ({'U2': 50, 'U': 20}, {'U': 20, 'U2': 50}):
+        model = MoveCostModel(overrides)
+        assert model.costs['U'] == model.costs["U'"] == 20
+        assert model.costs['U2'] == 50
+        assert model.cost(['U', 'U2']) == 70
+
+def test_key_depends_on_the_costs_only():
+    assert MoveCostModel({'U2': 50, 'U': 20}).key == MoveCostModel({'U': 20, 'U2': 50}).key
+    assert MoveCostModel({'U': 20}).key != MoveCostModel().key
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import pytest
+from protocol import (
+    FrameDecoder,
+    Frame,
+    ProtocolError,
+    checksum,
+    encode_frame,
+    encode_moves,
+    decode_moves,
+    MOVE_CODES,
+    FRAME_MOVES,
+    FRAME_ACK,
+    FRAME_MAX_PAYLOAD,
+    NAK_CHECKSUM,
+    NAK_TOO_LONG
+)
+
+def test_checksum_is_crc16_ccitt_false():
+    assert checksum(b'123456789') == 0x29b1
+    assert checksum(b'') == 0xffff
+
+def test_move_bytes():
+    assert encode_moves("U U2 U' R S T X Z'") == bytes([0x01, 0x02, 0x03, 0x11, 0x60, 0x70, 0x81, 0x93])
+
+def test_moves_round_trip():
+    moves = list(MOVE_CODES)
+    assert decode_moves(encode_moves(moves)) == moves
+
+def test_unknown_moves():
+    with pytest.raises(ProtocolError):
+        encode_moves('R3')
+    with pytest.raises(ProtocolError):
+        decode_moves(b'\xff')
+
+def test_frame_round_trip():
+    payload = encode_moves("R U2 F'")
+    frame = encode_frame(FRAME_MOVES, 7, payload)
+    decoder = FrameDecoder()
+    assert decoder.feed(frame) == [Frame(FRAME_MOVES, 7, payload)]
+    assert decoder.rejected == []
+    assert decoder.skipped == 0
+
+def test_sequence_numbers_wrap():
+    assert FrameDecoder().feed(encode_frame(FRAME_ACK, 0x10001)) == [Frame(FRAME_ACK, 1, b'')]
+
+def test_payload_limit():
+    with pytest.raises(ProtocolError):
+        encode_frame(FRAME_MOVES, 1, bytes(FRAME_MAX_PAYLOAD + 1))
+
+def test_frames_split_over_reads():
+    data = encode_frame(FRAME_MOVES, 1, b'\x01\x02') + encode_frame(FRAME_ACK, 2)
+    decoder = FrameDecoder()
+    frames = []
+    for index in range(len(data)):
+        frames += decoder.feed(data[index:index + 1])
+    assert frames == [Frame(FRAME_MOVES, 1, b'\x01\x02'), Frame(FRAME_ACK, 2, b'')]
+
+def test_skips_bytes_in_front_of_a_frame():
+    decoder = FrameDecoder()
+    noise = b'Received: R\r\nStep 1 Cmd R\r\n'
+    assert decoder.feed(noise + encode_frame(FRAME_ACK, 3)) == [Frame(FRAME_ACK, 3, b'')]
+    assert decoder.skipped == len(noise)
+
+def test_rejects_a_damaged_frame_and_resynchronizes():
+    damaged = bytearray(encode_frame(FRAME_MOVES, 4, b'\x01\x02\x03'))
+    damaged[-3] ^= 0x40
+    decoder = FrameDecoder()
+    frames = decoder.feed(bytes(damaged) + encode_frame(FRAME_ACK, 5))
+    assert frames == [Frame(FRAME_ACK, 5, b'')]
+    assert decoder.rejected == [(4, NAK_CHECKSUM)]
+
+def test_rejects_an_implausible_length():
+    decoder = FrameDecoder(max_payload=8)
+    frames = decoder.feed(encode_frame(FRAME_MOVES, 6, bytes(9)) + encode_frame(FRAME_ACK, 6))
+    assert frames == [Frame(FRAME_ACK, 6, b'')]
+    assert decoder.rejected[0] == (6, NAK_TOO_LONG)
+
+def test_drops_a_stale_partial_frame():
+    decoder = FrameDecoder(idle_timeout=0)
+    frame = encode_frame(FRAME_MOVES, 8, b'\x01')
+    assert decoder.feed(frame[:5]) == []
+    # The rest arrives too late, the next complete frame still decodes.
+    decoder.received_at -= 1
+    assert decoder.feed(frame[5:] + encode_frame(FRAME_ACK, 9)) == [Frame(FRAME_ACK, 9, b'')]
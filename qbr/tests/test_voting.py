@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import numpy as np
+from voting import StickerVotes
+
+def test_not_stable_without_votes():
+    votes = StickerVotes(4, 0.75)
+    assert not votes.stable
+
+def test_majority_wins_with_its_share_of_the_window():
+    votes = StickerVotes(4, 0.75, colors=3, stickers=2)
+    for indices in ([0, 1], [0, 2], [0, 2], [1, 2]):
+        winners, confidence = votes.vote(indices)
+    assert winners.tolist() == [0, 2]
+    assert confidence.tolist() == [0.75, 0.75]
+    assert votes.stable
+
+def test_old_votes_leave_the_window():
+    votes = StickerVotes(3, 1.0, colors=2, stickers=1)
+    for index in (0, 0, 0, 1, 1, 1):
+        winners, confidence = votes.vote([index])
+    assert winners.tolist() == [1]
+    assert confidence.tolist() == [1.0]
+    # Every color's count is exactly the votes inside the window.
+    assert votes.counts.tolist() == [[0, 3]]
+
+def test_matches_counting_the_last_votes():
+    rng = np.random.default_rng(0)
+    window, colors = 5, 6
+    votes = StickerVotes(window, 0.6, colors)
+    history = []
+    for _ in range(100):
+        indices = rng.integers(0, colors, 9)
+        history.append(indices)
+        winners, confidence = votes.vote(indices)
+        counts = np.array([np.bincount(column, minlength=colors) for column in np.array(history[-window:]).T])
+        assert (winners == counts.argmax(axis=1)).all()
+        assert np.allclose(confidence, counts.max(axis=1) / window)
+
+def test_reset_forgets_all_votes():
+    votes = StickerVotes(2, 0.5)
+    votes.vote(np.zeros(9, dtype=int))
+    assert votes.stable
+    votes.reset()
+    assert not votes.stable
+    assert not votes.counts.any()
+
+def test_window_of_one_follows_every_frame():
+    votes = StickerVotes(1, 1.0)
+    for index in range(6):
+        winners, _ = votes.vote(np.full(9, index))
+        assert (winners == index).all()
+        assert votes.stable